@@ -1,10 +1,11 @@
 import streamlit as st
-from openai import OpenAI
 from pathlib import Path
 import base64
 import os
 import time
 
+from resources import get_openai_client, get_openai_tts_client
+
 # OpenAI APIキーを環境変数から取得（Render.com用）
 def get_openai_api_key():
     api_key = os.getenv("OPENAI_API_KEY")
@@ -13,7 +14,10 @@ def get_openai_api_key():
         st.stop()
     return api_key
 
-client = OpenAI(api_key=get_openai_api_key())
+# OpenAIクライアントの取得（プロセス内で共有されるので再実行のたびに作り直さない）
+openai_api_key = get_openai_api_key()
+client = get_openai_client(openai_api_key)
+tts_client = get_openai_tts_client(openai_api_key)
 
 # 画像のパスを設定
 AVATAR_PATH = Path("src/images/opening.png")
@@ -149,7 +153,7 @@ def init_session_state():
 def generate_speech(text):
     """Generate speech from text using OpenAI TTS"""
     try:
-        response = client.audio.speech.create(
+        response = tts_client.audio.speech.create(
             model="tts-1",
             voice="ash",  # 男性の声で挑発的な感じ
             input=text,
@@ -1,20 +1,165 @@
 import streamlit as st
-from openai import OpenAI
 from datetime import datetime
 from pathlib import Path
-import base64
 import io
 import tempfile
 import os
+import uuid
 import time
 import streamlit.components.v1 as components
 
-# OpenAI APIキーをsecretsから取得
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+from context_window import count_message_tokens
+from floor import get_floor
+from judge import VERDICT_CORRECT
+from llm_scheduler import PRIORITY_FLOOR, SchedulerRejected
+from media import audio_html, display_image, play_sound_effect, preload_sound_effects, register_media
+from pronunciation import apply_readings
+from model_router import TURN_OPEN, classify_turn
+from quiz_bank import QuizTracker, parse_prompt, parse_verdict
+from resources import (
+    get_avatar_thumbnail,
+    get_async_openai_client,
+    get_async_worker,
+    get_circuit_breakers,
+    get_llm_scheduler,
+    get_model_router,
+    get_openai_client,
+    get_openai_tts_client,
+    get_tts_cache,
+)
+from resilience import CircuitOpen, Deadline, DeadlineExceeded, call_with_retries, call_with_retries_async
+from rooms import current_session_id, request_rerun
+from transcript import display_older_messages, split_transcript
+from transitions import run_scheduled_transition, schedule_transition, transition_scheduled
+from tts_cache import make_cache_key
+
+# OpenAI APIキーをsecretsから取得（クライアントはプロセス内で共有）
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+tts_client = get_openai_tts_client(st.secrets["OPENAI_API_KEY"])
+# 返答の生成はスクリプトのスレッドではなく共有のイベントループで行う
+async_client = get_async_openai_client(st.secrets["OPENAI_API_KEY"])
+# イベントループからも使うので、スクリプトのスレッドで取得しておく
+tts_cache = get_tts_cache()
+# フロアの参加者の返答は、舞台上のステージより後に回す
+scheduler = get_llm_scheduler()
+breakers = get_circuit_breakers()
+# 判定済みの反応や出題だけのターンは小さなモデルに送る
+model_router = get_model_router()
+PRIORITY = PRIORITY_FLOOR
 
 # 画像のパスを設定
 AVATAR_PATH = Path("src/images/opening.png")
 
+# 効果音が読み込めなかったときに、次の画面に進むまで待つ時間（秒）
+DOOR_OPEN_SECONDS = 2
+
+# フロアモードの画面を更新する間隔（秒）
+FLOOR_REFRESH_SECONDS = 2
+
+# 返答を待っている間、終わったかどうかを確かめる間隔（秒）。通常は終わった時点で再実行される
+PENDING_TURN_POLL_SECONDS = 1
+
+# 返答と音声合成の持ち時間（秒）。過ぎたら返答はエラー、音声は文字だけの表示にする
+CHAT_TURN_BUDGET_SECONDS = 20
+TTS_BUDGET_SECONDS = 8
+
+# 黒水校長のキャラクター設定と問題リスト（問題は quiz_bank で1問ずつに分けて使う）
+SYSTEM_PROMPT = """
+GPTは黒水校長になりきってユーザーに問題を出します
+福岡の筑後弁で、挑発的な態度でしゃべってください。
+優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
+
+### 筑後弁の特徴
+以下の筑後弁の特徴を必ず使ってください：
+
+【語尾】
+- 「〜ばい」（〜だよ、〜だぞ）
+- 「〜たい」（〜だよ）
+- 「〜ちゃる」（〜てしまう、〜てやる）
+- 「〜やけん」（〜だから）
+- 「〜とる」（〜ている）
+- 「〜やろ」（〜だろう）
+
+【特有の語彙】
+- 「なんね」（何だね）
+- 「ええ」（いい）
+- 「よか」（いい）
+- 「おい」（俺）
+- 「あんた」（あなた）
+- 「あんたら」（あなたたち）
+- 「こげん」（こんな）
+- 「そげん」（そんな）
+- 「あげん」（あんな）
+- 「どげん」（どんな）
+- 「いっちょん」（全然）
+- 「ばってん」（だけど）
+- 「たいぎ」（大変）
+- 「しゃあない」（仕方ない）
+
+【音韻変化】
+- 「し」→「ひ」（例：しゃべる→ひゃべる）
+- 「じ」→「び」（例：時間→びかん）
+
+【例文】
+- 「なんね、あんたら？元の附設にもどしたい？」
+- 「そんならおいの質問に答えてみんね？」
+- 「卒業生なら、簡単に答えられるやろう」
+- 「準備はええかね？」
+- 「こげんもんじゃなかっちゃな」
+- 「よかたい、次は体育館で決着ばつけちゃるばい！」
+
+### 質問
+下記の質問を順番に質問してください
+正解するまでは次の謎に進めません。正解しない限り次に進めません。
+正解は伝えません。
+
+質問１：鎌倉幕府を開いた源頼朝（みなもとのよりとも）が征夷大将軍（せいいたいしょうぐん）に任命されたのは何年や？
+答え：1192年
+
+質問２：次の文の空欄に入る最も適切な単語はなんだ  If I ___ more time, I would travel around the world.
+答え：had
+
+質問３：細胞の中で、エネルギーを作り出す働きを持つ細胞小器官は何か？
+答え：ミトコンドリア
+
+質問４：「いとをかし」の現代語訳として正しいものは？
+
+質問５：ムハンマドが創始した宗教は何か？
+答え：イスラム教
+
+#### ここからは附設に関する質問やけんな
+質問６：浪人生が行くクラスの名前は？
+答え：補修科
+
+質問７：附設の裏にあった商店の通称は？
+答え：裏店（うらみせ）
+
+質問８：学食の牛丼の名称は？
+答え：にくめし
+
+質問９：高校の文化祭の名前は？
+答え：男く祭（おとこくさい）
+
+質問１０：附設高校が共学になった年は？
+答え：2005年
+
+
+###出題方法
+ヒントはださないでください
+答えを聞かれても教えてないでください
+
+### 正誤の判定方法
+厳密に答えとあっていなくても正解とします
+「わからない」「分からない」「知らない」などの回答は不正解とします
+
+### 最後の会話
+参加者が10問とも正解したら、「おお！正解ばい！さすがは附設の卒業生じゃのう。頭の回転が速かばい！全問正解！さすがじゃ！お前が本当の附設の卒業生じゃと認めよう。」というコメントをしてください。
+
+### 口調
+福岡の筑後弁で挑発的な態度でしゃべってください。
+優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
+"""
+
 def init_session_state():
     """Initialize session state variables"""
     if 'game_state' not in st.session_state:
@@ -22,130 +167,49 @@ def init_session_state():
     if 'messages' not in st.session_state:
         st.session_state.messages = []
     if 'openai_messages' not in st.session_state:
+        # 問題はアプリ側で1問ずつ指示するので、システムプロンプトはキャラクター設定だけ
+        bank = parse_prompt(SYSTEM_PROMPT)
         st.session_state.openai_messages = [
-            {"role": "system", "content": """
-            GPTは黒水校長になりきってユーザーに問題を出します
-            福岡の筑後弁で、挑発的な態度でしゃべってください。
-            優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
-
-            ### 筑後弁の特徴
-            以下の筑後弁の特徴を必ず使ってください：
-            
-            【語尾】
-            - 「〜ばい」（〜だよ、〜だぞ）
-            - 「〜たい」（〜だよ）
-            - 「〜ちゃる」（〜てしまう、〜てやる）
-            - 「〜やけん」（〜だから）
-            - 「〜とる」（〜ている）
-            - 「〜やろ」（〜だろう）
-            
-            【特有の語彙】
-            - 「なんね」（何だね）
-            - 「ええ」（いい）
-            - 「よか」（いい）
-            - 「おい」（俺）
-            - 「あんた」（あなた）
-            - 「あんたら」（あなたたち）
-            - 「こげん」（こんな）
-            - 「そげん」（そんな）
-            - 「あげん」（あんな）
-            - 「どげん」（どんな）
-            - 「いっちょん」（全然）
-            - 「ばってん」（だけど）
-            - 「たいぎ」（大変）
-            - 「しゃあない」（仕方ない）
-            
-            【音韻変化】
-            - 「し」→「ひ」（例：しゃべる→ひゃべる）
-            - 「じ」→「び」（例：時間→びかん）
-            
-            【例文】
-            - 「なんね、あんたら？元の附設にもどしたい？」
-            - 「そんならおいの質問に答えてみんね？」
-            - 「卒業生なら、簡単に答えられるやろう」
-            - 「準備はええかね？」
-            - 「こげんもんじゃなかっちゃな」
-            - 「よかたい、次は体育館で決着ばつけちゃるばい！」
-
-            ### 質問
-            下記の質問を順番に質問してください
-            正解するまでは次の謎に進めません。正解しない限り次に進めません。
-            正解は伝えません。
-
-            質問１：鎌倉幕府を開いた源頼朝（みなもとのよりとも）が征夷大将軍（せいいたいしょうぐん）に任命されたのは何年や？
-            答え：1192年
-            
-            質問２：次の文の空欄に入る最も適切な単語はなんだ  If I ___ more time, I would travel around the world.
-            答え：had
-            
-            質問３：細胞の中で、エネルギーを作り出す働きを持つ細胞小器官は何か？
-            答え：ミトコンドリア
-            
-            質問４：「いとをかし」の現代語訳として正しいものは？
-             
-            質問５：ムハンマドが創始した宗教は何か？
-            答え：イスラム教
-            
-            #### ここからは附設に関する質問やけんな
-            質問６：浪人生が行くクラスの名前は？
-            答え：補修科
-             
-            質問７：附設の裏にあった商店の通称は？
-            答え：裏店（うらみせ）
-            
-            質問８：学食の牛丼の名称は？
-            答え：にくめし
-             
-            質問９：高校の文化祭の名前は？
-            答え：男く祭（おとこくさい）
-            
-            質問１０：附設高校が共学になった年は？
-            答え：2005年
-            
-
-            ###出題方法
-            ヒントはださないでください
-            答えを聞かれても教えてないでください
-
-            ### 正誤の判定方法
-            厳密に答えとあっていなくても正解とします
-            「わからない」「分からない」「知らない」などの回答は不正解とします
-
-            ### 最後の会話
-            参加者が10問とも正解したら、「おお！正解ばい！さすがは附設の卒業生じゃのう。頭の回転が速かばい！全問正解！さすがじゃ！お前が本当の附設の卒業生じゃと認めよう。」というコメントをしてください。
-
-            ### 口調
-            福岡の筑後弁で挑発的な態度でしゃべってください。
-            優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
-            """
-            }
+            {"role": "system", "content": bank.system_prompt()}
         ]
+        st.session_state.quiz_tracker = QuizTracker(bank)
     if 'avatar_image' not in st.session_state:
-        if AVATAR_PATH.exists():
-            with open(AVATAR_PATH, "rb") as f:
-                avatar_data = f.read()
-            st.session_state.avatar_image = avatar_data
-        else:
-            st.session_state.avatar_image = None
+        # 縮小画像はプロセスで1つだけ持ち、各セッションはそれを参照する
+        st.session_state.avatar_image = get_avatar_thumbnail(str(AVATAR_PATH))
     if 'tts_enabled' not in st.session_state:
         st.session_state.tts_enabled = True
     if 'quiz_completed' not in st.session_state:
         st.session_state.quiz_completed = False
+    if 'participant_id' not in st.session_state:
+        # フロアモードで回答した人を見分けるためのID
+        st.session_state.participant_id = uuid.uuid4().hex
 
 def generate_speech(text):
     """Generate speech from text using OpenAI TTS"""
-    try:
-        response = client.audio.speech.create(
-            model="tts-1",
-            voice="ash",  # 男性の声で挑発的な感じ
-            input=text,
-            speed=1.0  # 少しゆっくりめで威厳のある感じ
+    def synthesize():
+        response = call_with_retries(
+            lambda timeout: tts_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+                model="tts-1",
+                voice="ash",  # 男性の声で挑発的な感じ
+                input=text,
+                speed=1.0  # 少しゆっくりめで威厳のある感じ
+            ),
+            Deadline(TTS_BUDGET_SECONDS),
+            breakers.get("openai-tts"),
         )
+        return response.content
+
+    try:
+        # 同じ台詞は合成済みの音声を使い回す
+        audio_bytes = get_tts_cache().get_or_create(make_cache_key("openai", "ash", "tts-1", 1.0, text), synthesize)
         
         # 音声データを一時ファイルに保存
         with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-            tmp_file.write(response.content)
+            tmp_file.write(audio_bytes)
             return tmp_file.name
+    except (DeadlineExceeded, CircuitOpen):
+        # 音声が間に合わないときは文字だけ表示する
+        return None
     except Exception as e:
         st.error(f"音声生成エラー: {str(e)}")
         return None
@@ -385,22 +449,86 @@ def load_css():
     </style>
     """
 
-def get_chat_response(messages):
-    """Get response from OpenAI API"""
+async def get_chat_response(messages, instruction=None, session_id=None, turn_type=TURN_OPEN):
+    """Get response from OpenAI API（イベントループ上で実行する）
+
+    instructionには今回のターンだけの指示（今の問題と進行状況）を渡す。
+    turn_typeで小さなモデルに送るか大きなモデルに送るかが決まる。
+    送る前にプロセス全体の順番待ちで順番を取る。(返答, 使ったモデルと応答時間) を返す
+    """
+    if instruction:
+        # 今回のターンの指示は最後のユーザーメッセージの直前に置く
+        messages = messages[:-1] + [{"role": "system", "content": instruction}] + messages[-1:]
+    deadline = Deadline(CHAT_TURN_BUDGET_SECONDS)
+    _, model = model_router.choose(turn_type, "gpt-4o", ["gpt-4o"])
+    # 上限はモデルごとなので、送るモデルの順番を取る
+    await scheduler.acquire_async(
+        session_id, PRIORITY, count_message_tokens(messages) + 1000, model, timeout=deadline.remaining()
+    )
+    started = time.monotonic()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
+        response = await call_with_retries_async(
+            lambda timeout: async_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000
+            ),
+            deadline,
+            breakers.get("openai"),
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"エラーが発生しました: {str(e)}")
-        return None
+    except Exception:
+        model_router.stats.record(model, ok=False)
+        raise
+    latency = time.monotonic() - started
+    model_router.stats.record(model, latency)
+    return response.choices[0].message.content, {"model": model, "total_latency": round(latency, 2)}
+
+async def take_turn(messages, instruction=None, speak=False, session_id=None, turn_type=TURN_OPEN):
+    """返答を取得し、読み上げる場合は音声も続けて合成する
+
+    (返答, 判定タグ, 音声のバイト列, 使ったモデルと応答時間) を返す。音声が作れなくても返答は返す
+    """
+    ai_response, route = await get_chat_response(messages, instruction, session_id, turn_type)
+    tagged_verdict, ai_response = parse_verdict(ai_response)
+    audio_bytes = None
+    if speak and ai_response:
+        # 同じ台詞は合成済みの音声を使い回す（get_or_create はループを止めるので get と put に分ける）
+        cache_key = make_cache_key("openai", "ash", "tts-1", 1.0, ai_response)
+        try:
+            audio_bytes = tts_cache.get(cache_key)
+            if audio_bytes is None:
+                response = await call_with_retries_async(
+                    lambda timeout: async_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+                        model="tts-1", voice="ash", input=ai_response, speed=1.0
+                    ),
+                    Deadline(TTS_BUDGET_SECONDS),
+                    breakers.get("openai-tts"),
+                )
+                audio_bytes = response.content
+                tts_cache.put(cache_key, audio_bytes)
+        except Exception:
+            # 音声が間に合わないときは文字だけ表示する
+            audio_bytes = None
+    return ai_response, tagged_verdict, audio_bytes, route
+
+def new_message(role, content):
+    """表示用のメッセージを作成
+
+    再実行をまたいで同じメッセージを見分けるためのIDと、読み上げ音声の状態を持たせる。
+    音声の状態は pending（未合成）→ synthesized（合成済み）→ delivered（ブラウザに送信済み）
+    → played（再生済み）と進み、TTSがオフのときに表示したものは skipped になる。
+    """
+    message = {"id": uuid.uuid4().hex, "role": role, "content": content}
+    if role == "assistant":
+        message["audio"] = {"status": "pending"}
+    return message
+
+def format_message(role, content, container, is_new_message=False, audio=None):
+    """Format message with Streamlit components
 
-def format_message(role, content, container, is_new_message=False):
-    """Format message with Streamlit components"""
+    audioにメッセージの音声状態を渡すと、合成・送信の結果をそこに記録する
+    """
     if role == "user":
         container.markdown(f"""
         <div class="message-container user-message-container">
@@ -412,19 +540,24 @@ def format_message(role, content, container, is_new_message=False):
     else:
         # TTSが有効で、新しいメッセージの場合のみ音声を先に生成・再生
         if st.session_state.tts_enabled and is_new_message:
-            audio_file = generate_speech(content)
-            if audio_file:
-                with open(audio_file, "rb") as f:
-                    audio_bytes = f.read()
+            # 返答と一緒に合成しておいた音声があればそれを使う
+            audio_bytes = audio.pop("prefetched", None) if audio is not None else None
+            audio_file = None
+            if audio_bytes is None:
+                audio_file = generate_speech(content)
+                if audio_file:
+                    with open(audio_file, "rb") as f:
+                        audio_bytes = f.read()
+            if audio_bytes:
+                if audio is not None:
+                    audio["status"] = "synthesized"
                 
-                # Base64エンコードしてHTMLに埋め込み
-                audio_b64 = base64.b64encode(audio_bytes).decode()
+                # メディアファイルとして登録し、URLで参照する
+                audio_url = register_media(audio_bytes)
                 
                 # 音声を先に再生
                 container.markdown(f"""
-                <audio autoplay style="display: none;">
-                    <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-                </audio>
+                {audio_html(audio_url)}
                 <script>
                     // 音声再生を確実にするためのJavaScript
                     document.addEventListener('DOMContentLoaded', function() {{
@@ -439,7 +572,15 @@ def format_message(role, content, container, is_new_message=False):
                 """, unsafe_allow_html=True)
                 
                 # 一時ファイルを削除
-                os.unlink(audio_file)
+                if audio_file:
+                    os.unlink(audio_file)
+                if audio is not None:
+                    audio["status"] = "delivered"
+        
+        # 読み上げなかった（TTSオフ・合成失敗）メッセージは、再実行しても読み上げない
+        if audio is not None and audio["status"] == "pending" and is_new_message:
+            audio["status"] = "skipped"
+            audio.pop("prefetched", None)
         
         # 音声再生後にメッセージを表示
         cols = container.columns([1, 15])
@@ -457,43 +598,125 @@ def format_message(role, content, container, is_new_message=False):
             </div>
             """, unsafe_allow_html=True)
 
+def display_messages(chat_area):
+    """チャット履歴を表示する
+
+    読み上げはメッセージごとに1回だけ。TTSの切り替えなどで再実行しても音声は作り直さない。
+    直近のメッセージだけを通常どおり表示し、古いものはトグルを開いたときだけ表示する
+    """
+    older, recent = split_transcript(st.session_state.messages)
+    display_older_messages(older, chat_area)
+    for msg in recent:
+        audio = msg.get('audio')
+        if audio and audio['status'] == 'delivered':
+            # 前回の実行でブラウザに送った音声は再生済みとして扱う
+            audio['status'] = 'played'
+        is_new_message = bool(audio) and audio['status'] == 'pending'
+        format_message(msg['role'], msg['content'], chat_area, is_new_message=is_new_message, audio=audio)
+
 def handle_submit():
-    """Handle message submission"""
+    """Handle message submission
+
+    返答は共有のイベントループで生成し、ここでは待たない（送ったメッセージはすぐに表示される）
+    """
     current_input = st.session_state["user_input_field"]
     
-    if current_input.strip():
-        user_message = {
-            "role": "user",
-            "content": current_input
-        }
-        st.session_state.messages.append(user_message)
+    if current_input.strip() and st.session_state.get('pending_turn') is None:
+        session_id = current_session_id()
+        if not scheduler.admit(session_id):
+            # 連投はモデルに送らず、入力もそのまま残す
+            st.toast("送るのが早すぎるばい。ちょっと待たんね")
+            return
+        st.session_state.messages.append(new_message("user", current_input))
         st.session_state.openai_messages.append({
             "role": "user",
             "content": current_input
         })
         
-        # スピナーを削除して画面が暗くならないようにする
-        ai_response = get_chat_response(st.session_state.openai_messages)
-        
-        if ai_response:
-            assistant_message = {
-                "role": "assistant",
-                "content": ai_response
-            }
-            st.session_state.messages.append(assistant_message)
-            st.session_state.openai_messages.append({
-                "role": "assistant",
-                "content": ai_response
-            })
+        tracker = st.session_state.quiz_tracker
+        # 答えが決まっている問題はアプリ側で判定し、モデルには反応だけを書かせる
+        verdict = tracker.judge(current_input)
+        future = get_async_worker().submit(
+            take_turn(
+                list(st.session_state.openai_messages),
+                tracker.instruction(verdict),
+                speak=st.session_state.tts_enabled,
+                session_id=session_id,
+                # 判定済みの反応や出題だけなら小さなモデル、モデルに判定させるなら大きなモデル
+                turn_type=classify_turn(tracker, verdict),
+            ),
+            owner=session_id,
+            # 返答ができたらすぐに画面を更新する
+            on_done=lambda _: request_rerun(session_id),
+        )
+        st.session_state.pending_turn = {
+            "future": future,
+            "verdict": verdict,
+            "game_state": st.session_state.game_state,
+        }
         
         st.session_state["user_input_field"] = ""
 
+def collect_pending_turn():
+    """返答ができていれば履歴に追加する。ゲームの状態が変わっていたら取り消す
+
+    まだ待っている場合はTrueを返す
+    """
+    turn = st.session_state.get('pending_turn')
+    if turn is None:
+        return False
+    future = turn["future"]
+    if turn["game_state"] != st.session_state.game_state:
+        future.cancel()
+    if not future.done():
+        return True
+    st.session_state.pending_turn = None
+    if future.cancelled():
+        return False
+    try:
+        ai_response, tagged_verdict, audio_bytes, route = future.result()
+    except (DeadlineExceeded, CircuitOpen, SchedulerRejected):
+        st.error("校長の返事が間に合わんやった。もう一回送ってみんね")
+        return False
+    except Exception as e:
+        st.error(f"エラーが発生しました: {str(e)}")
+        return False
+    if ai_response:
+        # 判定に合わせて問題を進める
+        st.session_state.quiz_tracker.record(turn["verdict"] or tagged_verdict)
+        message = new_message("assistant", ai_response)
+        # どのモデルがどれだけかかって返したかを残す
+        message["route"] = route
+        if audio_bytes:
+            message["audio"]["prefetched"] = audio_bytes
+        elif st.session_state.tts_enabled:
+            # 音声の合成が失敗・時間切れなら、ここで合成し直さずに文字だけ表示する
+            message["audio"]["status"] = "skipped"
+        st.session_state.messages.append(message)
+        st.session_state.openai_messages.append({
+            "role": "assistant",
+            "content": ai_response
+        })
+    return False
+
+@st.fragment(run_every=PENDING_TURN_POLL_SECONDS)
+def display_pending_turn():
+    """返答を待っている間の表示。終わったのに再実行の通知が届かなかった場合はここで拾う"""
+    turn = st.session_state.get('pending_turn')
+    if turn is None or turn["future"].done():
+        st.rerun()
+    position = scheduler.position(current_session_id())
+    if position:
+        st.caption(f"順番待ち（{position}番目）…")
+    else:
+        st.caption("校長が考えとる…")
+
 def display_title():
     """タイトル画面を表示"""
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/title.png", use_container_width=True)
+        display_image("src/images/title.png")
     
     # ゲームスタートボタン（中央揃え）
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -510,10 +733,13 @@ def display_opening():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/manager-room-door.png", use_container_width=True)
+        display_image("src/images/manager-room-door.png")
     
     st.markdown("<h2 style='text-align: center;'>暗証番号を入力せよ</h2>", unsafe_allow_html=True)
     
+    # 鍵が開いたときに鳴らすドアの音を先に読み込んでおく
+    preload_sound_effects("door-open")
+    
     # 暗証番号入力（中央揃え、4桁用の幅）
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
@@ -522,38 +748,12 @@ def display_opening():
         # 入力値が4桁になったら自動チェック
         if pin_code and len(pin_code) == 6:
             if pin_code == "442222":
-                # ドアが開く音を再生
-                try:
-                    with open("src/audio/door-open.mp3", "rb") as f:
-                        audio_bytes = f.read()
-                    
-                    # Base64エンコードしてHTMLに埋め込み
-                    audio_b64 = base64.b64encode(audio_bytes).decode()
-                    
-                    st.markdown(f"""
-                    <audio autoplay style="display: none;">
-                        <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-                    </audio>
-                    <script>
-                        // 音声再生を確実にするためのJavaScript
-                        document.addEventListener('DOMContentLoaded', function() {{
-                            const audio = document.querySelector('audio[autoplay]');
-                            if (audio) {{
-                                audio.play().catch(function(error) {{
-                                    console.log('音声再生に失敗しました:', error);
-                                }});
-                            }}
-                        }});
-                    </script>
-                    """, unsafe_allow_html=True)
-                except FileNotFoundError:
-                    st.warning("音声ファイルが見つかりません: src/audio/door-open.mp3")
-                
+                # ドアが開く音を再生し、鳴り終わったら次の画面へ（待っている間もスレッドは塞がない）
+                if not transition_scheduled():
+                    duration = play_sound_effect("door-open")
+                    schedule_transition('quiz', duration or DOOR_OPEN_SECONDS)
                 st.success("鍵が開いた・・")
-                # 音が再生されるまで少し待機
-                time.sleep(2)
-                st.session_state.game_state = 'quiz'
-                st.rerun()
+                run_scheduled_transition()
             else:
                 st.error("暗証番号が間違っているようだ")
     
@@ -565,7 +765,7 @@ def display_success():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/anger-kuromizu.png", use_container_width=True)
+        display_image("src/images/anger-kuromizu.png")
     
     st.markdown("""
     
@@ -601,35 +801,30 @@ def display_form():
     st.components.v1.iframe(form_url, height=600)
     
 
-def display_quiz():
-    st.markdown("<h1 style='text-align: center;'>黒水校長の試練</h1>", unsafe_allow_html=True)
-    
-    # メッセージがない場合のみタイトルと説明を表示
+@st.fragment
+def display_chat():
+    """チャット欄と入力欄。回答を送ったときはこのフラグメントだけを再実行する
+
+    返答ができたときは request_rerun でアプリ全体が再実行され、collect_pending_turn が履歴に追加する。
+    全問正解で画面を切り替えるときはアプリ全体を再実行する
+    """
+    # メッセージがない場合のみタイトルと説明を表示（回答を送ると、このフラグメントの再実行で消える）
     if not st.session_state.messages:
-        # より均等な配置のためのcolumns設定
-        col1, col2, col3 = st.columns([1, 2, 1])  # 比率を[1, 2, 1]に変更してより中央に寄せる
-        with col2:
-            st.image("src/images/principals-office.png", width=1200)
- 
-        st.markdown("""
-            <div style="background-color: #212121;">
-                <h2 class="title-container" style="font-size: 1.5rem; margin: 0; padding: 0;">
-                    <div class="subtitle">なんね、あんたら？元の附設にもどしたい？<br>そんならおいの質問に答えてみんね？<br>卒業生なら、簡単に答えられるやろう<br>準備はええかね？</div>
-                </h2>
-            </div>
-        """, unsafe_allow_html=True)
+        display_intro()
     
     # チャットメッセージの表示エリア
     chat_area = st.container()
     
-    # 過去のメッセージを表示（TTSなし）
-    for i, msg in enumerate(st.session_state.messages[:-1] if st.session_state.messages else []):
-        format_message(msg['role'], msg['content'], chat_area, is_new_message=False)
+    waiting = st.session_state.get('pending_turn') is not None
+    
+    # メッセージを表示（読み上げはまだ読み上げていないメッセージだけ）
+    display_messages(chat_area)
+    
+    if waiting:
+        display_pending_turn()
     
-    # 最新のメッセージのみTTS処理を行う
     if st.session_state.messages:
         latest_msg = st.session_state.messages[-1]
-        format_message(latest_msg['role'], latest_msg['content'], chat_area, is_new_message=True)
         
         # 最後のメッセージが成功メッセージかチェック
         if "全問正解" in latest_msg['content'] and not st.session_state.quiz_completed:
@@ -647,11 +842,146 @@ def display_quiz():
         "あなたの回答を入力してください",
         key="user_input_field",
         on_change=handle_submit,
+        disabled=waiting,
         label_visibility="collapsed"
     )
     
     st.markdown('</div></div>', unsafe_allow_html=True)
 
+def display_quiz():
+    st.markdown("<h1 style='text-align: center;'>黒水校長の試練</h1>", unsafe_allow_html=True)
+    
+    display_chat()
+
+def display_intro():
+    """最初の回答までだけ表示するタイトルと説明（チャット欄のフラグメントの中で描く）"""
+    # より均等な配置のためのcolumns設定
+    col1, col2, col3 = st.columns([1, 2, 1])  # 比率を[1, 2, 1]に変更してより中央に寄せる
+    with col2:
+        display_image("src/images/principals-office.png", width=1200)
+ 
+    st.markdown("""
+        <div style="background-color: #212121;">
+            <h2 class="title-container" style="font-size: 1.5rem; margin: 0; padding: 0;">
+                <div class="subtitle">なんね、あんたら？元の附設にもどしたい？<br>そんならおいの質問に答えてみんね？<br>卒業生なら、簡単に答えられるやろう<br>準備はええかね？</div>
+            </h2>
+        </div>
+    """, unsafe_allow_html=True)
+
+def synthesize_commentary(text):
+    """フロア全員に配る校長の反応を読み上げ音声にする（合成済みなら使い回す）"""
+    spoken = apply_readings(text)
+
+    def synthesize():
+        # 持ち時間切れやブレーカーが開いているときは例外になり、反応は文字だけで配られる
+        response = call_with_retries(
+            lambda timeout: tts_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+                model="tts-1", voice="ash", input=spoken, speed=1.0
+            ),
+            Deadline(TTS_BUDGET_SECONDS),
+            breakers.get("openai-tts"),
+        )
+        return response.content
+
+    return get_tts_cache().get_or_create(make_cache_key("openai", "ash", "tts-1", 1.0, spoken), synthesize)
+
+def display_floor_commentary(floor):
+    """集計に対する校長の反応を表示し、読み上げ音声を流す（全員の画面で同じもの）"""
+    commentary = floor.commentary_for()
+    if not commentary:
+        return
+    cols = st.columns([1, 15])
+    with cols[0]:
+        if st.session_state.avatar_image:
+            st.image(st.session_state.avatar_image, width=80)
+    with cols[1]:
+        st.markdown(f"""
+        <div class="message-container assistant-message-container">
+            <div class="assistant-message">
+                <p class="message-text">{commentary["text"]}</p>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
+    if st.session_state.tts_enabled and commentary["audio"]:
+        # 画面の更新のたびに同じURLになるので、再生が最初からやり直されることはない
+        audio_url = register_media(commentary["audio"], key=f"floor-commentary-{floor.question_index}")
+        st.markdown(audio_html(audio_url), unsafe_allow_html=True)
+
+def format_tally(tally):
+    """問題ごとの集計を1行で表示する文字列"""
+    rate = tally["correct"] / tally["total"] if tally["total"] else 0
+    return f"正解 {tally['correct']}人 / 回答 {tally['total']}人（正解率 {rate:.0%}）"
+
+@st.fragment(run_every=FLOOR_REFRESH_SECONDS)
+def display_floor_question():
+    """フロアの参加者用：今の問題に回答し、締め切り後に判定を見る"""
+    floor = get_floor(SYSTEM_PROMPT)
+    question = floor.current_question
+    if question is None:
+        st.markdown("<h3 style='text-align: center;'>全部の問題が終わったばい</h3>", unsafe_allow_html=True)
+        return
+
+    st.markdown(f"### 第{question.number}問\n{question.text}")
+    participant_id = st.session_state.participant_id
+    if floor.is_open:
+        if participant_id in floor.answers:
+            st.info(f"回答「{floor.answers[participant_id]}」を受け付けた。締め切りを待たんね")
+            return
+        with st.form(key=f"floor_answer_{question.number}", clear_on_submit=True):
+            answer = st.text_input("あなたの回答", label_visibility="collapsed")
+            if st.form_submit_button("回答する") and floor.submit(participant_id, answer):
+                st.rerun(scope="fragment")
+        return
+
+    verdict = floor.result_for(participant_id)
+    if verdict == VERDICT_CORRECT:
+        st.success("正解ばい")
+    elif verdict is not None:
+        st.error("不正解ばい")
+    tally = floor.tallies.get(floor.question_index)
+    if tally:
+        st.markdown(format_tally(tally))
+    display_floor_commentary(floor)
+
+@st.fragment(run_every=FLOOR_REFRESH_SECONDS)
+def display_floor_host():
+    """フロアの司会用：回答を締め切って一括判定し、次の問題に進める"""
+    floor = get_floor(SYSTEM_PROMPT)
+    question = floor.current_question
+    if question is not None:
+        st.markdown(f"## 第{question.number}問\n{question.text}")
+        st.metric("回答数", len(floor.answers))
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("締め切って判定する", disabled=not floor.is_open, key="floor_close"):
+                floor.close(client)
+                # 判定結果はすぐに全員に届き、校長の反応は1回だけ生成して後から配る
+                try:
+                    floor.publish_commentary(client, synthesize_commentary)
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"エラーが発生しました: {str(e)}")
+        with col2:
+            if st.button("次の問題へ", disabled=floor.is_open, key="floor_next"):
+                floor.next_question()
+                st.rerun(scope="fragment")
+    else:
+        st.markdown("## 全問終了")
+    display_floor_commentary(floor)
+
+    if floor.tallies:
+        st.markdown("### 問題ごとの集計")
+        for index, tally in sorted(floor.tallies.items()):
+            st.markdown(f"- 第{index + 1}問：{format_tally(tally)}")
+
+def display_floor():
+    """フロアモード（URLに ?floor=1、司会は ?floor=host を付けて開く）"""
+    st.markdown("<h1 style='text-align: center;'>黒水校長の試練</h1>", unsafe_allow_html=True)
+    if st.query_params.get("floor") == "host":
+        display_floor_host()
+    else:
+        display_floor_question()
+
 def main():
     st.set_page_config(
         page_title="地獄の附設高校 - 1st Stage",
@@ -673,6 +1003,9 @@ def main():
     init_session_state()
     st.markdown(load_css(), unsafe_allow_html=True)
     
+    # 返答ができていれば履歴に追加する（画面が変わっていれば取り消す）
+    collect_pending_turn()
+    
     # TTS設定のトグルボタン（クイズ画面でのみ表示）
     if st.session_state.game_state == 'quiz':
         with st.sidebar:
@@ -685,11 +1018,15 @@ def main():
     # メインコンテンツエリア
     st.markdown('<div class="main-content">', unsafe_allow_html=True)
     
-    # ゲーム状態に応じて画面を表示
-    if st.session_state.game_state == 'title':
+    # ゲーム状態に応じて画面を表示（フロアの司会画面はタイトルと暗証番号を飛ばす）
+    if st.query_params.get("floor") == "host":
+        display_floor()
+    elif st.session_state.game_state == 'title':
         display_title()
     elif st.session_state.game_state == 'opening':
         display_opening()
+    elif st.session_state.game_state == 'quiz' and st.query_params.get("floor"):
+        display_floor()
     elif st.session_state.game_state == 'quiz':
         display_quiz()
     elif st.session_state.game_state == 'success':
@@ -1,148 +1,200 @@
 import streamlit as st
-from openai import OpenAI
 from datetime import datetime
 from pathlib import Path
-import base64
 import io
 import tempfile
 import os
-
-# OpenAI APIキーをsecretsから取得
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+import uuid
+import time
+
+from context_window import count_message_tokens
+from llm_scheduler import PRIORITY_STAGE, SchedulerRejected
+from media import audio_html, display_image, register_media
+from model_router import TURN_OPEN, classify_turn
+from quiz_bank import QuizTracker, parse_prompt, parse_verdict
+from resources import (
+    get_avatar_thumbnail,
+    get_async_openai_client,
+    get_async_worker,
+    get_circuit_breakers,
+    get_llm_scheduler,
+    get_model_router,
+    get_openai_client,
+    get_openai_tts_client,
+    get_tts_cache,
+)
+from resilience import CircuitOpen, Deadline, DeadlineExceeded, call_with_retries, call_with_retries_async
+from rooms import current_session_id, request_rerun
+from transcript import display_older_messages, split_transcript
+from tts_cache import make_cache_key
+
+# OpenAI APIキーをsecretsから取得（クライアントはプロセス内で共有）
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+tts_client = get_openai_tts_client(st.secrets["OPENAI_API_KEY"])
+# 返答の生成はスクリプトのスレッドではなく共有のイベントループで行う
+async_client = get_async_openai_client(st.secrets["OPENAI_API_KEY"])
+# イベントループからも使うので、スクリプトのスレッドで取得しておく
+tts_cache = get_tts_cache()
+# 舞台上のゲームなので、フロアの参加者の返答より先に送る
+scheduler = get_llm_scheduler()
+breakers = get_circuit_breakers()
+# 判定済みの反応や出題だけのターンは小さなモデルに送る
+model_router = get_model_router()
+PRIORITY = PRIORITY_STAGE
 
 # 画像のパスを設定
 AVATAR_PATH = Path("src/images/opening.png")
 
+# 返答を待っている間、終わったかどうかを確かめる間隔（秒）。通常は終わった時点で再実行される
+PENDING_TURN_POLL_SECONDS = 1
+
+# 返答と音声合成の持ち時間（秒）。過ぎたら返答はエラー、音声は文字だけの表示にする
+CHAT_TURN_BUDGET_SECONDS = 20
+TTS_BUDGET_SECONDS = 8
+
+# 黒水校長のキャラクター設定と問題リスト（問題は quiz_bank で1問ずつに分けて使う）
+SYSTEM_PROMPT = """
+GPTは意地悪な黒水校長になりきってユーザーに問題を出します
+福岡の久留米弁もしくは筑後弁で、挑発的な態度でしゃべってください。
+優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
+参加者に対しては「お前ら」と喋ります
+
+### 筑後弁の特徴
+
+【語尾】
+- 「〜ばい」（〜だよ、〜だぞ）
+- 「〜たい」（〜だよ）
+- 「〜ちゃる」（〜てしまう、〜てやる）
+- 「〜やけん」（〜だから）
+- 「〜とる」（〜ている）
+- 「〜やろ」（〜だろう）
+
+【特有の語彙】
+- 「なんね」（何だね）
+- 「ええ」（いい）
+- 「よか」（いい）
+- 「おい」（俺）
+- 「あんた」（あなた）
+- 「あんたら」（あなたたち）
+- 「こげん」（こんな）
+- 「そげん」（そんな）
+- 「あげん」（あんな）
+- 「どげん」（どんな）
+- 「いっちょん」（全然）
+- 「ばってん」（だけど）
+- 「たいぎ」（大変）
+- 「しゃあない」（仕方ない）
+
+【音韻変化】
+- 「し」→「ひ」（例：しゃべる→ひゃべる）
+- 「じ」→「び」（例：時間→びかん）
+
+【例文】
+- 「なんね、あんたら？元の附設にもどしたい？」
+- 「そんならおいの質問に答えてみんね？」
+- 「卒業生なら、簡単に答えられるやろう」
+- 「準備はええかね？」
+- 「こげんもんじゃなかっちゃな」
+- 「よかたい、次は体育館で決着ばつけちゃるばい！」
+
+### 質問
+下記の質問を順番に質問してください。参加者は４チーム（えいちゃんチーム、まことチーム、あいじチーム、ほりチーム）が交代で答えます
+次の問題にいったら次の順番のチームに聞きます。
+正解するまで次の問題にいきません。
+間違ったら難しいヒントをたまに出します。しかし正解自体は教えません。
+
+質問１：附設高校初代校長の名前をフルネームで
+答え：板垣政参（いたがきまさみつ）
+ヒント：最初の文字は「い」です（これしかださない）
+
+質問２：附設の近くにあった美味しいお好み焼きのお店は何や？
+答え：弁天
+
+質問３：福岡市の交通系ICカードとかけて、ウサイン・ボルトが尊敬される理由と解く、その心は？
+答え：はやかけん
+
+質問４：町田校長は第何代校長や？
+答え：第11代校長
+
+質問５：福岡で一番いいホテルはどこや？
+答え：ソラリア西鉄ホテル（会場のホテル）
+
+質問６：附設高校が現在の場所に移転したのはいつや？
+答え：1968年
+
+質問７：西鉄（にしてつ）久留米から附設高校前に停まるバスの行き先番号は何番や？
+答え：２番と７番（両方答えないとダメ）
+ヒント：お前らはどこにおるとや？（参加者が３回間違ったら出す）
+
+質問８：2023年に瑞宝中綬章を受けた元校長は誰や？
+答え：吉川敦
+
+質問９：附設高校の校章の花は何や？
+答え：芙蓉
+これはヒントなしで 
+
+質問10：イブニング附設で提供されていた食事は？
+答え：豚汁
+これはヒントなしで
+
+
+
+### 正誤の判定方法
+厳密に答えとあっていなくても正解とします
+
+### 最後の会話
+参加者が全問とも正解したら、「ぬぬぬ、、、まさか...まさか俺が...敗れるとは...！」<br><br>   
+というコメントをしてください。
+
+### 口調
+久留米弁で挑発的な態度でしゃべってください。
+参加者が正解しても褒めません。
+優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
+"""
+
 def init_session_state():
     """Initialize session state variables"""
     if 'messages' not in st.session_state:
         st.session_state.messages = []
     if 'openai_messages' not in st.session_state:
+        # 問題はアプリ側で1問ずつ指示するので、システムプロンプトはキャラクター設定だけ
+        bank = parse_prompt(SYSTEM_PROMPT)
         st.session_state.openai_messages = [
-            {"role": "system", "content": """
-            GPTは意地悪な黒水校長になりきってユーザーに問題を出します
-            福岡の久留米弁もしくは筑後弁で、挑発的な態度でしゃべってください。
-            優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
-            参加者に対しては「お前ら」と喋ります
-
-            ### 筑後弁の特徴
-            
-            【語尾】
-            - 「〜ばい」（〜だよ、〜だぞ）
-            - 「〜たい」（〜だよ）
-            - 「〜ちゃる」（〜てしまう、〜てやる）
-            - 「〜やけん」（〜だから）
-            - 「〜とる」（〜ている）
-            - 「〜やろ」（〜だろう）
-            
-            【特有の語彙】
-            - 「なんね」（何だね）
-            - 「ええ」（いい）
-            - 「よか」（いい）
-            - 「おい」（俺）
-            - 「あんた」（あなた）
-            - 「あんたら」（あなたたち）
-            - 「こげん」（こんな）
-            - 「そげん」（そんな）
-            - 「あげん」（あんな）
-            - 「どげん」（どんな）
-            - 「いっちょん」（全然）
-            - 「ばってん」（だけど）
-            - 「たいぎ」（大変）
-            - 「しゃあない」（仕方ない）
-            
-            【音韻変化】
-            - 「し」→「ひ」（例：しゃべる→ひゃべる）
-            - 「じ」→「び」（例：時間→びかん）
-            
-            【例文】
-            - 「なんね、あんたら？元の附設にもどしたい？」
-            - 「そんならおいの質問に答えてみんね？」
-            - 「卒業生なら、簡単に答えられるやろう」
-            - 「準備はええかね？」
-            - 「こげんもんじゃなかっちゃな」
-            - 「よかたい、次は体育館で決着ばつけちゃるばい！」
-
-            ### 質問
-            下記の質問を順番に質問してください。参加者は４チーム（えいちゃんチーム、まことチーム、あいじチーム、ほりチーム）が交代で答えます
-            次の問題にいったら次の順番のチームに聞きます。
-            正解するまで次の問題にいきません。
-            間違ったら難しいヒントをたまに出します。しかし正解自体は教えません。
-
-            質問１：附設高校初代校長の名前をフルネームで
-            答え：板垣政参（いたがきまさみつ）
-            ヒント：最初の文字は「い」です（これしかださない）
-            
-            質問２：附設の近くにあった美味しいお好み焼きのお店は何や？
-            答え：弁天
-        
-            質問３：福岡市の交通系ICカードとかけて、ウサイン・ボルトが尊敬される理由と解く、その心は？
-            答え：はやかけん
-            
-            質問４：町田校長は第何代校長や？
-            答え：第11代校長
-             
-            質問５：福岡で一番いいホテルはどこや？
-            答え：ソラリア西鉄ホテル（会場のホテル）
-             
-            質問６：附設高校が現在の場所に移転したのはいつや？
-            答え：1968年
-             
-            質問７：西鉄（にしてつ）久留米から附設高校前に停まるバスの行き先番号は何番や？
-            答え：２番と７番（両方答えないとダメ）
-            ヒント：お前らはどこにおるとや？（参加者が３回間違ったら出す）
-             
-            質問８：2023年に瑞宝中綬章を受けた元校長は誰や？
-            答え：吉川敦
-            
-            質問９：附設高校の校章の花は何や？
-            答え：芙蓉
-            これはヒントなしで 
-            
-            質問10：イブニング附設で提供されていた食事は？
-            答え：豚汁
-            これはヒントなしで
-            
-            
-
-            ### 正誤の判定方法
-            厳密に答えとあっていなくても正解とします
-
-            ### 最後の会話
-            参加者が全問とも正解したら、「ぬぬぬ、、、まさか...まさか俺が...敗れるとは...！」<br><br>   
-            というコメントをしてください。
-
-            ### 口調
-            久留米弁で挑発的な態度でしゃべってください。
-            参加者が正解しても褒めません。
-            優しい言葉や丁寧な言葉は使わないでください。絶対に絶対に丁寧には喋らないでください
-            """
-            }
+            {"role": "system", "content": bank.system_prompt()}
         ]
+        st.session_state.quiz_tracker = QuizTracker(bank)
     if 'avatar_image' not in st.session_state:
-        if AVATAR_PATH.exists():
-            with open(AVATAR_PATH, "rb") as f:
-                avatar_data = f.read()
-            st.session_state.avatar_image = avatar_data
-        else:
-            st.session_state.avatar_image = None
+        # 縮小画像はプロセスで1つだけ持ち、各セッションはそれを参照する
+        st.session_state.avatar_image = get_avatar_thumbnail(str(AVATAR_PATH))
     if 'tts_enabled' not in st.session_state:
         st.session_state.tts_enabled = True
 
 def generate_speech(text):
     """Generate speech from text using OpenAI TTS"""
-    try:
-        response = client.audio.speech.create(
-            model="tts-1",
-            voice="ash",  # 男性の声で挑発的な感じ
-            input=text,
-            speed=1.0  # 少しゆっくりめで威厳のある感じ
+    def synthesize():
+        response = call_with_retries(
+            lambda timeout: tts_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+                model="tts-1",
+                voice="ash",  # 男性の声で挑発的な感じ
+                input=text,
+                speed=1.0  # 少しゆっくりめで威厳のある感じ
+            ),
+            Deadline(TTS_BUDGET_SECONDS),
+            breakers.get("openai-tts"),
         )
+        return response.content
+
+    try:
+        # 同じ台詞は合成済みの音声を使い回す
+        audio_bytes = get_tts_cache().get_or_create(make_cache_key("openai", "ash", "tts-1", 1.0, text), synthesize)
         
         # 音声データを一時ファイルに保存
         with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-            tmp_file.write(response.content)
+            tmp_file.write(audio_bytes)
             return tmp_file.name
+    except (DeadlineExceeded, CircuitOpen):
+        # 音声が間に合わないときは文字だけ表示する
+        return None
     except Exception as e:
         st.error(f"音声生成エラー: {str(e)}")
         return None
@@ -407,22 +459,86 @@ def load_css():
     </style>
     """
 
-def get_chat_response(messages):
-    """Get response from OpenAI API"""
+async def get_chat_response(messages, instruction=None, session_id=None, turn_type=TURN_OPEN):
+    """Get response from OpenAI API（イベントループ上で実行する）
+
+    instructionには今回のターンだけの指示（今の問題と進行状況）を渡す。
+    turn_typeで小さなモデルに送るか大きなモデルに送るかが決まる。
+    送る前にプロセス全体の順番待ちで順番を取る。(返答, 使ったモデルと応答時間) を返す
+    """
+    if instruction:
+        # 今回のターンの指示は最後のユーザーメッセージの直前に置く
+        messages = messages[:-1] + [{"role": "system", "content": instruction}] + messages[-1:]
+    deadline = Deadline(CHAT_TURN_BUDGET_SECONDS)
+    _, model = model_router.choose(turn_type, "gpt-4o", ["gpt-4o"])
+    # 上限はモデルごとなので、送るモデルの順番を取る
+    await scheduler.acquire_async(
+        session_id, PRIORITY, count_message_tokens(messages) + 1000, model, timeout=deadline.remaining()
+    )
+    started = time.monotonic()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
+        response = await call_with_retries_async(
+            lambda timeout: async_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000
+            ),
+            deadline,
+            breakers.get("openai"),
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"エラーが発生しました: {str(e)}")
-        return None
+    except Exception:
+        model_router.stats.record(model, ok=False)
+        raise
+    latency = time.monotonic() - started
+    model_router.stats.record(model, latency)
+    return response.choices[0].message.content, {"model": model, "total_latency": round(latency, 2)}
+
+async def take_turn(messages, instruction=None, speak=False, session_id=None, turn_type=TURN_OPEN):
+    """返答を取得し、読み上げる場合は音声も続けて合成する
 
-def format_message(role, content, container, is_new_message=False):
-    """Format message with Streamlit components"""
+    (返答, 判定タグ, 音声のバイト列, 使ったモデルと応答時間) を返す。音声が作れなくても返答は返す
+    """
+    ai_response, route = await get_chat_response(messages, instruction, session_id, turn_type)
+    tagged_verdict, ai_response = parse_verdict(ai_response)
+    audio_bytes = None
+    if speak and ai_response:
+        # 同じ台詞は合成済みの音声を使い回す（get_or_create はループを止めるので get と put に分ける）
+        cache_key = make_cache_key("openai", "ash", "tts-1", 1.0, ai_response)
+        try:
+            audio_bytes = tts_cache.get(cache_key)
+            if audio_bytes is None:
+                response = await call_with_retries_async(
+                    lambda timeout: async_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+                        model="tts-1", voice="ash", input=ai_response, speed=1.0
+                    ),
+                    Deadline(TTS_BUDGET_SECONDS),
+                    breakers.get("openai-tts"),
+                )
+                audio_bytes = response.content
+                tts_cache.put(cache_key, audio_bytes)
+        except Exception:
+            # 音声が間に合わないときは文字だけ表示する
+            audio_bytes = None
+    return ai_response, tagged_verdict, audio_bytes, route
+
+def new_message(role, content):
+    """表示用のメッセージを作成
+
+    再実行をまたいで同じメッセージを見分けるためのIDと、読み上げ音声の状態を持たせる。
+    音声の状態は pending（未合成）→ synthesized（合成済み）→ delivered（ブラウザに送信済み）
+    → played（再生済み）と進み、TTSがオフのときに表示したものは skipped になる。
+    """
+    message = {"id": uuid.uuid4().hex, "role": role, "content": content}
+    if role == "assistant":
+        message["audio"] = {"status": "pending"}
+    return message
+
+def format_message(role, content, container, is_new_message=False, audio=None):
+    """Format message with Streamlit components
+
+    audioにメッセージの音声状態を渡すと、合成・送信の結果をそこに記録する
+    """
     if role == "user":
         container.markdown(f"""
         <div class="message-container user-message-container">
@@ -434,19 +550,24 @@ def format_message(role, content, container, is_new_message=False):
     else:
         # TTSが有効で、新しいメッセージの場合のみ音声を先に生成・再生
         if st.session_state.tts_enabled and is_new_message:
-            audio_file = generate_speech(content)
-            if audio_file:
-                with open(audio_file, "rb") as f:
-                    audio_bytes = f.read()
+            # 返答と一緒に合成しておいた音声があればそれを使う
+            audio_bytes = audio.pop("prefetched", None) if audio is not None else None
+            audio_file = None
+            if audio_bytes is None:
+                audio_file = generate_speech(content)
+                if audio_file:
+                    with open(audio_file, "rb") as f:
+                        audio_bytes = f.read()
+            if audio_bytes:
+                if audio is not None:
+                    audio["status"] = "synthesized"
                 
-                # Base64エンコードしてHTMLに埋め込み
-                audio_b64 = base64.b64encode(audio_bytes).decode()
+                # メディアファイルとして登録し、URLで参照する
+                audio_url = register_media(audio_bytes)
                 
                 # 音声を先に再生
                 container.markdown(f"""
-                <audio autoplay style="display: none;">
-                    <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-                </audio>
+                {audio_html(audio_url)}
                 <script>
                     // 音声再生を確実にするためのJavaScript
                     document.addEventListener('DOMContentLoaded', function() {{
@@ -461,7 +582,15 @@ def format_message(role, content, container, is_new_message=False):
                 """, unsafe_allow_html=True)
                 
                 # 一時ファイルを削除
-                os.unlink(audio_file)
+                if audio_file:
+                    os.unlink(audio_file)
+                if audio is not None:
+                    audio["status"] = "delivered"
+        
+        # 読み上げなかった（TTSオフ・合成失敗）メッセージは、再実行しても読み上げない
+        if audio is not None and audio["status"] == "pending" and is_new_message:
+            audio["status"] = "skipped"
+            audio.pop("prefetched", None)
         
         # 音声再生後にメッセージを表示
         cols = container.columns([1, 15])
@@ -479,37 +608,163 @@ def format_message(role, content, container, is_new_message=False):
             </div>
             """, unsafe_allow_html=True)
 
+def display_messages(chat_area):
+    """チャット履歴を表示する
+
+    読み上げはメッセージごとに1回だけ。TTSの切り替えなどで再実行しても音声は作り直さない。
+    直近のメッセージだけを通常どおり表示し、古いものはトグルを開いたときだけ表示する
+    """
+    older, recent = split_transcript(st.session_state.messages)
+    display_older_messages(older, chat_area)
+    for msg in recent:
+        audio = msg.get('audio')
+        if audio and audio['status'] == 'delivered':
+            # 前回の実行でブラウザに送った音声は再生済みとして扱う
+            audio['status'] = 'played'
+        is_new_message = bool(audio) and audio['status'] == 'pending'
+        format_message(msg['role'], msg['content'], chat_area, is_new_message=is_new_message, audio=audio)
+
 def handle_submit():
-    """Handle message submission"""
+    """Handle message submission
+
+    返答は共有のイベントループで生成し、ここでは待たない（送ったメッセージはすぐに表示される）
+    """
     current_input = st.session_state["user_input_field"]
     
-    if current_input.strip():
-        user_message = {
-            "role": "user",
-            "content": current_input
-        }
-        st.session_state.messages.append(user_message)
+    if current_input.strip() and st.session_state.get('pending_turn') is None:
+        st.session_state.messages.append(new_message("user", current_input))
         st.session_state.openai_messages.append({
             "role": "user",
             "content": current_input
         })
         
-        # スピナーを削除して画面が暗くならないようにする
-        ai_response = get_chat_response(st.session_state.openai_messages)
-        
-        if ai_response:
-            assistant_message = {
-                "role": "assistant",
-                "content": ai_response
-            }
-            st.session_state.messages.append(assistant_message)
-            st.session_state.openai_messages.append({
-                "role": "assistant",
-                "content": ai_response
-            })
+        tracker = st.session_state.quiz_tracker
+        # 答えが決まっている問題はアプリ側で判定し、モデルには反応だけを書かせる
+        verdict = tracker.judge(current_input)
+        session_id = current_session_id()
+        future = get_async_worker().submit(
+            take_turn(
+                list(st.session_state.openai_messages),
+                tracker.instruction(verdict),
+                speak=st.session_state.tts_enabled,
+                session_id=session_id,
+                # 判定済みの反応や出題だけなら小さなモデル、モデルに判定させるなら大きなモデル
+                turn_type=classify_turn(tracker, verdict),
+            ),
+            owner=session_id,
+            # 返答ができたらすぐに画面を更新する
+            on_done=lambda _: request_rerun(session_id),
+        )
+        st.session_state.pending_turn = {"future": future, "verdict": verdict}
         
         st.session_state["user_input_field"] = ""
 
+def collect_pending_turn():
+    """返答ができていれば履歴に追加する
+
+    まだ待っている場合はTrueを返す
+    """
+    turn = st.session_state.get('pending_turn')
+    if turn is None:
+        return False
+    future = turn["future"]
+    if not future.done():
+        return True
+    st.session_state.pending_turn = None
+    if future.cancelled():
+        return False
+    try:
+        ai_response, tagged_verdict, audio_bytes, route = future.result()
+    except (DeadlineExceeded, CircuitOpen, SchedulerRejected):
+        st.error("校長の返事が間に合わんやった。もう一回送ってみんね")
+        return False
+    except Exception as e:
+        st.error(f"エラーが発生しました: {str(e)}")
+        return False
+    if ai_response:
+        # 判定に合わせて問題を進める
+        st.session_state.quiz_tracker.record(turn["verdict"] or tagged_verdict)
+        message = new_message("assistant", ai_response)
+        # どのモデルがどれだけかかって返したかを残す
+        message["route"] = route
+        if audio_bytes:
+            message["audio"]["prefetched"] = audio_bytes
+        elif st.session_state.tts_enabled:
+            # 音声の合成が失敗・時間切れなら、ここで合成し直さずに文字だけ表示する
+            message["audio"]["status"] = "skipped"
+        st.session_state.messages.append(message)
+        st.session_state.openai_messages.append({
+            "role": "assistant",
+            "content": ai_response
+        })
+    return False
+
+def display_intro():
+    """最初の回答までだけ表示するタイトルと説明（チャット欄のフラグメントの中で描く）"""
+    # より均等な配置のためのcolumns設定
+    col1, col2, col3 = st.columns([2, 1, 2])  # 比率を[1, 2, 1]に変更してより中央に寄せる
+    with col2:
+        display_image("src/images/kurouzu-gate.jpg", width=400)
+ 
+    st.markdown("""
+        <div style="background-color: #212121;">
+            <div class="title-container">
+                <div class="main-title">今度はさっきのようにはいかんぞ！!<br>準備はいいか！</div>
+            </div>
+        </div>
+    """, unsafe_allow_html=True)
+
+@st.fragment
+def display_chat():
+    """チャット欄と入力欄。回答を送ったときはこのフラグメントだけを再実行する
+
+    返答ができたときは request_rerun でアプリ全体が再実行され、collect_pending_turn が履歴に追加する
+    """
+    waiting = st.session_state.get('pending_turn') is not None
+    
+    # メッセージがない場合のみタイトルと説明を表示（回答を送ると、このフラグメントの再実行で消える）
+    if not st.session_state.messages:
+        display_intro()
+    
+    # チャットメッセージの表示エリア
+    chat_area = st.container()
+    
+    # メッセージを表示（読み上げはまだ読み上げていないメッセージだけ）
+    display_messages(chat_area)
+    
+    if waiting:
+        display_pending_turn()
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+    # 入力フィールド（固定位置）
+    st.markdown("""
+        <div class="input-container">
+            <div style="max-width: 1000px; margin: 0 auto;">
+    """, unsafe_allow_html=True)
+    
+    st.text_input(
+        "メッセージを入力してください",
+        key="user_input_field",
+        on_change=handle_submit,
+        disabled=waiting,
+        label_visibility="collapsed"
+    )
+    
+    st.markdown('</div></div>', unsafe_allow_html=True)
+
+@st.fragment(run_every=PENDING_TURN_POLL_SECONDS)
+def display_pending_turn():
+    """返答を待っている間の表示。終わったのに再実行の通知が届かなかった場合はここで拾う"""
+    turn = st.session_state.get('pending_turn')
+    if turn is None or turn["future"].done():
+        st.rerun()
+    position = scheduler.position(current_session_id())
+    if position:
+        st.caption(f"順番待ち（{position}番目）…")
+    else:
+        st.caption("校長が考えとる…")
+
 def main():
     st.set_page_config(
         page_title="2nd stage",
@@ -531,6 +786,9 @@ def main():
     init_session_state()
     st.markdown(load_css(), unsafe_allow_html=True)
     
+    # 返答ができていれば履歴に追加する
+    waiting = collect_pending_turn()
+    
     # TTS設定のトグルボタン
     with st.sidebar:
         st.markdown("### 音声設定")
@@ -542,49 +800,7 @@ def main():
     # メインコンテンツエリア
     st.markdown('<div class="main-content">', unsafe_allow_html=True)
     
-    # メッセージがない場合のみタイトルと説明を表示
-    if not st.session_state.messages:
-            # より均等な配置のためのcolumns設定
-        col1, col2, col3 = st.columns([2, 1, 2])  # 比率を[1, 2, 1]に変更してより中央に寄せる
-        with col2:
-            st.image("src/images/kurouzu-gate.jpg", width=400)
- 
-        st.markdown("""
-            <div style="background-color: #212121;">
-                <div class="title-container">
-                    <div class="main-title">今度はさっきのようにはいかんぞ！!<br>準備はいいか！</div>
-                </div>
-            </div>
-        """, unsafe_allow_html=True)
-    
-    # チャットメッセージの表示エリア
-    chat_area = st.container()
-    
-    # 過去のメッセージを表示（TTSなし）
-    for i, msg in enumerate(st.session_state.messages[:-1] if st.session_state.messages else []):
-        format_message(msg['role'], msg['content'], chat_area, is_new_message=False)
-    
-    # 最新のメッセージのみTTS処理を行う
-    if st.session_state.messages:
-        latest_msg = st.session_state.messages[-1]
-        format_message(latest_msg['role'], latest_msg['content'], chat_area, is_new_message=True)
-    
-    st.markdown('</div>', unsafe_allow_html=True)
-    
-    # 入力フィールド（固定位置）
-    st.markdown("""
-        <div class="input-container">
-            <div style="max-width: 1000px; margin: 0 auto;">
-    """, unsafe_allow_html=True)
-    
-    st.text_input(
-        "メッセージを入力してください",
-        key="user_input_field",
-        on_change=handle_submit,
-        label_visibility="collapsed"
-    )
-    
-    st.markdown('</div></div>', unsafe_allow_html=True)
+    display_chat()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
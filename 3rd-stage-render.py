@@ -1,10 +1,13 @@
 import streamlit as st
-from openai import OpenAI
 from pathlib import Path
 import base64
 import os
 import time
 
+from media import display_image
+from resources import get_avatar_thumbnail, get_openai_client
+from transcript import display_older_messages, split_transcript
+
 # OpenAI APIキーを環境変数から取得（Render.com用）
 def get_openai_api_key():
     api_key = os.getenv("OPENAI_API_KEY")
@@ -13,7 +16,8 @@ def get_openai_api_key():
         st.stop()
     return api_key
 
-client = OpenAI(api_key=get_openai_api_key())
+# OpenAIクライアントの取得（プロセス内で共有されるので再実行のたびに作り直さない）
+client = get_openai_client(get_openai_api_key())
 
 # 画像のパスを設定
 AVATAR_PATH = Path("src/images/opening.png")
@@ -140,12 +144,8 @@ def init_session_state():
             }
         ]
     if 'avatar_image' not in st.session_state:
-        if AVATAR_PATH.exists():
-            with open(AVATAR_PATH, "rb") as f:
-                avatar_data = f.read()
-            st.session_state.avatar_image = avatar_data
-        else:
-            st.session_state.avatar_image = None
+        # 縮小画像はプロセスで1つだけ持ち、各セッションはそれを参照する
+        st.session_state.avatar_image = get_avatar_thumbnail(str(AVATAR_PATH))
     if 'quiz_completed' not in st.session_state:
         st.session_state.quiz_completed = False
 
@@ -402,7 +402,7 @@ def display_title():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/title.png", use_container_width=True)
+        display_image("src/images/title.png")
     
     # ゲームスタートボタン（中央揃え）
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -423,7 +423,7 @@ def display_opening():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/manager-room-door.png", use_container_width=True)
+        display_image("src/images/manager-room-door.png")
     
     # 次へボタン（中央揃え）
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -441,7 +441,7 @@ def display_success():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/anger-kuromizu.png", use_container_width=True)
+        display_image("src/images/anger-kuromizu.png")
     
     st.markdown("""
     
@@ -493,7 +493,7 @@ def display_quiz_intro():
     # より均等な配置のためのcolumns設定
     col1, col2, col3 = st.columns([1, 2, 1])  # 比率を[1, 2, 1]に変更してより中央に寄せる
     with col2:
-        st.image("src/images/principals-office.png", width=1200)
+        display_image("src/images/principals-office.png", width=1200)
  
     st.markdown("""
         <div style="background-color: #212121;">
@@ -521,15 +521,24 @@ def display_quiz():
 """, unsafe_allow_html=True)
     st.markdown('<p class="center-text">元の附設に戻せ！と入力してスタートせよ</p>', unsafe_allow_html=True)
     
+    display_chat()
+
+@st.fragment
+def display_chat():
+    """チャット欄と入力欄。回答を送ったときはこのフラグメントだけを再実行する"""
     # チャットメッセージの表示エリア
     chat_area = st.container()
     
-    # メッセージを表示
-    for msg in st.session_state.messages:
+    # メッセージを表示（直近のメッセージだけ。古いものはトグルを開いたときだけ表示）
+    older, recent = split_transcript(st.session_state.messages)
+    display_older_messages(older, chat_area)
+    for msg in recent:
         format_message(msg['role'], msg['content'], chat_area, is_new_message=False)
-        
-        # 最後のメッセージが成功メッセージかチェック
-        if msg == st.session_state.messages[-1] and "ゲーム終了" in msg['content'] and not st.session_state.quiz_completed:
+    
+    # 最後のメッセージが成功メッセージかチェック（画面を切り替えるのでアプリ全体を再実行）
+    if st.session_state.messages:
+        latest_msg = st.session_state.messages[-1]
+        if "ゲーム終了" in latest_msg['content'] and not st.session_state.quiz_completed:
             st.session_state.quiz_completed = True
             st.session_state.game_state = 'success'
             st.rerun()
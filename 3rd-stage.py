@@ -1,14 +1,51 @@
 import streamlit as st
-from openai import OpenAI
 from pathlib import Path
-import base64
 import os
 import time
-import google.generativeai as genai  # Gemini APIのインポート
+import uuid
+from functools import partial
+import streamlit.components.v1 as components
 
 # Google Cloud Text-to-Speech APIのインポート
 from google.cloud import texttospeech
 
+from resources import (
+    GEMINI_MODEL_NAME,
+    configure_gemini,
+    get_avatar_thumbnail,
+    get_background_executor,
+    get_circuit_breakers,
+    get_gemini_model,
+    get_google_tts_client,
+    get_hedge_executor,
+    get_latency_stats,
+    get_llm_scheduler,
+    get_model_router,
+    get_openai_client,
+    get_openai_tts_client,
+    get_tts_cache,
+    get_tts_executor,
+)
+from tts_cache import make_cache_key
+from context_window import (
+    CONTEXT_SUMMARY_BUDGET_SECONDS,
+    CONTEXT_SUMMARY_MODEL,
+    ConversationContext,
+    count_message_tokens,
+    summarize_with_openai,
+)
+from llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_STAGE, SchedulerRejected
+from hedging import hedge
+from model_router import TURN_OPEN, classify_turn
+from resilience import CircuitOpen, Deadline, DeadlineExceeded, call_with_retries
+from quiz_bank import QuizTracker, VerdictReader, parse_prompt
+from rooms import current_session_id, get_room
+from media import audio_html, display_image, play_sound_effect, preload_sound_effects, register_media
+from pronunciation import apply_readings
+from transcript import display_older_messages, split_transcript
+from transitions import run_scheduled_transition, schedule_transition, transition_scheduled
+from speech_pipeline import SpeechPipeline, speech_enqueue_html
+
 # OpenAI APIキーを環境変数から取得（Render.com用）
 def get_openai_api_key():
     api_key = os.getenv("OPENAI_API_KEY")
@@ -17,11 +54,10 @@ def get_openai_api_key():
         st.stop()
     return api_key
 
-# Gemini APIキーをファイルから取得
+# Gemini APIキーをファイルから取得（genaiの初期化はプロセスで1回だけ）
 def get_gemini_api_key():
     try:
-        with open("src/credentials/gemini-api-key.txt", "r") as f:
-            api_key = f.read().strip()
+        api_key = configure_gemini()
         if not api_key:
             st.error("Gemini APIキーが設定されていません。src/credentials/gemini-api-key.txtを確認してください。")
             return None
@@ -30,17 +66,53 @@ def get_gemini_api_key():
         st.error(f"Gemini APIキーの読み込みエラー: {str(e)}")
         return None
 
-# OpenAIクライアントの初期化
-client = OpenAI(api_key=get_openai_api_key())
+# OpenAIクライアントの取得（プロセス内で共有されるので再実行のたびに作り直さない）
+openai_api_key = get_openai_api_key()
+client = get_openai_client(openai_api_key)
+tts_client = get_openai_tts_client(openai_api_key)
 
 # Gemini APIの初期化
 gemini_api_key = get_gemini_api_key()
-if gemini_api_key:
-    genai.configure(api_key=gemini_api_key)
+
+# プロバイダーごとのサーキットブレーカー（TTSのワーカースレッドからも使う）
+breakers = get_circuit_breakers()
+# モデルごとの最初の文字が届くまでの時間（ヘッジ送信のワーカースレッドからも使う）
+latency_stats = get_latency_stats()
+# ターンごとのモデルの選択と、モデルごとの応答時間・エラー率の指数移動平均
+model_router = get_model_router()
 
 # 画像のパスを設定
 AVATAR_PATH = Path("src/images/opening.png")
 
+# 音声合成の設定（キャッシュキーにも使う）
+OPENAI_TTS_MODEL = "tts-1"
+OPENAI_TTS_VOICE = "ash"
+OPENAI_TTS_SPEED = 1.0
+GOOGLE_TTS_VOICE = "ja-JP-Wavenet-B"
+
+# 1ターンの持ち時間（秒）。最初の文字が届くまでの時間で、過ぎたらもう一方のモデルに切り替える
+CHAT_TURN_BUDGET_SECONDS = 15
+CHAT_FALLBACK_BUDGET_SECONDS = 10
+# セッションに残す、ターンごとのモデルと応答時間の記録の数
+TURN_LOG_LIMIT = 50
+# 1文の音声合成の持ち時間（秒）。過ぎたら音声なしで表示する
+TTS_BUDGET_SECONDS = 8
+
+# 効果音が読み込めなかったときに、次の画面に進むまで待つ時間（秒）
+DOOR_OPEN_SECONDS = 2
+
+# ルームのビューアー画面が更新を取りに行く間隔（秒）。通常はドライバーからの通知ですぐに更新される
+ROOM_POLL_SECONDS = 3
+
+# サイドバーの状況表示を描き直す間隔（秒）。ターン中はチャット欄のフラグメントだけが再実行されるため
+SIDEBAR_STATUS_POLL_SECONDS = 2
+
+# クイズ終了の合図（この文言が返答に出たら次の画面に進む）
+QUIZ_END_MARKERS = {
+    'quiz1': "これでクイズ1は終了だ",
+    'quiz2': "これでクイズ2は終了だ",
+}
+
 def load_prompt_from_file(file_path):
     """プロンプトをファイルから読み込む"""
     try:
@@ -51,6 +123,23 @@ def load_prompt_from_file(file_path):
         st.error(f"プロンプトファイルの読み込みエラー: {str(e)}")
         return None
 
+def start_quiz(file_path):
+    """プロンプトファイルを問題リストとして読み込み、会話と進行状況をリセットする
+
+    モデルにはキャラクター設定だけをシステムプロンプトとして送り、
+    問題は進行状況に合わせて1問ずつ指示する。読み込めなかった場合はFalseを返す
+    """
+    prompt_content = load_prompt_from_file(file_path)
+    if not prompt_content:
+        return False
+    bank = parse_prompt(prompt_content)
+    st.session_state.messages = []
+    st.session_state.openai_messages = [
+        {"role": "system", "content": bank.system_prompt()}
+    ]
+    st.session_state.quiz_tracker = QuizTracker(bank)
+    return True
+
 def init_session_state():
     """Initialize session state variables"""
     if 'game_state' not in st.session_state:
@@ -59,22 +148,13 @@ def init_session_state():
         st.session_state.messages = []
     if 'openai_messages' not in st.session_state:
         # プロンプトをファイルから読み込む
-        prompt_content = load_prompt_from_file("prompt.txt")
-        if prompt_content:
-            st.session_state.openai_messages = [
-                {"role": "system", "content": prompt_content}
-            ]
-        else:
+        if not start_quiz("prompt.txt"):
             # ファイル読み込みに失敗した場合はエラーメッセージを表示して終了
             st.error("プロンプトファイルが見つからないか、読み込めませんでした。prompt.txtファイルを確認してください。")
             st.stop()
     if 'avatar_image' not in st.session_state:
-        if AVATAR_PATH.exists():
-            with open(AVATAR_PATH, "rb") as f:
-                avatar_data = f.read()
-            st.session_state.avatar_image = avatar_data
-        else:
-            st.session_state.avatar_image = None
+        # 縮小画像はプロセスで1つだけ持ち、各セッションはそれを参照する
+        st.session_state.avatar_image = get_avatar_thumbnail(str(AVATAR_PATH))
     if 'tts_enabled' not in st.session_state:
         st.session_state.tts_enabled = True
     if 'tts_provider' not in st.session_state:
@@ -89,101 +169,63 @@ def init_session_state():
         st.session_state.current_quiz = 'quiz1'
     if 'model_choice' not in st.session_state:
         st.session_state.model_choice = 'gpt-4o'  # デフォルトはGPT-4o
+    if 'pending_response' not in st.session_state:
+        st.session_state.pending_response = False
+    if 'hedge_enabled' not in st.session_state:
+        st.session_state.hedge_enabled = False
 
 def apply_pronunciation_guides(text):
-    """読み方が難しい言葉にふりがなや読み方のヒントを付ける"""
-    # 読み方マッピング辞書（漢字: 読み方の表記）
-    pronunciation_map = {
-        "源頼朝": "源頼朝みなもとのよりとも",
-        "征夷大将軍": "せいいたいしょうぐん",
-        "趣":"おもむき",
-        "浪人生":"ろうにんせい",
-        "板垣政参": "いたがきまさみつ",
-        "瑞宝中綬章": "ずいほうちゅうじゅしょう",
-        "裏店": "うらみせ",
-        "肉飯": "にくめし",
-        "男く祭": "おとこくさい",
-        "芙蓉": "ふよう",
-        "西鉄": "にしてつ",
-        "久留米":"くるめ",
-        "チーム1":"チームいち",
-        "チーム2":"チームに",
-        "チーム3":"チームさん",
-        "チーム4":"チームよん",
-        "チーム5":"チームご",
-        "1192":"せんひゃくきゅうじゅうに",
-        "2005":"にせんご",
-        "1968":"せんきゅうひゃくろうじゅうはち",
-        "吉川敦": "よしかわあつし",
-        "黒水": "くろうず",
-        "七福神":"しちふくじん", 
-        "満々":"まんまん",
-        "松下由依":"まつしたゆい",
-        "勝連":"かつれん",
-        "小林":"こばやし",
-        "松雪":"まつゆき",
-        "中島":"なかじま",
-        "山本":"やまもと",
-        "上坂元":"かみさかもと",
-        "秋本":"あきもと",
-        "松浦":"まつうら",
-        "田中":"たなか",
-        "吉開":"よしかい",
-        "年": "ねん",
-        "織田信長":"おだのぶなが",
-        "町田": "まちだ",
-        "情け": "なさけ",
-        "三権分立":"さんけんぶんりつ",
-        "県花":"けんか",
-    }
-    
-    # 辞書内の各項目に対して読み方を追加
-    for word, reading in pronunciation_map.items():
-        if word in text and word != reading:  # 既に読み方が付いていない場合のみ
-            text = text.replace(word, reading)
-    
-    return text
+    """読み方が難しい言葉にふりがなや読み方のヒントを付ける
 
-def generate_speech(text):
-    """Generate speech from text using OpenAI TTS"""
-    try:
-        # 読み方ガイドを適用
-        modified_text = apply_pronunciation_guides(text)
-        
-        response = client.audio.speech.create(
-            model="tts-1",
-            voice="ash",
+    読み方はpronunciation.json（app.jsと共有）で管理し、1回の走査で最長一致の語を置き換える
+    """
+    return apply_readings(text)
+
+def prepare_speech(text, provider):
+    """読み方ガイドを適用したテキストと、その音声のキャッシュキーを返す"""
+    modified_text = apply_pronunciation_guides(text)
+    if provider == "openai":
+        cache_key = make_cache_key("openai", OPENAI_TTS_VOICE, OPENAI_TTS_MODEL, OPENAI_TTS_SPEED, modified_text)
+    else:
+        cache_key = make_cache_key("google", GOOGLE_TTS_VOICE, "mp3", 1.0, modified_text)
+    return modified_text, cache_key
+
+def synthesize_speech_openai(text):
+    """OpenAI TTSで音声を合成する（失敗時は例外を投げる）
+
+    ワーカースレッドからも呼ばれるのでst.*の表示関数は使わない
+    """
+    # 読み方ガイドを適用
+    modified_text, cache_key = prepare_speech(text, "openai")
+    
+    def synthesize(timeout):
+        response = tts_client.with_options(timeout=timeout, max_retries=0).audio.speech.create(
+            model=OPENAI_TTS_MODEL,
+            voice=OPENAI_TTS_VOICE,
             input=modified_text,
-            speed=1.0
+            speed=OPENAI_TTS_SPEED
         )
-        
         return response.content
-    except Exception as e:
-        st.error(f"音声生成エラー: {str(e)}")
-        return None
+    
+    # 同じ台詞は合成済みの音声を使い回す
+    return get_tts_cache().get_or_create(
+        cache_key,
+        lambda: call_with_retries(synthesize, Deadline(TTS_BUDGET_SECONDS), breakers.get("openai-tts"))
+    )
 
-# 既存のOpenAI TTS関数の下にGoogle TTSの関数を追加
-def generate_speech_google(text):
-    """Generate speech from text using Google Cloud TTS"""
-    try:
-        # 読み方ガイドを適用
-        modified_text = apply_pronunciation_guides(text)
-        
-        # 認証情報ファイルへのパスを絶対パスで設定
-        # __file__を使わず、明示的に絶対パスを指定
-        credentials_path = "/Users/Yukis_MacBook/Python/Hell-high-school/src/credentials/hell-highschool-40eb2d572293.json"
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
-        
-        # Google Cloud Text-to-Speech クライアントを初期化
-        tts_client = texttospeech.TextToSpeechClient()
-        
+def synthesize_speech_google(text, google_tts_client):
+    """Google Cloud TTSで音声を合成する（失敗時は例外を投げる）"""
+    # 読み方ガイドを適用
+    modified_text, cache_key = prepare_speech(text, "google")
+    
+    def synthesize(timeout):
         # 合成する入力テキストを設定
         synthesis_input = texttospeech.SynthesisInput(text=modified_text)
         
         # 音声設定（日本語、女性の声）
         voice = texttospeech.VoiceSelectionParams(
             language_code="ja-JP",
-            name="ja-JP-Wavenet-B",  # 女性の声
+            name=GOOGLE_TTS_VOICE,  # 女性の声
             ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
         )
         
@@ -193,15 +235,53 @@ def generate_speech_google(text):
         )
         
         # リクエストを送信
-        response = tts_client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
+        response = google_tts_client.synthesize_speech(
+            input=synthesis_input, voice=voice, audio_config=audio_config, timeout=timeout
         )
         
         # 音声データを返す
         return response.audio_content
+    
+    # 同じ台詞は合成済みの音声を使い回す
+    return get_tts_cache().get_or_create(
+        cache_key,
+        lambda: call_with_retries(synthesize, Deadline(TTS_BUDGET_SECONDS), breakers.get("google-tts"))
+    )
+
+def generate_speech(text):
+    """Generate speech from text using OpenAI TTS"""
+    try:
+        return synthesize_speech_openai(text)
+    except (DeadlineExceeded, CircuitOpen):
+        # 音声が間に合わないときは文字だけ表示する
+        return None
+    except Exception as e:
+        st.error(f"音声生成エラー: {str(e)}")
+        return None
+
+# 既存のOpenAI TTS関数の下にGoogle TTSの関数を追加
+def generate_speech_google(text):
+    """Generate speech from text using Google Cloud TTS"""
+    try:
+        # Google Cloud Text-to-Speech クライアントを取得（プロセスで共有）
+        return synthesize_speech_google(text, get_google_tts_client())
+    except (DeadlineExceeded, CircuitOpen):
+        # 音声が間に合わないときは文字だけ表示する
+        return None
+    except Exception as e:
+        st.error(f"Google音声生成エラー: {str(e)}")
+        return None
+
+def get_speech_synthesizer():
+    """選択中のプロバイダーで音声を合成する関数を返す（ワーカースレッド用）"""
+    if st.session_state.tts_provider == "openai":
+        return synthesize_speech_openai
+    try:
+        google_tts_client = get_google_tts_client()
     except Exception as e:
         st.error(f"Google音声生成エラー: {str(e)}")
         return None
+    return lambda text: synthesize_speech_google(text, google_tts_client)
 
 def load_css():
     """Return CSS for the chat interface"""
@@ -392,146 +472,747 @@ def load_css():
     </style>
     """
 
-def get_chat_response(messages):
-    """Get response from OpenAI API or Gemini API based on model choice"""
+def get_chat_response(messages, stream=False, instruction=None, turn_type=TURN_OPEN):
+    """Get response from OpenAI API or Gemini API based on model choice
+
+    stream=Trueの場合は返答の文字列を少しずつ返すジェネレーターを返す。
+    instructionには今回のターンだけの指示（今の問題と進行状況）を渡す。
+    turn_typeで小さなモデルに送るか大きなモデルに送るかが決まる（model_router を参照）
+    """
+    if stream:
+        return stream_chat_response(messages, instruction=instruction, turn_type=turn_type)
+    return "".join(
+        stream_chat_response(messages, stream=False, instruction=instruction, turn_type=turn_type)
+    ) or None
+
+def get_conversation_context(messages):
+    """このセッションの会話コンテキスト（プロンプトが変わったら作り直す）"""
+    context = st.session_state.get('conversation_context')
+    system_content = messages[0]["content"]
+    if context is None or context.system_content != system_content or context.folded > len(messages) - 1:
+        context = ConversationContext(system_content)
+        st.session_state.conversation_context = context
+    return context
+
+def summarize_older_turns(messages):
+    """直近より古いやり取りを、バックグラウンドで進行状況の要約にまとめる"""
+    scheduler = get_llm_scheduler()
+    session_id = current_session_id()
+
+    def summarize(previous_summary, older_messages):
+        deadline = Deadline(CONTEXT_SUMMARY_BUDGET_SECONDS)
+        # 要約は返答を待っているリクエストより後に回す。持ち時間内に順番が来なければ今回は要約しない
+        # （バックグラウンドのワーカーを待ちっぱなしで塞がない。次のターンでもう一度要約する）
+        try:
+            scheduler.acquire(
+                session_id,
+                PRIORITY_BACKGROUND,
+                count_message_tokens(older_messages) + 300,
+                CONTEXT_SUMMARY_MODEL,
+                timeout=deadline.remaining(),
+            )
+        except SchedulerRejected:
+            return None
+        return summarize_with_openai(
+            client, previous_summary, older_messages, deadline=deadline, breaker=breakers.get("openai")
+        )
+
+    get_conversation_context(messages).schedule_summary(messages, summarize, get_background_executor())
+
+def to_gemini_history(messages, summary=""):
+    """OpenAI形式のメッセージをGeminiの履歴形式に変換（systemは除く）
+
+    要約があれば最初のユーザーメッセージの前に付ける
+    """
+    history = [
+        {"role": "user" if msg["role"] == "user" else "model", "parts": [msg["content"]]}
+        for msg in messages
+        if msg["role"] != "system"
+    ]
+    if summary and history:
+        history[0]["parts"] = [f"（これまでの進行状況）\n{summary}\n\n{history[0]['parts'][0]}"]
+    return history
+
+def get_gemini_chat(messages, model_name=GEMINI_MODEL_NAME):
+    """このセッションのGeminiチャットを返す
+
+    チャットはセッションごとに1つ保持して、毎ターン新しいメッセージだけを送る。
+    初回、プロンプトが変わったとき、GPT-4oで会話を進めたとき、モデルを切り替えたときなど、
+    チャットの履歴がmessagesと食い違う場合だけ履歴から作り直す。
+    履歴が長くなりすぎた場合も、要約 + 直近のメッセージだけで作り直す。
+    """
+    model = get_gemini_model(messages[0]["content"], model_name)
+    context = get_conversation_context(messages)
+    state = st.session_state.get('gemini_chat')
+    if (
+        state is None
+        or state['model'] is not model
+        or state['synced_length'] != len(messages) - 1
+        or state['history_tokens'] > context.max_input_tokens
+        or state['history_length'] > context.keep_messages + context.keep_messages // 2
+    ):
+        _, summary, window = context.build(messages)
+        history = window[:-1]
+        chat = model.start_chat(history=to_gemini_history(history, summary))
+        state = {
+            'chat': chat,
+            'model': model,
+            'synced_length': None,
+            'history_length': len(history),
+            'history_tokens': count_message_tokens(history) + count_message_tokens([{"content": summary}]),
+        }
+        st.session_state.gemini_chat = state
+    # 返答を最後まで受け取るまでは同期していない扱いにする（途中で止めたチャットは使い回さない）
+    state['synced_length'] = None
+    return state['chat']
+
+def mark_gemini_chat_synced(messages, reply):
+    """返答を受け取り終えたら、チャットがmessagesのどこまでを反映しているかを記録する"""
+    state = st.session_state.get('gemini_chat')
+    if state is not None:
+        # 送ったユーザーメッセージと、これから履歴に追加される返答の分
+        state['synced_length'] = len(messages) + 1
+        state['history_length'] += 2
+        state['history_tokens'] += count_message_tokens([messages[-1], {"content": reply}])
+
+def openai_text_chunks(response):
+    """OpenAIのストリームからテキストだけを取り出す"""
+    try:
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # 途中で読むのをやめた場合も接続をプールに返す
+        response.close()
+
+def send_openai(model, request_messages, stream, timeout):
+    """OpenAIに送り、返答のチャンクのイテレーターを返す（timeoutは残りの持ち時間）"""
+    response = client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+        model=model,
+        messages=request_messages,
+        temperature=0.7,
+        max_tokens=1000,
+        stream=stream
+    )
+    if not stream:
+        return iter([response.choices[0].message.content])
+    return openai_text_chunks(response)
+
+def gemini_text_chunks(response, messages):
+    """Geminiのストリームからテキストだけを取り出し、最後まで受け取ったらチャットを同期済みにする"""
+    reply = ""
+    for chunk in response:
+        # 安全フィルタなどでテキストが無いチャンクは飛ばす
+        if chunk.parts:
+            reply += chunk.text
+            yield chunk.text
+    mark_gemini_chat_synced(messages, reply)
+
+def send_gemini(chat, content, messages, stream, timeout):
+    """Geminiに送り、返答のチャンクのイテレーターを返す（timeoutは残りの持ち時間）"""
+    response = chat.send_message(content, stream=stream, request_options={"timeout": timeout})
+    if not stream:
+        mark_gemini_chat_synced(messages, response.text)
+        return iter([response.text])
+    return gemini_text_chunks(response, messages)
+
+def prepare_request(model_choice, model, messages, instruction):
+    """model_choice（プロバイダー）の model に送る内容を用意し、send(stream, timeout) の形の関数を返す
+
+    セッションの状態（会話コンテキスト・Geminiのチャット）を使うのでスクリプトのスレッドで呼ぶ。
+    返した関数はワーカースレッドから呼んでもよい
+    """
+    if model_choice == 'gpt-4o':
+        # システムプロンプト + 進行状況の要約 + 直近のメッセージだけを送る
+        request_messages = get_conversation_context(messages).to_openai_messages(messages)
+        if instruction:
+            # 今回のターンの指示は最後のユーザーメッセージの直前に置く
+            request_messages.insert(len(request_messages) - 1, {"role": "system", "content": instruction})
+        return partial(send_openai, model, request_messages)
+    chat = get_gemini_chat(messages, model)
+    # 新しいユーザーメッセージだけを、今回のターンの指示を添えて送信
+    content = messages[-1]["content"]
+    if instruction:
+        content = f"{instruction}\n\n### 参加者の発言\n{content}"
+    return partial(send_gemini, chat, content, messages)
+
+def start_response(model_choice, model, send, stream, timeout):
+    """最初のチャンクまで受け取る（再試行の単位）。(最初のチャンク, 残りのチャンク) を返す
+
+    最初のチャンクが届くまでの時間は、ヘッジ送信の待ち時間とモデルの選択のために記録する
+    """
+    started = time.monotonic()
     try:
-        if st.session_state.model_choice == 'gpt-4o':
-            # OpenAI APIを使用
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1000
+        chunks = send(stream, timeout)
+        first = next(chunks, "")
+    except Exception:
+        model_router.stats.record(model, ok=False)
+        raise
+    latency = time.monotonic() - started
+    latency_stats.record(model_choice, latency)
+    model_router.stats.record(model, latency)
+    return first, chunks
+
+def wait_for_llm_slot(messages, model, deadline, on_wait=None):
+    """OpenAIの model に送る順番待ち。ステージの返答はフロアより先に送る"""
+    get_llm_scheduler().acquire(
+        current_session_id(),
+        PRIORITY_STAGE,
+        count_message_tokens(messages) + 1000,
+        model,
+        timeout=deadline.remaining(),
+        on_wait=on_wait,
+    )
+
+def fallback_model(model_choice):
+    """持ち時間切れやブレーカーが開いたときに切り替える先（無ければNone）"""
+    if model_choice == 'gpt-4o':
+        return 'gemini' if gemini_api_key else None
+    return 'gpt-4o'
+
+def start_hedged_response(primary, secondary, messages, instruction, deadline, turn_type):
+    """選択中のモデルに送り、いつもより遅ければもう一方にも送って、先に応答した方を使う
+
+    (応答したプロバイダー, モデル, 最初のチャンク, 残りのチャンク) を返す
+    """
+    # ワーカースレッドではセッションが分からないので、順番待ちの引数はここで用意する
+    scheduler = get_llm_scheduler()
+    session_id = current_session_id()
+    tokens = count_message_tokens(messages) + 1000
+
+    models = {provider: model_router.model_for(provider, turn_type) for provider in (primary, secondary)}
+
+    def attempt(model_choice):
+        send = prepare_request(model_choice, models[model_choice], messages, instruction)
+
+        def run():
+            if model_choice == 'gpt-4o':
+                scheduler.acquire(
+                    session_id, PRIORITY_STAGE, tokens, models[model_choice], timeout=deadline.remaining()
+                )
+            # 再試行の代わりにもう一方のモデルに送るので、ここでは1回だけ
+            return call_with_retries(
+                partial(start_response, model_choice, models[model_choice], send, True),
+                deadline,
+                breakers.get(model_choice),
+                attempts=1,
             )
-            return response.choices[0].message.content
-        elif st.session_state.model_choice == 'gemini':
-            # Gemini APIを使用
-            if not gemini_api_key:
-                st.error("Gemini APIキーが設定されていません。")
-                return None
-            
-            # Gemini用にメッセージをフォーマット（最後のメッセージを除く）
-            gemini_messages = []
-            for msg in messages[:-1]:  # 最後のメッセージを除外
-                if msg["role"] == "system":
-                    # Geminiはシステムロールをサポートしていないため、ユーザーメッセージとして扱う
-                    gemini_messages.append({"role": "user", "parts": [msg["content"]]})
-                else:
-                    gemini_messages.append({"role": "user" if msg["role"] == "user" else "model", "parts": [msg["content"]]})
-            
-            # Geminiモデルを設定
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            # チャット履歴を作成
-            chat = model.start_chat(history=gemini_messages)
-            
-            # 最後のメッセージを送信
-            last_message = messages[-1]
-            response = chat.send_message(last_message["content"])
-            return response.text
+        return run
+
+    winner, first, chunks = hedge(
+        attempt(primary), attempt(secondary), latency_stats.hedge_delay(primary), get_hedge_executor()
+    )
+    provider = primary if winner == "primary" else secondary
+    return provider, models[provider], first, chunks
+
+def available_providers():
+    """今送れるプロバイダー（APIキーが無いものとブレーカーが開いているものを除く）"""
+    providers = ['gpt-4o'] + (['gemini'] if gemini_api_key else [])
+    return [provider for provider in providers if not breakers.get(provider).is_open]
+
+def record_turn_route(provider, model, first_latency, total_latency):
+    """このターンに使ったモデルと応答時間を記録する（サイドバーに表示する）"""
+    route = {
+        "provider": provider,
+        "model": model,
+        "first_latency": round(first_latency, 2),
+        "total_latency": round(total_latency, 2),
+    }
+    st.session_state.turn_log = (st.session_state.get('turn_log', []) + [route])[-TURN_LOG_LIMIT:]
+    return route
+
+@st.fragment(run_every=SIDEBAR_STATUS_POLL_SECONDS)
+def display_turn_route():
+    """前のターンに使ったモデルと応答時間を表示する（サイドバーの中で一定間隔で描き直す）"""
+    turn_log = st.session_state.get('turn_log')
+    if not turn_log:
+        return
+    route = turn_log[-1]
+    st.caption(
+        f"前のターン: {route['model']}（最初の文字まで{route['first_latency']:.1f}秒・"
+        f"全体{route['total_latency']:.1f}秒）"
+    )
+
+@st.fragment(run_every=SIDEBAR_STATUS_POLL_SECONDS)
+def display_tts_cache_stats():
+    """音声キャッシュのヒット・ミスの数を表示する（サイドバーの中で一定間隔で描き直す）"""
+    cache_stats = get_tts_cache().stats()
+    st.caption(
+        f"音声キャッシュ: ヒット {cache_stats['memory_hits'] + cache_stats['disk_hits']} / "
+        f"ミス {cache_stats['misses']}（{cache_stats['disk_bytes'] // 1024} KB）"
+    )
+
+def stream_chat_response(messages, stream=True, instruction=None, turn_type=TURN_OPEN):
+    """返答のテキストをチャンクごとに返すジェネレーター
+
+    ターンの種類と各モデルの応答時間・エラー率から、送るプロバイダーとモデルを選ぶ。
+    最初のチャンクが届くまでを持ち時間の中で再試行する。選択中のモデルが持ち時間内に
+    応答しないか、ブレーカーが開いている場合は、もう一方のモデルに切り替えて送り直す。
+    ヘッジ送信がオンなら、遅いときは待たずにもう一方のモデルにも同時に送る。
+    使ったモデルと応答時間は st.session_state.turn_log に記録する
+    """
+    if st.session_state.model_choice == 'gemini' and not gemini_api_key:
+        st.error("Gemini APIキーが設定されていません。")
+        return
+    started = time.monotonic()
+    model_choice, model = model_router.choose(
+        turn_type, st.session_state.model_choice, available_providers()
+    )
+    deadline = Deadline(CHAT_TURN_BUDGET_SECONDS)
+    secondary = fallback_model(model_choice)
+    if stream and st.session_state.get('hedge_enabled') and secondary and not breakers.get(secondary).is_open:
+        try:
+            model_choice, model, first, chunks = start_hedged_response(
+                model_choice, secondary, messages, instruction, deadline, turn_type
+            )
+        except Exception as e:
+            st.error(f"エラーが発生しました: {str(e)}")
+            return
+    else:
+        tried = set()
+        while True:
+            tried.add(model_choice)
+            try:
+                if model_choice == 'gpt-4o':
+                    # 混んでいれば順番待ちの位置を表示する
+                    wait_notice = st.empty()
+                    try:
+                        wait_for_llm_slot(
+                            messages, model, deadline,
+                            on_wait=lambda position: wait_notice.caption(f"順番待ち（{position}番目）…"),
+                        )
+                    finally:
+                        wait_notice.empty()
+                # Geminiのチャットは失敗すると使えなくなるので、送り直すたびに用意し直す
+                first, chunks = call_with_retries(
+                    lambda timeout: start_response(
+                        model_choice, model, prepare_request(model_choice, model, messages, instruction),
+                        stream, timeout
+                    ),
+                    deadline,
+                    breakers.get(model_choice),
+                )
+            except (DeadlineExceeded, CircuitOpen, SchedulerRejected) as e:
+                fallback = fallback_model(model_choice)
+                if fallback is None or fallback in tried:
+                    st.error(f"エラーが発生しました: {str(e)}")
+                    return
+                # 以降のターンも切り替えた先のモデルで進める
+                st.toast(f"{model_choice}が応答しないので{fallback}に切り替えます")
+                st.session_state.model_choice = model_choice = fallback
+                model = model_router.model_for(model_choice, turn_type)
+                deadline = Deadline(CHAT_FALLBACK_BUDGET_SECONDS)
+                continue
+            except Exception as e:
+                st.error(f"エラーが発生しました: {str(e)}")
+                return
+            break
+    first_latency = time.monotonic() - started
+    try:
+        if first:
+            yield first
+        yield from chunks
     except Exception as e:
+        # 途中で途切れた返答は、届いた分だけで終える
         st.error(f"エラーが発生しました: {str(e)}")
-        return None
+    finally:
+        record_turn_route(model_choice, model, first_latency, time.monotonic() - started)
 
-def convert_to_hiragana(text):
-    """難しい漢字や固有名詞をひらがなに変換"""
-    # 変換マッピング
-    conversion_map = {
-        "源頼朝": "みなもとのよりとも",
-        "征夷大将軍": "せいいたいしょうぐん",
-        "鎌倉幕府": "かまくらばくふ",
-        "裏店": "うらみせ",
-        "男く祭": "おとこくさい",
-        "芙蓉": "ふよう"
-    }
-    
-    # 表示用テキストと音声用テキストを分ける
-    display_text = text
-    speech_text = text
-    
-    for word, reading in conversion_map.items():
-        if word in speech_text:
-            speech_text = speech_text.replace(word, reading)
-    
-    return display_text, speech_text
+def close_chunks(chunks):
+    """読むのをやめたチャンクのジェネレーターを閉じる（上流のストリームの接続と音声合成も止まる）"""
+    close = getattr(chunks, "close", None)
+    if close is not None:
+        close()
+
+def watch_quiz_end(chunks, marker, on_quiz_end):
+    """ストリーム中にクイズ終了の合図を見つけたら、その場でon_quiz_endを呼んで読み込みを止める
+
+    ゲームの状態が変わったら返答の残りは使わないので、上流のストリームも閉じる
+    """
+    received = ""
+    try:
+        for chunk in chunks:
+            yield chunk
+            # 合図がチャンクの境目で分かれても見つけられるように末尾だけを検索する
+            tail = received[-len(marker):] + chunk
+            received += chunk
+            if marker in tail:
+                on_quiz_end()
+                return
+    finally:
+        close_chunks(chunks)
+
+def new_message(role, content):
+    """表示用のメッセージを作成
+
+    再実行をまたいで同じメッセージを見分けるためのIDと、読み上げ音声の状態を持たせる。
+    音声の状態は pending（未合成）→ synthesized（合成済み）→ delivered（ブラウザに送信済み）
+    → played（再生済み）と進み、TTSがオフのときに表示したものは skipped になる。
+    """
+    message = {"id": uuid.uuid4().hex, "role": role, "content": content}
+    if role == "assistant":
+        message["audio"] = {"status": "pending", "keys": []}
+    return message
+
+def play_speech(text, container, audio=None):
+    """読み上げ音声を生成して再生する"""
+    # 選択されたプロバイダーに基づいて音声を生成
+    if st.session_state.tts_provider == "openai":
+        audio_bytes = generate_speech(text)
+    else:  # google
+        audio_bytes = generate_speech_google(text)
+        
+    if audio_bytes:
+        if audio is not None:
+            audio["keys"].append(prepare_speech(text, st.session_state.tts_provider)[1])
+            audio["status"] = "synthesized"
+
+        # メディアファイルとして登録し、URLで参照する
+        audio_url = register_media(audio_bytes, key=audio["keys"][-1] if audio else None)
+        container.markdown(audio_html(audio_url), unsafe_allow_html=True)
+        if audio is not None:
+            audio["status"] = "delivered"
+
+def speak_while_streaming(chunks, container, audio=None):
+    """返答を表示しながら文ごとに音声合成し、届いた順に隙間なく再生する"""
+    synthesize = get_speech_synthesizer()
+    provider = st.session_state.tts_provider
+    if synthesize is None or breakers.get(f"{provider}-tts").is_open:
+        # TTSが落ちているあいだは文字だけ表示する
+        yield from chunks
+        return
+
+    pipeline = SpeechPipeline(synthesize, get_tts_executor())
+    turn_id = uuid.uuid4().hex
+    error_shown = False
+    finished = False
+
+    def enqueue(results):
+        nonlocal error_shown
+        for index, audio_bytes, error in results:
+            if error is not None and not error_shown and not isinstance(error, (DeadlineExceeded, CircuitOpen)):
+                st.error(f"音声生成エラー: {str(error)}")
+                error_shown = True
+            # 合成に失敗した文も空のsrcで必ず追加する。再生キューは番号順に待つので、
+            # 1つでも欠けるとそれより後ろの文がいつまでも再生されない
+            src = ""
+            if audio_bytes:
+                if audio is not None:
+                    audio["keys"].append(prepare_speech(pipeline.texts[index], provider)[1])
+                    audio["status"] = "synthesized"
+                src = register_media(audio_bytes, key=f"{turn_id}-{index}")
+            with container:
+                components.html(speech_enqueue_html(turn_id, index, src), height=0)
+
+    try:
+        for chunk in chunks:
+            yield chunk
+            pipeline.feed(chunk)
+            enqueue(pipeline.ready())
 
-def format_message(role, content, container, is_new_message=False):
-    """Format message with Streamlit components"""
+        # クイズが終了して画面遷移する場合は残りを読み上げない
+        if st.session_state.game_state not in ('quiz', 'quiz2'):
+            pipeline.cancel()
+        else:
+            enqueue(pipeline.finish())
+        finished = True
+    finally:
+        if not finished:
+            # 表示の途中で止まった（セッションが閉じられた・再実行された）ら、まだの合成は取り消す
+            pipeline.cancel()
+            close_chunks(chunks)
+    if audio is not None and audio["keys"]:
+        audio["status"] = "delivered"
+
+def format_message(role, content, container, is_new_message=False, audio=None):
+    """Format message with Streamlit components
+
+    contentにジェネレーターを渡すと受け取った順に文字を表示し、最終的な全文を返す。
+    audioにメッセージの音声状態を渡すと、合成・送信の結果をそこに記録する
+    """
     if role == "user":
         with container.chat_message("user"):
             st.write(content)
+        return content
+
+    speak = st.session_state.tts_enabled and is_new_message
+
+    if not isinstance(content, str):
+        # ストリーミング表示：届いたトークンからすぐに表示し、文が完成するたびに読み上げる
+        if speak:
+            content = speak_while_streaming(content, container, audio)
+        with container.chat_message("assistant", avatar=st.session_state.avatar_image):
+            content = st.write_stream(content)
+        if not isinstance(content, str):
+            content = "".join(str(part) for part in content)
     else:
-        # 表示用テキストと音声用テキストを分ける
-        display_text, speech_text = convert_to_hiragana(content)
-        
         # TTSが有効で、新しいメッセージの場合のみ音声を先に生成・再生
-        if st.session_state.tts_enabled and is_new_message:
-            # 選択されたプロバイダーに基づいて音声を生成
-            if st.session_state.tts_provider == "openai":
-                audio_bytes = generate_speech(speech_text)
-            else:  # google
-                audio_bytes = generate_speech_google(speech_text)
-                
-            if audio_bytes:
-                # Base64エンコードしてHTMLに埋め込み
-                audio_b64 = base64.b64encode(audio_bytes).decode()
-                
-                # 音声を先に再生
-                container.markdown(f"""
-                <audio autoplay style="display: none;">
-                    <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-                </audio>
-                """, unsafe_allow_html=True)
+        # （読み方の変換は音声合成の直前に行うので、表示は元のテキストのまま）
+        if speak:
+            play_speech(content, container, audio)
         
         # 音声再生後に元のテキストを表示
         with container.chat_message("assistant", avatar=st.session_state.avatar_image):
-            st.write(display_text)  # 元のテキストを表示
+            st.write(content)
+
+    # 読み上げなかった（TTSオフ・合成失敗）メッセージは、再実行しても読み上げない
+    if audio is not None and audio["status"] == "pending" and is_new_message:
+        audio["status"] = "skipped"
+    return content
+
+def keep_audio_registered(msg):
+    """ブラウザに送ったばかりの音声を、アプリ全体の再実行のあとも配信し続ける
+
+    登録し直されなかった音声はアプリ全体の再実行の終わりに消えるので、送った直後に再実行すると
+    （入力キューに次の回答がある場合など）ブラウザが読み込む前に404になる。
+    再生済みとして扱う実行でTTSキャッシュから取り出し、同じ内容をもう一度登録しておく
+    """
+    cache = get_tts_cache()
+    for index, key in enumerate(msg['audio']['keys']):
+        audio_bytes = cache.get(key)
+        if audio_bytes:
+            register_media(audio_bytes, key=f"{msg['id']}-{index}")
+
+def display_messages(chat_area):
+    """チャット履歴を表示する
+
+    読み上げはメッセージごとに1回だけ。TTSの切り替えなどで再実行しても音声は作り直さない。
+    直近のメッセージだけを通常どおり表示し、古いものはトグルを開いたときだけ表示する
+    """
+    older, recent = split_transcript(st.session_state.messages)
+    display_older_messages(older, chat_area)
+    for msg in recent:
+        audio = msg.get('audio')
+        if audio and audio['status'] == 'delivered':
+            # 前回の実行でブラウザに送った音声は再生済みとして扱う（読み込みが終わるまでは配信を続ける）
+            keep_audio_registered(msg)
+            audio['status'] = 'played'
+        is_new_message = bool(audio) and audio['status'] == 'pending'
+        format_message(msg['role'], msg['content'], chat_area, is_new_message=is_new_message, audio=audio)
 
 def handle_submit():
-    """Handle message submission"""
+    """Handle message submission
+
+    返答はここでは待たずに、次の再実行でストリーミング表示する
+    """
     current_input = st.session_state["user_input_field"]
     
+    room = get_stage_room()
+    if room is not None:
+        # ルームでは他の端末からの回答と同じ入力キューに並べ、1件ずつ処理する
+        room.enqueue(current_input, session_id=current_session_id())
+        st.session_state["user_input_field"] = ""
+        return
+    
     if current_input.strip():
-        user_message = {
-            "role": "user",
-            "content": current_input
-        }
-        st.session_state.messages.append(user_message)
+        st.session_state.messages.append(new_message("user", current_input))
         st.session_state.openai_messages.append({
             "role": "user",
             "content": current_input
         })
-        
-        # スピナーを削除して画面が暗くならないようにする
-        ai_response = get_chat_response(st.session_state.openai_messages)
-        
-        if ai_response:
-            assistant_message = {
-                "role": "assistant",
-                "content": ai_response
-            }
-            st.session_state.messages.append(assistant_message)
-            st.session_state.openai_messages.append({
-                "role": "assistant",
-                "content": ai_response
-            })
-            
-            # 最後のメッセージが成功メッセージかチェック
-            if st.session_state.current_quiz == 'quiz1' and "これでクイズ1は終了だ" in ai_response:
-                st.session_state.quiz1_completed = True
-                st.session_state.game_state = 'middle_success'
-            elif st.session_state.current_quiz == 'quiz2' and "これでクイズ2は終了だ" in ai_response and len(st.session_state.messages) > 3:
-                st.session_state.quiz2_completed = True
-                st.session_state.game_state = 'final_success'
+        st.session_state.pending_response = True
         
         st.session_state["user_input_field"] = ""
 
+def get_stage_room():
+    """URLに ?room=名前 が付いていればそのルーム（無ければNone）"""
+    name = st.query_params.get("room")
+    return get_room(name) if name else None
+
+def is_room_viewer():
+    """?view=1 が付いていれば、返答も音声も作らずにルームの内容を表示するだけの画面
+
+    ?team=番号 のチームの端末も、回答を入力キューに送る以外はビューアーと同じ
+    """
+    return bool(st.query_params.get("view") or st.query_params.get("team"))
+
+def format_room_queue(in_flight, queued):
+    """入力キューの状況の1行（処理中・順番待ちが無ければ空文字）"""
+    parts = []
+    if in_flight is not None:
+        parts.append(f"{in_flight['team'] or '司会'}の回答を判定中…")
+    if queued:
+        parts.append(f"順番待ち {len(queued)}件")
+    return "　".join(parts)
+
+def stream_room_turn(chat_area, room):
+    """ルームの入力キューから回答を1件だけ取り出し、返答をストリーミング表示する（ドライバーだけ）"""
+    submission = room.begin_turn()
+    if submission is None:
+        return
+    try:
+        content = submission["text"]
+        if submission["team"]:
+            content = f"（{submission['team']}の回答）{content}"
+        st.session_state.messages.append(new_message("user", content))
+        format_message("user", content, chat_area)
+        st.session_state.openai_messages.append({"role": "user", "content": content})
+        # アプリ側の判定にはチーム名を付ける前の回答を使う
+        st.session_state.pending_answer = submission["text"]
+        st.session_state.pending_response = True
+        stream_pending_response(chat_area)
+    finally:
+        # 返答をビューアーに配ってから次の回答に進む
+        room.publish(st.session_state.messages, st.session_state.game_state)
+        room.end_turn(submission)
+    if room.has_queued():
+        st.rerun()
+
+@st.fragment(run_every=ROOM_POLL_SECONDS)
+def display_room_queue(room):
+    """ドライバー画面の入力キューの状況。ドライバーに通知が届かなかった回答もここで拾う"""
+    in_flight, queued = room.queue_status()
+    if queued and in_flight is None and not st.session_state.get('pending_response'):
+        st.rerun()
+    status = format_room_queue(in_flight, queued)
+    if status:
+        st.caption(status)
+
+def publish_while_streaming(chunks, room):
+    """ストリーミング中の返答をルームのビューアーにも途中経過として配る"""
+    received = ""
+    try:
+        for chunk in chunks:
+            received += chunk
+            room.publish_partial(received)
+            yield chunk
+    finally:
+        close_chunks(chunks)
+
+def play_room_audio(msg, container):
+    """ドライバーが合成した音声をキャッシュから取り出して再生する（合成はしない）"""
+    cache = get_tts_cache()
+    for index, key in enumerate(msg["audio_keys"]):
+        audio_bytes = cache.get(key)
+        src = register_media(audio_bytes, key=f"{msg['id']}-{index}") if audio_bytes else ""
+        with container:
+            components.html(speech_enqueue_html(msg["id"], index, src), height=0)
+
+@st.fragment(run_every=ROOM_POLL_SECONDS)
+def display_room_viewer(room):
+    """ルームのビューアー画面：ドライバーの会話と音声をそのまま表示・再生する"""
+    room.subscribe(current_session_id())
+    version, transcript, game_state, streaming = room.snapshot()
+    if 'room_heard' not in st.session_state:
+        # 途中から開いた画面では、それまでの音声は再生しない
+        st.session_state.room_heard = {msg["id"] for msg in transcript}
+
+    if game_state == 'quiz2':
+        st.markdown("<h1 style='text-align: center;'>附設に関する質問をクリアせよ！</h1>", unsafe_allow_html=True)
+    else:
+        st.markdown("<h1 style='text-align: center;'>基本問題をクリアせよ！</h1>", unsafe_allow_html=True)
+
+    chat_area = st.container()
+    for msg in transcript:
+        format_message(msg["role"], msg["content"], chat_area)
+        if msg["role"] == "assistant" and msg["id"] not in st.session_state.room_heard:
+            st.session_state.room_heard.add(msg["id"])
+            if st.session_state.tts_enabled:
+                play_room_audio(msg, chat_area)
+    if streaming:
+        format_message("assistant", streaming, chat_area)
+
+    # 処理中・順番待ちの回答があれば、他の端末には「待ち」の状態を見せる
+    queue_status = st.empty()
+    team = st.query_params.get("team")
+    if team and game_state in ('quiz', 'quiz2'):
+        with st.form("room_answer_form", clear_on_submit=True):
+            answer = st.text_input(f"チーム{team}の回答", label_visibility="collapsed")
+            submitted = st.form_submit_button("回答する")
+        if submitted and not get_llm_scheduler().admit(current_session_id()):
+            st.warning("送信が早すぎます。少し待ってから送ってください")
+        elif submitted:
+            submission, accepted = room.enqueue(answer, team=f"チーム{team}", session_id=current_session_id())
+            if submission is not None and not accepted:
+                st.info("同じ回答はすでに受け付けています")
+    in_flight, queued = room.queue_status()
+    status = format_room_queue(in_flight, queued)
+    if status:
+        queue_status.caption(status)
+
+    if game_state == 'middle_success':
+        st.markdown("<h2 style='text-align: center;'>クイズ1クリア</h2>", unsafe_allow_html=True)
+    elif game_state == 'final_success':
+        st.markdown("<h2 style='text-align: center;'>クイズ2クリア</h2>", unsafe_allow_html=True)
+
+def finish_current_quiz():
+    """クイズ終了の合図が出たら次の画面に切り替える"""
+    if st.session_state.current_quiz == 'quiz1':
+        st.session_state.quiz1_completed = True
+        st.session_state.game_state = 'middle_success'
+    elif st.session_state.current_quiz == 'quiz2' and len(st.session_state.messages) >= 3:
+        # 返答を追加する前なので、元の「len(messages) > 3」と同じ条件になる
+        st.session_state.quiz2_completed = True
+        st.session_state.game_state = 'final_success'
+
+def stream_pending_response(chat_area):
+    """未回答のメッセージがあれば、AIの返答をストリーミングで表示して履歴に追加
+
+    1st/2nd-stageと違い、返答は共有のイベントループではなくスクリプトのスレッドで受け取る
+    （届いたトークンを st.write_stream でその場で描くため）。入力欄の on_change では待たないので
+    送ったメッセージはすぐ表示され、持ち時間は CHAT_TURN_BUDGET_SECONDS で区切られる。
+    セッションが閉じられたり再実行されたりすると次の描画でスクリプトが止まるので、そこで
+    チャンクのジェネレーターを閉じ、OpenAIの接続とまだの音声合成を取り消す。
+    Geminiのストリームには閉じる手段が無いので、読むのをやめるだけになる
+    """
+    if not st.session_state.get('pending_response'):
+        return
+    st.session_state.pending_response = False
+
+    marker = QUIZ_END_MARKERS[st.session_state.current_quiz]
+    tracker = st.session_state.quiz_tracker
+    # 答えが決まっている問題はアプリ側で判定し、モデルには反応だけを書かせる
+    answer = st.session_state.pop('pending_answer', None) or st.session_state.openai_messages[-1]["content"]
+    verdict = tracker.judge(answer)
+    verdict_reader = VerdictReader()
+    chunks = watch_quiz_end(
+        verdict_reader.read(get_chat_response(
+            st.session_state.openai_messages,
+            stream=True,
+            instruction=tracker.instruction(verdict),
+            # 判定済みの反応や出題だけなら小さなモデル、モデルに判定させるなら大きなモデル
+            turn_type=classify_turn(tracker, verdict),
+        )),
+        marker,
+        finish_current_quiz
+    )
+    room = get_stage_room()
+    if room is not None:
+        chunks = publish_while_streaming(chunks, room)
+    assistant_message = new_message("assistant", "")
+    try:
+        ai_response = format_message(
+            "assistant", chunks, chat_area, is_new_message=True, audio=assistant_message["audio"]
+        )
+    finally:
+        # セッションが閉じられたり再実行されたりすると表示の途中で止まるので、そこで返答の生成も止める
+        close_chunks(chunks)
+    
+    if ai_response:
+        # 返答の判定に合わせて問題とチームを進める
+        tracker.record(verdict or verdict_reader.verdict)
+        assistant_message["content"] = ai_response
+        if st.session_state.get('turn_log'):
+            # どのモデルがどれだけかかって返したかをメッセージにも残す
+            assistant_message["route"] = st.session_state.turn_log[-1]
+        st.session_state.messages.append(assistant_message)
+        st.session_state.openai_messages.append({
+            "role": "assistant",
+            "content": ai_response
+        })
+        # 次の質問までの間に古いやり取りを要約しておく
+        summarize_older_turns(st.session_state.openai_messages)
+    
+    # 終了の合図が出ていれば、返答の残りを待たずに次の画面へ
+    if st.session_state.game_state not in ('quiz', 'quiz2'):
+        st.rerun()
+
 def display_title():
     """タイトル画面を表示"""
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/title.png", use_container_width=True)
+        display_image("src/images/title.png")
     
     # ゲームスタートボタン（中央揃え）
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -576,14 +1257,8 @@ def display_title():
         # ボタンの状態を受け取るための仕組み
         jump_clicked = st.checkbox("", key="jump_to_quiz2", value=False, label_visibility="collapsed")
         if jump_clicked:
-            # クイズ2のプロンプトを読み込む
-            prompt_content = load_prompt_from_file("prompt2.txt")
-            if prompt_content:
-                # メッセージをリセットして新しいプロンプトを設定
-                st.session_state.messages = []
-                st.session_state.openai_messages = [
-                    {"role": "system", "content": prompt_content}
-                ]
+            # クイズ2のプロンプトを読み込み、メッセージをリセットする
+            if start_quiz("prompt2.txt"):
                 st.session_state.current_quiz = 'quiz2'
                 st.session_state.game_state = 'quiz2'
                 st.session_state.quiz1_completed = True  # クイズ1をクリアした状態にする
@@ -598,7 +1273,10 @@ def display_opening():
     col1, col2, col3 = st.columns([1, 1, 1])
 
     with col2:
-        st.image("src/images/ruined-door.jpg", use_container_width=True)
+        display_image("src/images/ruined-door.jpg")
+    
+    # 次の画面で鳴らすドアの音を先に読み込んでおく
+    preload_sound_effects("door-open")
     
     
 def display_opening2():
@@ -606,7 +1284,7 @@ def display_opening2():
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        st.image("src/images/ruined-door-opened.png", use_container_width=True)
+        display_image("src/images/ruined-door-opened.png")
     
     with col2:
         st.markdown("<div style='margin-top: 30%;'></div>", unsafe_allow_html=True)
@@ -619,25 +1297,11 @@ def display_opening2():
     # 音声再生と画面遷移の処理を分離
     st.markdown("<div style='height: 0px;'></div>", unsafe_allow_html=True)  # 非表示のスペーサー
     
-    # ドアが開く音を再生
-    try:
-        with open("src/audio/door-open.mp3", "rb") as f:
-            audio_bytes = f.read()
-        
-        audio_b64 = base64.b64encode(audio_bytes).decode()
-        
-        st.markdown(f"""
-        <audio autoplay style="display: none;">
-            <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-        </audio>
-        """, unsafe_allow_html=True)
-    except FileNotFoundError:
-        st.warning("音声ファイルが見つかりません: src/audio/door-open.mp3")
-    
-    # 音が再生されるまで少し待機
-    time.sleep(2)
-    st.session_state.game_state = 'quiz_intro'
-    st.rerun()
+    # ドアが開く音を再生し、鳴り終わったら次の画面へ（待っている間もスレッドは塞がない）
+    if not transition_scheduled():
+        duration = play_sound_effect("door-open")
+        schedule_transition('quiz_intro', duration or DOOR_OPEN_SECONDS)
+    run_scheduled_transition()
 
 
 def display_middle_success():
@@ -645,7 +1309,7 @@ def display_middle_success():
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/school-gate.png", use_container_width=True)
+        display_image("src/images/school-gate.png")
     
     st.markdown("""
     <div style="text-align: center; margin: 20px 0;">
@@ -657,14 +1321,8 @@ def display_middle_success():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
         if st.button("次に進む", key="next_quiz_button"):
-            # quiz2のプロンプトを読み込む
-            prompt_content = load_prompt_from_file("prompt2.txt")
-            if prompt_content:
-                # メッセージをリセットして新しいプロンプトを設定
-                st.session_state.messages = []
-                st.session_state.openai_messages = [
-                    {"role": "system", "content": prompt_content}
-                ]
+            # quiz2のプロンプトを読み込み、メッセージをリセットする
+            if start_quiz("prompt2.txt"):
                 st.session_state.current_quiz = 'quiz2'
                 st.session_state.game_state = 'quiz2'
                 st.rerun()
@@ -682,42 +1340,19 @@ def display_final_success():
         </div>
         """, unsafe_allow_html=True)
 
-        st.image("src/images/anger-kuromizu.png", use_container_width=True)
+        display_image("src/images/anger-kuromizu.png")
+
+    # 「次へ」で鳴らすドアの音を先に読み込んでおく
+    preload_sound_effects("door-open")
 
     with col3:
         # ボタンの上にマージンを追加
         st.markdown("<div style='margin-top: 100%;'></div>", unsafe_allow_html=True)
-        if st.button("次へ", key="next_button"):
-            # ドアが開く音を再生
-            try:
-                with open("src/audio/door-open.mp3", "rb") as f:
-                    audio_bytes = f.read()
-                
-                # Base64エンコードしてHTMLに埋め込み
-                audio_b64 = base64.b64encode(audio_bytes).decode()
-                
-                st.markdown(f"""
-                <audio autoplay style="display: none;">
-                    <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-                </audio>
-                <script>
-                    // 音声再生を確実にするためのJavaScript
-                    document.addEventListener('DOMContentLoaded', function() {{
-                        const audio = document.querySelector('audio[autoplay]');
-                        if (audio) {{
-                            audio.play().catch(function(error) {{
-                                console.log('音声再生に失敗しました:', error);
-                            }});
-                        }}
-                    }});
-                </script>
-                """, unsafe_allow_html=True)
-            except FileNotFoundError:
-                st.warning("音声ファイルが見つかりません: src/audio/door-open.mp3")
-            
-            time.sleep(2.0)
-            st.session_state.game_state = 'ending'
-            st.rerun()
+        if st.button("次へ", key="next_button", disabled=transition_scheduled()):
+            # ドアが開く音を再生し、鳴り終わったら次の画面へ
+            duration = play_sound_effect("door-open")
+            schedule_transition('ending', duration or DOOR_OPEN_SECONDS)
+        run_scheduled_transition()
 
 
 def display_quiz_intro():
@@ -726,7 +1361,7 @@ def display_quiz_intro():
     # より均等な配置のためのcolumns設定
     col1, col2 = st.columns([1, 1])  # 比率を[1, 2, 1]に変更してより中央に寄せる
     with col1:
-        st.image("src/images/principals-office.png", use_container_width=True)
+        display_image("src/images/principals-office.png")
     
     with col2:
         # 空白を入れて上部に余白を作成し、垂直方向の中央に配置
@@ -745,6 +1380,47 @@ def display_quiz_intro():
             st.session_state.game_state = 'quiz'
             st.rerun()
 
+@st.fragment
+def display_chat():
+    """チャット欄と入力欄（quiz1・quiz2共通）
+
+    回答を送ったときはこのフラグメントだけを再実行する。
+    画面を切り替えるとき（クイズの終了など）は stream_pending_response がアプリ全体を再実行する。
+    サイドバーの状況表示はここでは描き直されないので、それぞれのフラグメントが一定間隔で描き直す
+    """
+    # チャットメッセージの表示エリア
+    chat_area = st.container()
+    
+    # メッセージを表示（読み上げはまだ読み上げていないメッセージだけ）
+    display_messages(chat_area)
+    
+    # 送信されたばかりのメッセージへの返答をストリーミング表示
+    stream_pending_response(chat_area)
+    
+    # ルームでは各端末から届いた回答を入力キューの順に1件ずつ処理する
+    room = get_stage_room()
+    if room is not None:
+        stream_room_turn(chat_area, room)
+        display_room_queue(room)
+    
+    # 入力フィールド（固定位置）
+    st.markdown("""
+        <div class="input-container">
+            <div style="max-width: 1000px; margin: 0 auto;">
+    """, unsafe_allow_html=True)
+    
+    st.text_input(
+        "あなたの回答を入力してください",
+        key="user_input_field",
+        on_change=handle_submit,
+        label_visibility="collapsed"
+    )
+    
+    st.markdown('</div></div>', unsafe_allow_html=True)
+    
+    # 画面下部に余白を追加して、チャットが上に表示されるようにする
+    st.markdown("<div style='height: 300px;'></div>", unsafe_allow_html=True)
+
 def display_quiz():
     """クイズ画面を表示（quiz1）"""
     st.markdown(f"<h1 style='text-align: center;'>基本問題をクリアせよ！</h1>", unsafe_allow_html=True)
@@ -768,36 +1444,13 @@ def display_quiz():
         if model_choice != st.session_state.model_choice:
             st.session_state.model_choice = model_choice
             st.rerun()
+        st.session_state.hedge_enabled = st.toggle(
+            "ヘッジ送信（遅いときはもう一方のモデルにも送る）",
+            value=st.session_state.hedge_enabled,
+        )
+        display_turn_route()
     
-    # チャットメッセージの表示エリア
-    chat_area = st.container()
-    
-    # 過去のメッセージを表示（TTSなし）
-    for i, msg in enumerate(st.session_state.messages[:-1] if st.session_state.messages else []):
-        format_message(msg['role'], msg['content'], chat_area, is_new_message=False)
-    
-    # 最新のメッセージのみTTS処理を行う
-    if st.session_state.messages:
-        latest_msg = st.session_state.messages[-1]
-        format_message(latest_msg['role'], latest_msg['content'], chat_area, is_new_message=True)
-    
-    # 入力フィールド（固定位置）
-    st.markdown("""
-        <div class="input-container">
-            <div style="max-width: 1000px; margin: 0 auto;">
-    """, unsafe_allow_html=True)
-    
-    st.text_input(
-        "あなたの回答を入力してください",
-        key="user_input_field",
-        on_change=handle_submit,
-        label_visibility="collapsed"
-    )
-    
-    st.markdown('</div></div>', unsafe_allow_html=True)
-    
-    # 画面下部に余白を追加して、チャットが上に表示されるようにする
-    st.markdown("<div style='height: 300px;'></div>", unsafe_allow_html=True)
+    display_chat()
 
 def display_quiz2():
     """クイズ画面を表示（quiz2）"""
@@ -822,43 +1475,20 @@ def display_quiz2():
         if model_choice != st.session_state.model_choice:
             st.session_state.model_choice = model_choice
             st.rerun()
+        st.session_state.hedge_enabled = st.toggle(
+            "ヘッジ送信（遅いときはもう一方のモデルにも送る）",
+            value=st.session_state.hedge_enabled,
+        )
+        display_turn_route()
     
-    # チャットメッセージの表示エリア
-    chat_area = st.container()
-    
-    # 過去のメッセージを表示（TTSなし）
-    for i, msg in enumerate(st.session_state.messages[:-1] if st.session_state.messages else []):
-        format_message(msg['role'], msg['content'], chat_area, is_new_message=False)
-    
-    # 最新のメッセージのみTTS処理を行う
-    if st.session_state.messages:
-        latest_msg = st.session_state.messages[-1]
-        format_message(latest_msg['role'], latest_msg['content'], chat_area, is_new_message=True)
-    
-    # 入力フィールド（固定位置）
-    st.markdown("""
-        <div class="input-container">
-            <div style="max-width: 1000px; margin: 0 auto;">
-    """, unsafe_allow_html=True)
-    
-    st.text_input(
-        "あなたの回答を入力してください",
-        key="user_input_field",
-        on_change=handle_submit,
-        label_visibility="collapsed"
-    )
-    
-    st.markdown('</div></div>', unsafe_allow_html=True)
-    
-    # 画面下部に余白を追加して、チャットが上に表示されるようにする
-    st.markdown("<div style='height: 300px;'></div>", unsafe_allow_html=True)
+    display_chat()
 
 def display_ending():
     """エンディング画面を表示"""
     # カラムの比率を変更して中央の列をより大きく
     col1, col2, col3 = st.columns([1, 3, 1])
     with col2:
-        st.image("src/images/manager-room-empty.png", use_container_width=True)
+        display_image("src/images/manager-room-empty.png")
 
 def main():
     st.set_page_config(
@@ -881,6 +1511,14 @@ def main():
     init_session_state()
     st.markdown(load_css(), unsafe_allow_html=True)
     
+    # ルーム（?room=名前）：1つのドライバーだけが返答と音声を作り、ビューアー（&view=1）は表示するだけ
+    room = get_stage_room()
+    if room is not None and is_room_viewer():
+        display_room_viewer(room)
+        return
+    if room is not None:
+        room.claim_driver(current_session_id())
+    
     # TTS設定のトグルボタン（クイズ画面でのみ表示）
     if st.session_state.game_state == 'quiz' or st.session_state.game_state == 'quiz2':
         with st.sidebar:
@@ -894,6 +1532,12 @@ def main():
                 index=0 if st.session_state.tts_provider == "openai" else 1
             )
             
+            # 音声キャッシュの状況と削除ボタン
+            display_tts_cache_stats()
+            if st.button("音声キャッシュを削除", key="purge_tts_cache_button"):
+                get_tts_cache().purge()
+                st.rerun()
+            
             if tts_enabled != st.session_state.tts_enabled or tts_provider != st.session_state.tts_provider:
                 st.session_state.tts_enabled = tts_enabled
                 st.session_state.tts_provider = tts_provider
@@ -918,6 +1562,10 @@ def main():
         display_final_success()
     elif st.session_state.game_state == 'ending':
         display_ending()
+    
+    # 会話と画面の状態をビューアーに配る
+    if room is not None:
+        room.publish(st.session_state.messages, st.session_state.game_state)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
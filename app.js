@@ -18,6 +18,12 @@ const prompts = {
     quiz2: null
 };
 
+// 読み方辞書（pronunciation.jsonから読み込む）
+const pronunciation = {
+    map: {},
+    pattern: null
+};
+
 // DOM要素の参照
 const screens = {
     opening: document.getElementById('opening-screen'),
@@ -56,6 +62,9 @@ async function init() {
     // プロンプトを読み込む
     await loadPrompts();
     
+    // 読み方辞書を読み込む
+    await loadPronunciationGuides();
+    
     // アバター画像を読み込む
     loadAvatarImage();
     
@@ -66,6 +75,23 @@ async function init() {
     showScreen('opening');
 }
 
+// 読み方辞書をファイルから読み込み、1つの正規表現にまとめる
+async function loadPronunciationGuides() {
+    try {
+        const response = await fetch('pronunciation.json');
+        const entries = await response.json();
+        const words = Object.keys(entries).filter((word) => word && word !== entries[word]);
+        // 長い語を先に並べて最長一致にする
+        words.sort((a, b) => b.length - a.length);
+        pronunciation.map = entries;
+        pronunciation.pattern = words.length
+            ? new RegExp(words.map((word) => word.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|'), 'g')
+            : null;
+    } catch (error) {
+        console.error('読み方辞書の読み込みエラー:', error);
+    }
+}
+
 // プロンプトをファイルから読み込む
 async function loadPrompts() {
     try {
@@ -631,60 +657,12 @@ async function generateAndPlaySpeech(text, isFinalSuccess = false, callback = nu
 }
 
 // 読み方ガイドを適用する
+// 辞書はpronunciation.json（Python版と共有）から読み込み、1回の走査で最長一致の語を置き換える
 function applyPronunciationGuides(text) {
-    // 読み方マッピング辞書
-    const pronunciationMap = {
-        "源頼朝": "源頼朝みなもとのよりとも",
-        "征夷大将軍": "せいいたいしょうぐん",
-        "趣":"おもむき",
-        "浪人生":"ろうにんせい",
-        "板垣政参": "いたがきまさみつ",
-        "瑞宝中綬章": "ずいほうちゅうじゅしょう",
-        "裏店": "うらみせ",
-        "肉飯": "にくめし",
-        "男く祭": "おとこくさい",
-        "芙蓉": "ふよう",
-        "西鉄": "にしてつ",
-        "久留米":"くるめ",
-        "チーム1":"チームいち",
-        "チーム2":"チームに",
-        "チーム3":"チームさん",
-        "チーム4":"チームよん",
-        "チーム5":"チームご",
-        "1192":"せんひゃくきゅうじゅうに",
-        "2005":"にせんご",
-        "1968":"せんきゅうひゃくろうじゅうはち",
-        "吉川敦": "よしかわあつし",
-        "黒水": "くろうず",
-        "七福神":"しちふくじん", 
-        "満々":"まんまん",
-        "松下由依":"まつしたゆい",
-        "勝連":"かつれん",
-        "小林":"こばやし",
-        "松雪":"まつゆき",
-        "中島":"なかじま",
-        "山本":"やまもと",
-        "上坂元":"かみさかもと",
-        "秋本":"あきもと",
-        "松浦":"まつうら",
-        "田中":"たなか",
-        "吉開":"よしかい",
-        "年": "ねん",
-        "織田信長":"おだのぶなが",
-        "町田": "まちだ",
-        "情け": "なさけ",
-        "三権分立":"さんけんぶんりつ",
-        "県花":"けんか",
-    };
-    
-    // 辞書内の各項目に対して読み方を追加
-    for (const [word, reading] of Object.entries(pronunciationMap)) {
-        if (text.includes(word) && word !== reading) {
-            text = text.replace(new RegExp(word, 'g'), reading);
-        }
+    if (!pronunciation.pattern || !text) {
+        return text;
     }
-    
-    return text;
+    return text.replace(pronunciation.pattern, (word) => pronunciation.map[word]);
 }
 
 // ドアが開く音を再生する
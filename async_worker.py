@@ -0,0 +1,87 @@
+"""返答の生成をスクリプトのスレッドの外で行う、プロセス共有のイベントループ
+
+text_inputのon_changeで返答を同期的に待つと、その間スクリプトのスレッドが塞がり、
+送ったメッセージすら表示されない。ここではバックグラウンドのスレッドで1つのasyncioの
+イベントループを動かし、全セッションの返答生成（AsyncOpenAIの補完とTTS）をそこで
+並行に実行する。画面側は受け取った Future を保持して、終わったら結果を表示する。
+
+Future はセッションIDごとに管理し、ゲームの状態が変わったときやセッションが閉じられたときに
+実行中の呼び出しを取り消す（取り消すと接続も閉じられる）。
+"""
+import asyncio
+import threading
+
+# 閉じられたセッションの呼び出しを探す間隔（秒）
+REAP_INTERVAL_SECONDS = 10
+
+
+class AsyncWorker:
+    """バックグラウンドのスレッドで動くイベントループ（スレッドセーフ）
+
+    is_alive はセッションIDを受け取り、そのセッションがまだ開いているかを返す関数
+    """
+
+    def __init__(self, is_alive=None, reap_interval=REAP_INTERVAL_SECONDS):
+        self.loop = asyncio.new_event_loop()
+        self._is_alive = is_alive
+        self._reap_interval = reap_interval
+        # セッションID → 実行中の Future
+        self._owned = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="async-worker", daemon=True)
+        self._thread.start()
+        if is_alive is not None:
+            asyncio.run_coroutine_threadsafe(self._reap(), self.loop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, owner=None, on_done=None):
+        """コルーチンをイベントループで実行し、concurrent.futures.Future を返す
+
+        on_done は終わったとき（取り消しを含む）にイベントループのスレッドから呼ばれる
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self._lock:
+            self._owned.setdefault(owner, set()).add(future)
+
+        def done(finished):
+            with self._lock:
+                futures = self._owned.get(owner)
+                if futures is not None:
+                    futures.discard(finished)
+                    if not futures:
+                        del self._owned[owner]
+            if on_done is not None:
+                on_done(finished)
+
+        future.add_done_callback(done)
+        return future
+
+    def cancel(self, owner):
+        """セッションの実行中の呼び出しをすべて取り消す"""
+        with self._lock:
+            futures = list(self._owned.get(owner, ()))
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    def pending_count(self):
+        """実行中の呼び出しの数"""
+        with self._lock:
+            return sum(len(futures) for futures in self._owned.values())
+
+    async def _reap(self):
+        """閉じられたセッションの呼び出しを定期的に取り消す"""
+        while True:
+            await asyncio.sleep(self._reap_interval)
+            with self._lock:
+                owners = [owner for owner in self._owned if owner is not None]
+            for owner in owners:
+                try:
+                    alive = self._is_alive(owner)
+                except Exception:
+                    alive = True
+                if not alive:
+                    self.cancel(owner)
@@ -0,0 +1,152 @@
+"""モデルに送る会話履歴の長さを一定に保つ
+
+システムプロンプトと直近のメッセージはそのまま送り、それより古いやり取りは
+「今何問目か・どのチームが回答中か・これまでの不正解」だけの短い要約にまとめる。
+要約はバックグラウンドで作るので、返答を待つ時間には影響しない。
+トークン数は手元で数えて、1回のリクエストの入力トークンに上限を設ける。
+"""
+import os
+
+from resilience import Deadline, call_with_retries
+
+# そのまま送る直近のメッセージ数（ユーザーとアシスタントを合わせて数える）
+CONTEXT_KEEP_MESSAGES = int(os.getenv("CONTEXT_KEEP_MESSAGES", "12"))
+# 1回のリクエストで送る入力トークンの上限
+CONTEXT_MAX_INPUT_TOKENS = int(os.getenv("CONTEXT_MAX_INPUT_TOKENS", "6000"))
+# 要約に使うモデル
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+# 要約1回の持ち時間（秒）。使い切ったら要約せず、次のターンでもう一度要約する
+CONTEXT_SUMMARY_BUDGET_SECONDS = float(os.getenv("CONTEXT_SUMMARY_BUDGET_SECONDS", "20"))
+
+# メッセージ1件ごとに付く役割などの分のトークン
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """あなたはクイズ大会の進行記録係です。
+校長（出題者）と参加者チームの会話から、進行状況だけを短くまとめてください。
+以下の3項目を、それぞれ1行で書いてください。会話の口調や雑談は含めないでください。
+- 現在の問題: 何問目か、問題文の要点
+- 回答中のチーム: 次に答えるチーム
+- 不正解: 現在の問題でこれまでに出た誤答とその回数
+"""
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+
+def count_tokens(text):
+    """テキストのトークン数を数える
+
+    tiktokenがあればGPT-4oと同じエンコーディングで数え、無ければ概算する
+    （日本語は1文字あたり約1トークン、英数字は4文字あたり約1トークン）
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def count_message_tokens(messages):
+    """メッセージのリストの合計トークン数"""
+    return sum(count_tokens(msg["content"]) + _MESSAGE_OVERHEAD_TOKENS for msg in messages)
+
+
+def summarize_with_openai(client, previous_summary, older_messages, model=CONTEXT_SUMMARY_MODEL,
+                          deadline=None, breaker=None):
+    """古いメッセージを前回の要約と合わせて要約し直す（ワーカースレッドで実行する）
+
+    deadline（省略時は CONTEXT_SUMMARY_BUDGET_SECONDS）の中で再試行し、使い切ったら DeadlineExceeded を投げる
+    """
+    transcript = "\n".join(
+        f"{'参加者' if msg['role'] == 'user' else '校長'}: {msg['content']}"
+        for msg in older_messages
+    )
+    response = call_with_retries(
+        lambda timeout: client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"これまでの要約:\n{previous_summary or 'なし'}\n\n続きの会話:\n{transcript}"},
+            ],
+            temperature=0,
+            max_tokens=200,
+        ),
+        deadline or Deadline(CONTEXT_SUMMARY_BUDGET_SECONDS),
+        breaker,
+    )
+    return response.choices[0].message.content.strip()
+
+
+class ConversationContext:
+    """システムプロンプト + 進行状況の要約 + 直近のメッセージ、の形に会話を切り詰める
+
+    messagesは先頭がsystemのOpenAI形式のリスト（st.session_state.openai_messages）。
+    要約済みのメッセージ数を覚えておき、それより後ろだけをそのまま送る。
+    """
+
+    def __init__(self, system_content, keep_messages=CONTEXT_KEEP_MESSAGES,
+                 max_input_tokens=CONTEXT_MAX_INPUT_TOKENS):
+        self.system_content = system_content
+        self.keep_messages = keep_messages
+        self.max_input_tokens = max_input_tokens
+        self.summary = ""
+        # 要約に含めたメッセージ数（systemを除いた先頭からの数）
+        self.folded = 0
+        self._future = None
+        self._future_target = 0
+
+    def _collect(self):
+        """バックグラウンドの要約が終わっていれば取り込む"""
+        if self._future is None or not self._future.done():
+            return
+        try:
+            summary = self._future.result()
+        except Exception:
+            # 要約に失敗した場合は、次のターンでもう一度要約する
+            summary = None
+        if summary:
+            self.summary = summary
+            self.folded = self._future_target
+        self._future = None
+
+    def build(self, messages):
+        """(systemメッセージ, 要約, そのまま送るメッセージ) を返す
+
+        そのまま送るメッセージは、入力トークンの上限に収まるように古い方から削り、
+        ユーザーのメッセージから始まるようにそろえる
+        """
+        self._collect()
+        system, history = messages[0], messages[1:]
+        window = history[min(self.folded, len(history)):]
+        budget = self.max_input_tokens - count_message_tokens([system]) - count_tokens(self.summary)
+        while len(window) > 1 and count_message_tokens(window) > budget:
+            window = window[1:]
+        while len(window) > 1 and window[0]["role"] != "user":
+            window = window[1:]
+        return system, self.summary, window
+
+    def to_openai_messages(self, messages):
+        """OpenAI APIに送るメッセージのリスト"""
+        system, summary, window = self.build(messages)
+        request = [system]
+        if summary:
+            request.append({"role": "system", "content": f"### これまでの進行状況\n{summary}"})
+        return request + window
+
+    def schedule_summary(self, messages, summarize, executor):
+        """直近のメッセージより古い分を、バックグラウンドで要約に畳み込む
+
+        summarize(前回の要約, 新たに畳み込むメッセージ) は要約の文字列を返す関数
+        """
+        self._collect()
+        history = messages[1:]
+        target = len(history) - self.keep_messages
+        if self._future is not None or target <= self.folded:
+            return
+        self._future = executor.submit(summarize, self.summary, history[self.folded:target])
+        self._future_target = target
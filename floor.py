@@ -0,0 +1,278 @@
+"""フロア全員で1st-stageを遊ぶためのモード
+
+会場の参加者（数百台のスマホ）が同じ問題に一斉に答え、司会の画面で回答を締め切ると
+全員分をまとめて判定する。1人ずつGPT-4oに判定させると回答のたびに補完が1回ずつ走るが、
+ここでは judge.batch_judge で一括判定し、判定しきれなかった回答だけを
+重複を除いてまとめてモデルに送るので、1問あたりのモデル呼び出しは数回で済む。
+校長の反応も参加者ごとの会話ではなく、集計結果に対して1問につき1回だけ生成し、
+その文章と読み上げ音声を全員の画面に配る。
+
+フロアの状態はプロセスに1つだけ持ち、全セッションで共有する。
+"""
+import json
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+
+from context_window import count_tokens
+from judge import VERDICT_CORRECT, VERDICT_WRONG, batch_judge
+from llm_scheduler import PRIORITY_FLOOR, SchedulerRejected
+from quiz_bank import parse_prompt
+from resilience import CircuitOpen, Deadline, DeadlineExceeded, call_with_retries
+from resources import get_circuit_breakers, get_llm_scheduler
+
+# 判定しきれなかった回答をモデルに送るときの1回あたりの件数とモデル
+FLOOR_LLM_BATCH_SIZE = 100
+FLOOR_JUDGE_MODEL = "gpt-4o-mini"
+FLOOR_COMMENTARY_MODEL = "gpt-4o"
+# 校長の反応に含める、よくあった誤答の数
+FLOOR_COMMON_WRONG_ANSWERS = 3
+# 順番待ちでフロアの呼び出しをまとめて扱うためのキー
+FLOOR_SCHEDULER_KEY = "floor"
+# 判定・反応それぞれの持ち時間（秒）。順番待ちと再試行を含め、使い切ったらあきらめる
+# （判定はアプリ側の判定だけで集計し、反応は作らずに司会画面にエラーを出す）
+FLOOR_JUDGE_BUDGET_SECONDS = 30
+FLOOR_COMMENTARY_BUDGET_SECONDS = 20
+
+FLOOR_JUDGE_PROMPT = """あなたはクイズの採点係です。
+問題と答え（または判定方法）に照らして、参加者の回答が正解かどうかを判定してください。
+厳密に答えとあっていなくても、意味が合っていれば正解とします。
+「わからない」などの回答は不正解です。
+{"verdicts": [true, false, ...]} の形式で、回答と同じ順番・同じ件数で返してください。
+"""
+
+
+def judge_with_llm(client, question, answers, model=FLOOR_JUDGE_MODEL):
+    """判定しきれなかった回答をまとめてモデルに判定させる
+
+    answersは重複を除いた回答のリスト。回答ごとに正解・不正解のリストを返す。
+    持ち時間を使い切るかブレーカーが開いていたら、そこから後ろの回答はNone（判定できなかった）にする
+    """
+    verdicts = []
+    deadline = Deadline(FLOOR_JUDGE_BUDGET_SECONDS)
+    breaker = get_circuit_breakers().get("openai")
+    for start in range(0, len(answers), FLOOR_LLM_BATCH_SIZE):
+        batch = answers[start:start + FLOOR_LLM_BATCH_SIZE]
+        listing = "\n".join(f"{number}. {answer}" for number, answer in enumerate(batch, 1))
+        try:
+            # 判定結果は回答1件あたり数トークン
+            get_llm_scheduler().acquire(
+                FLOOR_SCHEDULER_KEY,
+                PRIORITY_FLOOR,
+                count_tokens(FLOOR_JUDGE_PROMPT + listing) + 10 * len(batch),
+                model,
+                timeout=deadline.remaining(),
+            )
+            response = call_with_retries(
+                lambda timeout: client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": FLOOR_JUDGE_PROMPT},
+                        {"role": "user", "content": f"{question.describe()}\n\n回答:\n{listing}"},
+                    ],
+                    temperature=0,
+                    response_format={"type": "json_object"},
+                ),
+                deadline,
+                breaker,
+            )
+        except (DeadlineExceeded, CircuitOpen, SchedulerRejected):
+            verdicts.extend([None] * (len(answers) - start))
+            break
+        result = json.loads(response.choices[0].message.content).get("verdicts", [])
+        # 件数が合わない場合、足りない分は不正解として扱う
+        result = (list(result) + [False] * len(batch))[:len(batch)]
+        verdicts.extend(VERDICT_CORRECT if value else VERDICT_WRONG for value in result)
+    return verdicts
+
+
+def comment_on_results(client, bank, question, tally, next_question=None, model=FLOOR_COMMENTARY_MODEL):
+    """問題の集計結果に対する校長の反応を1回だけ生成する
+
+    持ち時間を使い切るかブレーカーが開いていたら DeadlineExceeded か CircuitOpen を投げる
+    """
+    rate = tally["correct"] / tally["total"] if tally["total"] else 0
+    lines = [
+        "### 今回のターン",
+        f"会場の参加者全員が第{question.number}問に答えた。集計結果に対して、会場全体に向けて短く反応する。",
+        question.describe(),
+        f"回答 {tally['total']}人、正解 {tally['correct']}人（正解率 {rate:.0%}）",
+    ]
+    if tally["common_wrong"]:
+        lines.append("よくあった誤答：" + "、".join(f"{answer}（{count}人）" for answer, count in tally["common_wrong"]))
+    lines.append("正解率が高ければ負け惜しみを、低ければ馬鹿にする。答えは言わない。")
+    if next_question is not None:
+        lines.append("最後に「次の問題いくばい」とだけ言う。")
+    else:
+        lines.append(bank.ending)
+    deadline = Deadline(FLOOR_COMMENTARY_BUDGET_SECONDS)
+    try:
+        get_llm_scheduler().acquire(
+            FLOOR_SCHEDULER_KEY,
+            PRIORITY_FLOOR,
+            count_tokens(bank.system_prompt()) + 500,
+            model,
+            timeout=deadline.remaining(),
+        )
+    except SchedulerRejected as e:
+        raise DeadlineExceeded(str(e)) from e
+    response = call_with_retries(
+        lambda timeout: client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": bank.system_prompt()},
+                {"role": "user", "content": "\n".join(lines)},
+            ],
+            temperature=0.7,
+            max_tokens=300,
+        ),
+        deadline,
+        get_circuit_breakers().get("openai"),
+    )
+    return response.choices[0].message.content
+
+
+class Floor:
+    """フロア全体の出題状況・回答・問題ごとの集計（スレッドセーフ）"""
+
+    def __init__(self, bank):
+        self.bank = bank
+        self.question_index = 0
+        # 参加者ID → 回答
+        self.answers = {}
+        # 参加者ID → 判定（締め切って判定したあとだけ入る）
+        self.results = None
+        # 問題番号 → {"total", "correct", "wrong", "common_wrong", ...}
+        self.tallies = {}
+        # 問題番号 → {"text": 校長の反応, "audio": 読み上げ音声のバイト列}
+        self.commentaries = {}
+        # 状態が変わるたびに増える番号（画面の更新が必要かどうかの判断に使う）
+        self.version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def current_question(self):
+        if self.question_index >= len(self.bank.questions):
+            return None
+        return self.bank.questions[self.question_index]
+
+    @property
+    def is_open(self):
+        """回答を受け付けているか"""
+        return self.results is None and self.current_question is not None
+
+    def _touch(self):
+        self.version += 1
+
+    def submit(self, participant_id, answer):
+        """回答を受け付ける。締め切り後や空の回答はFalse"""
+        answer = answer.strip()
+        with self._lock:
+            if not answer or not self.is_open:
+                return False
+            self.answers[participant_id] = answer
+            self._touch()
+            return True
+
+    def close(self, client):
+        """回答を締め切って全員分を判定し、この問題の集計を返す"""
+        with self._lock:
+            if not self.is_open:
+                return self.tallies.get(self.question_index)
+            question = self.current_question
+            # 判定中に届いた回答は受け付けない
+            self.results = {}
+            participants = list(self.answers)
+            answers = [self.answers[participant] for participant in participants]
+
+        started = time.perf_counter()
+        verdicts = batch_judge(question.answer_key, answers)
+        undecided = sorted({answer for answer, verdict in zip(answers, verdicts) if verdict is None})
+        if undecided:
+            try:
+                decided = dict(zip(undecided, judge_with_llm(client, question, undecided)))
+            except Exception:
+                decided = {}
+            # モデルで判定できなかった回答（持ち時間切れなど）は、アプリ側の判定だけで不正解にする
+            verdicts = [
+                verdict if verdict is not None else decided.get(answer) or VERDICT_WRONG
+                for answer, verdict in zip(answers, verdicts)
+            ]
+
+        correct = sum(1 for verdict in verdicts if verdict == VERDICT_CORRECT)
+        common_wrong = Counter(
+            answer for answer, verdict in zip(answers, verdicts) if verdict != VERDICT_CORRECT
+        ).most_common(FLOOR_COMMON_WRONG_ANSWERS)
+        tally = {
+            "total": len(verdicts),
+            "correct": correct,
+            "wrong": len(verdicts) - correct,
+            "common_wrong": common_wrong,
+            "llm_answers": len(undecided),
+            "seconds": time.perf_counter() - started,
+        }
+        with self._lock:
+            self.results = dict(zip(participants, verdicts))
+            self.tallies[self.question_index] = tally
+            self._touch()
+        return tally
+
+    def publish_commentary(self, client, synthesize=None):
+        """締め切った問題の集計に対する校長の反応を生成し、全員に配る
+
+        synthesize は文字列から読み上げ音声のバイト列を作る関数（Noneなら音声なし）。
+        反応は問題ごとに1回だけ生成する
+        """
+        with self._lock:
+            index = self.question_index
+            tally = self.tallies.get(index)
+            if tally is None or index in self.commentaries:
+                return self.commentaries.get(index)
+            # 生成中に別の司会画面から呼ばれても二重に生成しない
+            self.commentaries[index] = None
+        next_index = index + 1
+        next_question = self.bank.questions[next_index] if next_index < len(self.bank.questions) else None
+        try:
+            text = comment_on_results(client, self.bank, self.bank.questions[index], tally, next_question)
+        except Exception:
+            with self._lock:
+                del self.commentaries[index]
+            raise
+        audio = None
+        if synthesize is not None:
+            try:
+                audio = synthesize(text)
+            except Exception:
+                # 音声が作れなくても文章は配る
+                audio = None
+        commentary = {"text": text, "audio": audio}
+        with self._lock:
+            self.commentaries[index] = commentary
+            self._touch()
+        return commentary
+
+    def commentary_for(self, index=None):
+        """問題に対する校長の反応（まだ無ければNone）"""
+        return self.commentaries.get(self.question_index if index is None else index)
+
+    def next_question(self):
+        """次の問題に進んで回答を受け付け直す"""
+        with self._lock:
+            if self.current_question is not None:
+                self.question_index += 1
+            self.answers = {}
+            self.results = None
+            self._touch()
+
+    def result_for(self, participant_id):
+        """参加者の判定（未判定・未回答ならNone）"""
+        results = self.results
+        return results.get(participant_id) if results else None
+
+
+@st.cache_resource(show_spinner=False)
+def get_floor(prompt):
+    """プロンプトごとにフロアの状態を1つだけ作る（全セッションで共有）"""
+    return Floor(parse_prompt(prompt))
@@ -0,0 +1,99 @@
+"""gpt-4oとgeminiへのヘッジ送信（遅い応答の裾を切る）
+
+選択中のモデルに送り、いつもの応答時間（最初の文字が届くまでの時間の上位パーセンタイル）を
+過ぎても最初の文字が届かなければ、同じターンをもう一方のモデルにも送る。
+先に最初の文字を返した方を採用し、もう一方は取り消す（接続を閉じる）。
+"""
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# 応答時間の記録を残す数（プロバイダーごと）
+LATENCY_WINDOW = 50
+# このパーセンタイルを過ぎたらもう一方にも送る
+HEDGE_PERCENTILE = 0.9
+# 記録が少ないときの待ち時間と、待ち時間の下限・上限（秒）
+HEDGE_DEFAULT_DELAY = 3.0
+HEDGE_MIN_DELAY = 1.0
+HEDGE_MAX_DELAY = 6.0
+HEDGE_MIN_SAMPLES = 5
+
+
+class LatencyStats:
+    """プロバイダーごとの、最初の文字が届くまでの時間の記録（スレッドセーフ）"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, seconds):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider, fraction):
+        """記録のパーセンタイル（記録が無ければNone）"""
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(fraction * len(samples)))
+        return samples[index]
+
+    def count(self, provider):
+        with self._lock:
+            return len(self._samples.get(provider, ()))
+
+    def hedge_delay(self, provider, fraction=HEDGE_PERCENTILE):
+        """もう一方にも送るまでの待ち時間（秒）"""
+        if self.count(provider) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, self.percentile(provider, fraction)))
+
+
+def _discard(future):
+    """負けた方の呼び出しを取り消し、始まっていればストリームを閉じる"""
+    if future.cancel():
+        return
+
+    def close(finished):
+        if finished.cancelled() or finished.exception() is not None:
+            return
+        chunks = finished.result()[1]
+        close_stream = getattr(chunks, "close", None)
+        if close_stream is not None:
+            close_stream()
+
+    future.add_done_callback(close)
+
+
+def hedge(primary, secondary, delay, executor):
+    """primary を送り、delay 秒以内に最初の文字が届かなければ secondary も送る
+
+    primary / secondary は引数なしで (最初のチャンク, 残りのチャンク) を返す関数で、
+    ワーカースレッドで実行される（st.session_state は使わないこと）。
+    (勝った方の名前 "primary" / "secondary", 最初のチャンク, 残りのチャンク) を返す。
+    両方とも失敗したら最後の例外を投げる
+    """
+    futures = {executor.submit(primary): "primary"}
+    secondary_started = False
+    last_error = None
+    while futures or not secondary_started:
+        if not futures:
+            # primary がすぐに失敗した場合は待たずに secondary を送る
+            futures[executor.submit(secondary)] = "secondary"
+            secondary_started = True
+        done, _ = wait(futures, timeout=None if secondary_started else delay, return_when=FIRST_COMPLETED)
+        if not done:
+            futures[executor.submit(secondary)] = "secondary"
+            secondary_started = True
+            continue
+        for future in done:
+            name = futures.pop(future)
+            if future.exception() is None:
+                for loser in futures:
+                    _discard(loser)
+                first, chunks = future.result()
+                return name, first, chunks
+            last_error = future.exception()
+    raise last_error
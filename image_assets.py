@@ -0,0 +1,206 @@
+"""画像アセットの縮小・WebP/AVIF変換と、プロセス共有のバイト列キャッシュ
+
+src/images の画像は1枚1.6〜3.4MBのPNGで、画面を切り替えるたびにプロジェクターや
+参加者のスマートフォンが会場のWi-Fiで数MBずつ読み込む。ここでは元の画像の内容のハッシュごとに、
+いくつかの幅に縮小したAVIF・WebPを1回だけ作り、ディスクとプロセスのメモリに保存して使い回す。
+ブラウザは <picture> の srcset から、表示する幅と画面の解像度に合うものを選んで読み込む。
+
+Pillowが無い環境では変換せず、元の画像をそのまま配信する。
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+from pathlib import Path
+
+# 作る幅（px）。表示する最大の幅の2倍（高解像度の画面用）に届くまでを作る
+VARIANT_WIDTHS = (480, 960, 1440, 1920)
+# 優先する順の形式と、品質
+VARIANT_FORMATS = ("avif", "webp")
+VARIANT_QUALITY = {"avif": 55, "webp": 80, "jpeg": 85, "png": None}
+VARIANT_MIMETYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+
+def _pillow():
+    """Pillowの Image モジュール（入っていなければNone）"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def _supported_formats(formats):
+    """Pillowで書き出せる形式だけを残す"""
+    if _pillow() is None:
+        return ()
+    from PIL import features
+    return tuple(fmt for fmt in formats if features.check(fmt))
+
+
+class ImageAssets:
+    """画像の縮小・変換結果のキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, disk_dir=None, widths=VARIANT_WIDTHS, formats=VARIANT_FORMATS):
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.widths = widths
+        self.formats = _supported_formats(formats)
+        # パス → (更新時刻, サイズ, 内容のハッシュ, 元の幅)
+        self._sources = {}
+        # (ハッシュ, 幅, 形式) → バイト列
+        self._variants = {}
+        self._lock = threading.Lock()
+        # 変換は重いので、同じ画像を複数のセッションが同時に変換しないように1つずつ行う
+        self._build_lock = threading.Lock()
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    def _source(self, path):
+        """元の画像の (内容のハッシュ, 元の幅)。ファイルが変わっていなければ読み直さない"""
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._sources.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2], cached[3]
+        data = Path(path).read_bytes()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        width = None
+        Image = _pillow()
+        if Image is not None:
+            with Image.open(path) as image:
+                width = image.width
+        with self._lock:
+            self._sources[path] = (stat.st_mtime_ns, stat.st_size, digest, width)
+        return digest, width
+
+    def _disk_path(self, digest, width, fmt):
+        return self.disk_dir / f"{digest}-{width}.{fmt}"
+
+    def _encode(self, path, width, fmt):
+        Image = _pillow()
+        with Image.open(path) as image:
+            image.load()
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            if image.width > width:
+                height = round(image.height * width / image.width)
+                image = image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            if VARIANT_QUALITY[fmt] is None:
+                image.save(buffer, format=fmt.upper(), optimize=True)
+            else:
+                image.save(buffer, format=fmt.upper(), quality=VARIANT_QUALITY[fmt])
+            return buffer.getvalue()
+
+    def variant(self, path, width, fmt):
+        """幅 width・形式 fmt に変換した画像のバイト列（無ければ作る）"""
+        digest, _ = self._source(path)
+        key = (digest, width, fmt)
+        with self._lock:
+            data = self._variants.get(key)
+        if data is not None:
+            return data
+        with self._build_lock:
+            with self._lock:
+                data = self._variants.get(key)
+            if data is not None:
+                return data
+            disk_path = self._disk_path(digest, width, fmt) if self.disk_dir else None
+            try:
+                data = disk_path.read_bytes() if disk_path else None
+            except OSError:
+                data = None
+            if data is None:
+                data = self._encode(path, width, fmt)
+                if disk_path:
+                    # 書き込み途中のファイルを読まれないように一時ファイル経由で置き換える
+                    tmp_path = disk_path.with_suffix(f".{threading.get_ident()}.tmp")
+                    try:
+                        tmp_path.write_bytes(data)
+                        os.replace(tmp_path, disk_path)
+                    except OSError:
+                        pass
+            with self._lock:
+                self._variants[key] = data
+        return data
+
+    def original(self, path):
+        """変換していない元の画像のバイト列（読み込みは1回だけ）"""
+        digest, _ = self._source(path)
+        key = (digest, None, None)
+        with self._lock:
+            data = self._variants.get(key)
+        if data is None:
+            data = Path(path).read_bytes()
+            with self._lock:
+                self._variants[key] = data
+        return data
+
+    def thumbnail(self, path, width):
+        """st.image や chat_message のアバターにそのまま渡せる、幅 width の縮小画像（JPEGかPNG）
+
+        Streamlitはこれらの形式ならそのまま配信するので、再実行のたびに変換し直されない。
+        Pillowが無ければ元の画像を返す
+        """
+        path = str(path)
+        if _pillow() is None:
+            return self.original(path)
+        with _pillow().open(path) as image:
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        return self.variant(path, width, "png" if has_alpha else "jpeg")
+
+    def sources(self, path, max_width):
+        """表示する最大の幅に合わせた候補
+
+        ([(mimetype, [(幅, 名前, バイト列), ...]), ...], (mimetype, 名前, バイト列)) を返す。
+        前者は優先する形式の順、後者は <picture> に対応していないブラウザ向けの画像
+        """
+        path = str(path)
+        digest, source_width = self._source(path)
+        if not self.formats or source_width is None:
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            return [], (mimetype, f"{digest}{Path(path).suffix}", self.original(path))
+        # 決まった幅の中から、表示する幅の2倍に届くまでを使う（元の画像より大きくはしない）
+        widths = []
+        for width in self.widths:
+            if width >= source_width:
+                break
+            widths.append(width)
+            if width >= max_width * 2:
+                break
+        if not widths or widths[-1] < max_width * 2:
+            widths.append(source_width)
+        candidates = [
+            (VARIANT_MIMETYPES[fmt], [
+                (width, f"{digest}-{width}.{fmt}", self.variant(path, width, fmt)) for width in widths
+            ])
+            for fmt in self.formats
+        ]
+        # 古いブラウザ向けには、最後の形式（WebP）で表示する幅に近いものを使う
+        fallback_width = min(widths, key=lambda width: abs(width - max_width))
+        fallback_fmt = self.formats[-1]
+        fallback = (
+            VARIANT_MIMETYPES[fallback_fmt],
+            f"{digest}-{fallback_width}.{fallback_fmt}",
+            self.variant(path, fallback_width, fallback_fmt),
+        )
+        return candidates, fallback
+
+    def warm(self, paths, max_width):
+        """画像の変換を前もって済ませておく（最初に表示するセッションを待たせない）"""
+        for path in paths:
+            try:
+                self.sources(path, max_width)
+            except Exception:
+                # 読めない画像は表示するときにエラーにする
+                continue
+
+    def stats(self):
+        """キャッシュしている変換結果の数と合計サイズ"""
+        with self._lock:
+            return {
+                "variants": len(self._variants),
+                "variant_bytes": sum(len(data) for data in self._variants.values()),
+            }
+
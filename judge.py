@@ -0,0 +1,279 @@
+"""参加者の回答の正誤をアプリ側で判定する
+
+答えが決まっている問題（「1192年」「had」「ミトコンドリア」「補習科」「2005年」など）は、
+モデルに判定させずにここで判定する。全角・半角、ひらがな・カタカナ、漢数字、
+「年」「第〜代」などの表記ゆれをそろえてから比べ、少しの誤字は許す
+（プロンプトの「厳密に答えとあっていなくても正解とします」に合わせる）。
+判定できない回答（説明を求める問題、似ているとも違うとも言い切れない回答）はNoneを返し、
+その場合だけモデルに判定させる。
+"""
+import difflib
+import re
+import unicodedata
+
+import numpy as np
+
+VERDICT_CORRECT = "正解"
+VERDICT_WRONG = "不正解"
+
+# これ以上似ていれば正解、これ未満なら不正解（間はモデルに任せる）
+CORRECT_RATIO = 0.8
+WRONG_RATIO = 0.5
+
+# 「わからない」などは回答していないものとして不正解にする
+GIVE_UP_ANSWERS = ("わからない", "分からない", "わかりません", "わからん", "知らない", "しらない", "知らん", "パス")
+
+_KANJI_DIGITS = {"〇": 0, "零": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+_KANJI_NUMBER_PATTERN = re.compile(r"[〇零一二三四五六七八九十百千]+")
+_NUMBER_PATTERN = re.compile(r"\d+")
+_KANJI_PATTERN = re.compile(r"[\u4e00-\u9fff々]")
+# 答えの後ろの括弧：かなだけなら読み方、それ以外は補足
+_PARENTHESES_PATTERN = re.compile(r"[（(]([^）)]*)[）)]")
+_KANA_PATTERN = re.compile(r"^[ぁ-ゖァ-ヺー・\s]+$")
+# 答えを並べる区切り（「AもしくはB」「A、B」）
+_ALTERNATIVE_PATTERN = re.compile(r"もしくは|または|、|/|／")
+# 「2番と7番（両方答えないとダメ）」のように全部必要な答えの区切り
+_ALL_PATTERN = re.compile(r"と|,|＆|&")
+# 表記ゆれとして無視する部分（記号・空白、「第11代」「1192年」の数字の前後、文末の「です」など）
+_IGNORED_PATTERN = re.compile(r"[\s\W_]|第(?=\d)|(?<=\d)(?:代目?|年)")
+# 文末の語尾1つ（回答からは1つずつ除く）
+_ENDING_PATTERN = re.compile(r"(?:です|だよ|だ|やろ|ばい|たい|じゃ|かな|か)$")
+# 答えではなく、聞き返しやヒントのお願いなど（漢数字は normalize で数字になっている）
+_NON_ANSWER_PATTERN = re.compile(r"[?]|もう1[回度]|もういっかい|おしえて|教えて|ひんと|言って|いって|問題|どういう")
+# 答えの表記の何倍より長い回答は、答えではなく会話とみなす（似ていなくても不正解にしない）
+MAX_ANSWER_LENGTH_RATIO = 2
+MIN_ANSWER_LENGTH = 6
+
+
+def _kanji_to_number(kanji):
+    """「十一」「二千五」のような漢数字を整数にする"""
+    if all(char in _KANJI_DIGITS for char in kanji):
+        # 「二〇〇五」のように1桁ずつ並べた書き方
+        return int("".join(str(_KANJI_DIGITS[char]) for char in kanji))
+    total = 0
+    digit = 0
+    for char in kanji:
+        if char in _KANJI_DIGITS:
+            digit = _KANJI_DIGITS[char]
+        else:
+            total += (digit or 1) * _KANJI_UNITS[char]
+            digit = 0
+    return total + digit
+
+
+def normalize(text):
+    """表記ゆれをそろえる（全角→半角、カタカナ→ひらがな、漢数字→数字、小文字）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(chr(ord(char) - 0x60) if "ァ" <= char <= "ヶ" else char for char in text)
+    return _KANJI_NUMBER_PATTERN.sub(lambda match: str(_kanji_to_number(match.group())), text)
+
+
+def _strip_marks(text):
+    """比較に使う形（記号・空白・「年」「第〜代」を除く）。答えの表記はこの形で持つ"""
+    return _IGNORED_PATTERN.sub("", text)
+
+
+def _strip(text):
+    """_strip_marks に加えて文末の語尾をすべて除く（答えと関係のない「わからない」などの比較用）"""
+    text = _strip_marks(text)
+    while (match := _ENDING_PATTERN.search(text)) is not None:
+        text = text[:match.start()]
+    return text
+
+
+_GIVE_UP = tuple(_strip(normalize(phrase)) for phrase in GIVE_UP_ANSWERS)
+
+
+def _numbers(text):
+    return _NUMBER_PATTERN.findall(text)
+
+
+# 類似度を使わずには判定が決まらないことを表す印
+_UNDECIDED = object()
+
+
+class AnswerKey:
+    """問題の「答え：」の行から作る、正解とみなす表記の一覧"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        notes = _PARENTHESES_PATTERN.findall(answer)
+        base = _PARENTHESES_PATTERN.sub("", answer)
+        # 「両方答えないとダメ」のような補足があれば、並べた答えを全部言う必要がある
+        self.require_all = any("両方" in note or "全部" in note or "すべて" in note for note in notes)
+        if self.require_all:
+            parts = [part for part in _ALL_PATTERN.split(base) if part.strip()]
+            self.alternatives = [normalize(base)]
+        else:
+            parts = []
+            self.alternatives = [normalize(part) for part in _ALTERNATIVE_PATTERN.split(base) if part.strip()]
+            # かなだけの括弧は読み方なので、それも正解とする（「裏店（うらみせ）」）
+            self.alternatives += [normalize(note) for note in notes if _KANA_PATTERN.match(note)]
+        self.parts = [normalize(part) for part in parts]
+        self.aliases = [alias for alias in (_strip_marks(alternative) for alternative in self.alternatives) if alias]
+        self.numbers = sorted(set(number for alternative in self.alternatives for number in _numbers(alternative)))
+
+    def strip_response(self, normalized):
+        """回答を比較に使う形にする（記号などと文末の語尾を除く）
+
+        語尾は1つずつ除き、除くと答えの表記の途中まで（「ほしゅうか」→「ほしゅう」）になる場合は
+        それ以上除かない。答えそのものの末尾の「か」などを語尾として消さないため
+        """
+        text = _strip_marks(normalized)
+        while (match := _ENDING_PATTERN.search(text)) is not None:
+            rest = text[:match.start()]
+            if rest and any(alias != rest and alias.startswith(rest) for alias in self.aliases):
+                break
+            text = rest
+        return text
+
+    def _similarity(self, response, alias):
+        """回答と答えの近さ（0〜1）。回答が長い場合は答えと同じ長さの部分ごとに比べる"""
+        if alias in response:
+            return 1.0
+        if len(response) <= len(alias):
+            return difflib.SequenceMatcher(None, response, alias).ratio()
+        best = 0.0
+        for start in range(len(response) - len(alias) + 1):
+            window = response[start:start + len(alias)]
+            best = max(best, difflib.SequenceMatcher(None, window, alias).ratio())
+        return best
+
+    def looks_like_answer(self, normalized, stripped):
+        """答えを言っているように見えるか（聞き返しや長い会話ならFalse）"""
+        if _NON_ANSWER_PATTERN.search(normalized):
+            return False
+        longest = max((len(alias) for alias in self.aliases), default=0)
+        return len(stripped) <= max(longest * MAX_ANSWER_LENGTH_RATIO, MIN_ANSWER_LENGTH)
+
+    def _rule_verdict(self, normalized, stripped):
+        """答えとの近さを使わずに決まる判定（決まらなければ _UNDECIDED）"""
+        if not stripped or any(stripped.startswith(phrase) for phrase in _GIVE_UP):
+            return VERDICT_WRONG
+        if _NON_ANSWER_PATTERN.search(normalized):
+            # 「もう一回問題を言って」などは回答ではないので判定しない（モデルに任せる）
+            return None
+
+        if self.numbers:
+            # 数字の答えは数字だけで判定する（「1192」と「1193」を似ているとはしない）
+            given = set(_numbers(normalized))
+            if not given:
+                return None
+            if self.require_all or len(self.numbers) > 1:
+                return VERDICT_CORRECT if set(self.numbers) <= given else VERDICT_WRONG
+            return VERDICT_CORRECT if self.numbers[0] in given else VERDICT_WRONG
+
+        if self.require_all:
+            parts = [_strip_marks(part) for part in self.parts]
+            return VERDICT_CORRECT if all(part in stripped for part in parts) else None
+        return _UNDECIDED
+
+    def _is_partial(self, stripped):
+        """答えの表記の一部だけを答えたか（「補習科」に「補習」、「ほしゅうか」に「ほしゅう」）"""
+        return any(len(stripped) < len(alias) and stripped in alias for alias in self.aliases)
+
+    def _best_similarity(self, stripped):
+        """一番近い表記との近さ（表記の一部だけの回答は、その表記とは比べない）"""
+        best = 0.0
+        for alias in self.aliases:
+            if len(stripped) < len(alias) and stripped in alias:
+                continue
+            ratio = self._similarity(stripped, alias)
+            # 3文字の漢字・かなの答えは1文字違い（「補修科」と「補習科」）まで許す
+            if len(alias) == 3 and not alias.isascii() and ratio >= 0.66:
+                ratio = 1.0
+            best = max(best, ratio)
+        return best
+
+    def _similarity_verdict(self, normalized, stripped, best):
+        """一番近い表記との近さ best からの判定"""
+        if best >= CORRECT_RATIO:
+            return VERDICT_CORRECT
+        if self._is_partial(stripped):
+            # 答えの途中までは正解にも不正解にもしない（モデルに任せる）
+            return None
+        if best < WRONG_RATIO:
+            # 漢字の答えをかなで答えた場合は読みが合っているか分からないのでモデルに任せる
+            if not _KANJI_PATTERN.search(stripped) and any(_KANJI_PATTERN.search(alias) for alias in self.aliases):
+                return None
+            # 答えにしては長い回答は会話かもしれないのでモデルに任せる
+            if not self.looks_like_answer(normalized, stripped):
+                return None
+            return VERDICT_WRONG
+        return None
+
+    def judge(self, response):
+        """正解・不正解・判定できない（None）のどれかを返す"""
+        normalized = normalize(response)
+        stripped = self.strip_response(normalized)
+        verdict = self._rule_verdict(normalized, stripped)
+        if verdict is not _UNDECIDED:
+            return verdict
+        return self._similarity_verdict(normalized, stripped, self._best_similarity(stripped))
+
+
+def _count_matrix(texts, vocabulary):
+    """文字の出現回数の行列（テキスト数 × 語彙数）。語彙にない文字は数えない"""
+    matrix = np.zeros((len(texts), len(vocabulary)), dtype=np.int32)
+    for row, text in enumerate(texts):
+        for char in text:
+            column = vocabulary.get(char)
+            if column is not None:
+                matrix[row, column] += 1
+    return matrix
+
+
+def _similarity_upper_bound(texts, aliases):
+    """AnswerKey._similarity の値の上限（回答数 × 表記数）をまとめて計算する
+
+    difflib の ratio は 2×一致した文字数÷両方の長さの和で、一致した文字数は共通の文字の数
+    （重複を数える）と短い方の長さを超えない。回答が答えより長いときは答えと同じ長さの部分ごとに
+    比べるので、分母は答えの長さの2倍になる
+    """
+    vocabulary = {}
+    for alias in aliases:
+        for char in alias:
+            vocabulary.setdefault(char, len(vocabulary))
+    alias_counts = _count_matrix(aliases, vocabulary)
+    text_counts = _count_matrix(texts, vocabulary)
+    common = np.minimum(text_counts[:, None, :], alias_counts[None, :, :]).sum(axis=2)
+    text_lengths = np.array([len(text) for text in texts])[:, None]
+    alias_lengths = np.array([len(alias) for alias in aliases])[None, :]
+    matched = np.minimum(common, np.minimum(text_lengths, alias_lengths))
+    total = np.where(text_lengths > alias_lengths, 2 * alias_lengths, text_lengths + alias_lengths)
+    return 2 * matched / total
+
+
+def batch_judge(answer_key, responses):
+    """フロア全員の回答をまとめて判定する
+
+    AnswerKey.judge と同じ規則で判定し、同じ回答には必ず同じ判定を返す。
+    同じ表記の回答は1回だけ判定する。答えとの近さ（difflib）は重いので、先に上限を
+    NumPyで全回答 × 全表記まとめて計算し、上限が不正解のしきい値に届かない回答は比べずに済ませる。
+    判定（正解・不正解・None）のリストを返す。answer_keyがNone（答えが決まっていない問題）なら全部Noneになる
+    """
+    if not responses:
+        return []
+    if answer_key is None:
+        return [None] * len(responses)
+    normalized = np.array([normalize(response) for response in responses], dtype=object)
+    unique, inverse = np.unique(normalized, return_inverse=True)
+    stripped = [answer_key.strip_response(text) for text in unique]
+    verdicts = np.full(len(unique), None, dtype=object)
+
+    undecided = []
+    for index, (text, stripped_text) in enumerate(zip(unique, stripped)):
+        verdict = answer_key._rule_verdict(text, stripped_text)
+        if verdict is _UNDECIDED:
+            undecided.append(index)
+        else:
+            verdicts[index] = verdict
+
+    if undecided and answer_key.aliases:
+        bounds = _similarity_upper_bound([stripped[index] for index in undecided], answer_key.aliases).max(axis=1)
+        for index, bound in zip(undecided, bounds):
+            # 上限が不正解のしきい値（3文字の答えで許す0.66より低い）に届かなければ、比べなくても不正解の側
+            best = bound if bound < WRONG_RATIO else answer_key._best_similarity(stripped[index])
+            verdicts[index] = answer_key._similarity_verdict(unique[index], stripped[index], best)
+    return list(verdicts[inverse])
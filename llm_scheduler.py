@@ -0,0 +1,337 @@
+"""プロセス全体のLLMリクエストの順番待ち
+
+フロアの参加者が一斉に回答すると、全セッションがそれぞれ client.chat.completions.create を
+呼ぶのでプロバイダーの429が続き、舞台上のステージのゲームまでフロアの後ろで待たされる。
+ここではリクエストを送る前に LLMScheduler.acquire で順番を取る。
+
+- レート：モデルごとのリクエスト数とトークン数のトークンバケット（OpenAIの上限はモデルごとなので、
+  gpt-4o が混んでいても gpt-4o-mini の呼び出しは待たせない）。レスポンスの x-ratelimit-* ヘッダーで
+  プロバイダー側の残りに合わせ、429が返ったら指定の時間だけそのモデルを止める
+- 優先度：ステージ > フロア > バックグラウンド（要約など）。ステージ用に枠の一部を空けておく
+- 公平性：同じ優先度の中では、セッションごとに順番に送る（1つのセッションが連投しても
+  他のセッションが待たされ続けない）
+- 連投の制限：セッションごとの一定時間内の送信数と、同時に順番待ちできる数
+"""
+import asyncio
+import re
+import threading
+import time
+
+# 優先度（小さいほど先に送る）
+PRIORITY_STAGE = 0
+PRIORITY_FLOOR = 1
+PRIORITY_BACKGROUND = 2
+
+# ステージ用に空けておくバケットの割合（フロアとバックグラウンドはこれより下まで使わない）
+STAGE_RESERVED_FRACTION = 0.1
+# 1セッションが同時に順番待ちできるリクエスト数
+MAX_QUEUED_PER_SESSION = 2
+# 1セッションが SESSION_WINDOW_SECONDS 秒の間に送れる回答の数
+SESSION_MAX_SUBMITS = 5
+SESSION_WINDOW_SECONDS = 30
+# 順番待ちの間に状況を確かめる最長の間隔（秒）
+MAX_WAIT_STEP_SECONDS = 0.5
+
+# 「1s」「6m0s」「20ms」「1h2m3.5s」の形式のリセットまでの時間
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class SchedulerRejected(Exception):
+    """連投の制限や待ち時間の上限で、リクエストを受け付けなかった"""
+
+
+def parse_duration(value):
+    """x-ratelimit-reset-* の値を秒にする（読めなければNone）"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in matches)
+
+
+class TokenBucket:
+    """一定の速さで補充されるバケット（ロックは呼び出し側で持つ）"""
+
+    def __init__(self, capacity, per_seconds=60):
+        self.capacity = capacity
+        self.level = float(capacity)
+        self.rate = capacity / per_seconds
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount, now, reserve=0.0):
+        """amount を取れるようになるまでの秒数（0なら今すぐ取れる）"""
+        self._refill(now)
+        # バケットより大きいリクエストは満杯になれば通す
+        amount = min(amount, self.capacity - reserve)
+        shortage = amount + reserve - self.level
+        if shortage <= 0:
+            return 0.0
+        return shortage / self.rate if self.rate > 0 else MAX_WAIT_STEP_SECONDS
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def sync(self, limit, remaining, reset_seconds, now):
+        """プロバイダーが返した上限・残り・満杯までの時間に合わせる"""
+        self._refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            # 送信済みでまだ数えられていない分があるので、少ない方に合わせる
+            self.level = min(self.level, remaining)
+        if reset_seconds and remaining is not None and self.capacity > remaining:
+            self.rate = (self.capacity - remaining) / reset_seconds
+        elif limit:
+            self.rate = limit / 60
+
+
+class Ticket:
+    """順番待ちの1件"""
+
+    __slots__ = ("session_id", "priority", "tokens", "model", "tag", "seq")
+
+    def __init__(self, session_id, priority, tokens, model, tag, seq):
+        self.session_id = session_id
+        self.priority = priority
+        self.tokens = tokens
+        self.model = model
+        self.tag = tag
+        self.seq = seq
+
+    @property
+    def order(self):
+        return (self.priority, self.tag, self.seq)
+
+
+class LLMScheduler:
+    """プロセスで1つのLLMリクエストの順番待ち（スレッドセーフ）
+
+    requests_per_minute と tokens_per_minute は、ヘッダーで上限が分かるまでの各モデルの見込みの上限
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute,
+                 max_queued_per_session=MAX_QUEUED_PER_SESSION,
+                 session_max_submits=SESSION_MAX_SUBMITS,
+                 session_window_seconds=SESSION_WINDOW_SECONDS,
+                 stage_reserved_fraction=STAGE_RESERVED_FRACTION):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # モデル → (リクエスト数のバケット, トークン数のバケット)
+        self._buckets = {}
+        self.max_queued_per_session = max_queued_per_session
+        self.session_max_submits = session_max_submits
+        self.session_window_seconds = session_window_seconds
+        self.stage_reserved_fraction = stage_reserved_fraction
+        self._waiting = []
+        self._seq = 0
+        # セッションごとの最後の順番（同じ優先度の中で順番に回すための仮想時刻）。
+        # 順番待ちがなくなったセッションの分は消す（次に来たときは今の仮想時刻から数える）
+        self._session_tags = {}
+        self._virtual_time = 0
+        # セッションごとの直近の送信時刻。期間を過ぎたセッションの分は admit のたびに消す
+        self._submits = {}
+        # モデル → 429で止めている期限
+        self._paused_until = {}
+        self.granted = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def admit(self, session_id):
+        """セッションの回答を受け付けてよいか（一定時間内の送信数の上限）"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                sid for sid, times in self._submits.items()
+                if not times or now - times[-1] >= self.session_window_seconds
+            ]
+            for sid in expired:
+                del self._submits[sid]
+            recent = [t for t in self._submits.get(session_id, []) if now - t < self.session_window_seconds]
+            if len(recent) >= self.session_max_submits:
+                self._submits[session_id] = recent
+                return False
+            recent.append(now)
+            self._submits[session_id] = recent
+            return True
+
+    def _buckets_for(self, model):
+        """モデルのバケット（初めてのモデルなら作る。ロックは呼び出し側で持つ）"""
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            buckets = (TokenBucket(self.requests_per_minute), TokenBucket(self.tokens_per_minute))
+            self._buckets[model] = buckets
+        return buckets
+
+    def _enqueue(self, session_id, priority, tokens, model):
+        queued = sum(1 for ticket in self._waiting if ticket.session_id == session_id)
+        if session_id is not None and queued >= self.max_queued_per_session:
+            raise SchedulerRejected("順番待ちのリクエストが多すぎます")
+        tag = max(self._virtual_time, self._session_tags.get(session_id, 0)) + 1
+        self._session_tags[session_id] = tag
+        self._seq += 1
+        ticket = Ticket(session_id, priority, tokens, model, tag, self._seq)
+        self._waiting.append(ticket)
+        return ticket
+
+    def _remove(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            self._forget_idle(ticket.session_id)
+            self._changed.notify_all()
+
+    def _forget_idle(self, session_id):
+        """順番待ちが残っていないセッションの順番を消す（ロックは呼び出し側で持つ）
+
+        送り終えたセッションの順番は仮想時刻以下なので、消しても次の順番は変わらない。
+        送らずにあきらめた分は使っていない枠なので、数えなくてよい
+        """
+        if not any(waiting.session_id == session_id for waiting in self._waiting):
+            self._session_tags.pop(session_id, None)
+
+    def _try_grant(self, ticket):
+        """同じモデルの中で先頭の順番で、そのモデルのバケットに余裕があれば送ってよい
+
+        待つ秒数を返す（0なら送ってよい）
+        """
+        now = time.monotonic()
+        paused_until = self._paused_until.get(ticket.model, 0.0)
+        if now < paused_until:
+            return paused_until - now
+        head = min((waiting for waiting in self._waiting if waiting.model == ticket.model),
+                   key=lambda waiting: waiting.order)
+        if head is not ticket:
+            return MAX_WAIT_STEP_SECONDS
+        requests, tokens = self._buckets_for(ticket.model)
+        reserved = self.stage_reserved_fraction if ticket.priority > PRIORITY_STAGE else 0.0
+        wait = max(
+            requests.wait_time(1, now, reserve=requests.capacity * reserved),
+            tokens.wait_time(ticket.tokens, now, reserve=tokens.capacity * reserved),
+        )
+        if wait > 0:
+            return wait
+        requests.take(1, now)
+        tokens.take(ticket.tokens, now)
+        self._virtual_time = max(self._virtual_time, ticket.tag)
+        self._waiting.remove(ticket)
+        self._forget_idle(ticket.session_id)
+        self.granted += 1
+        self._changed.notify_all()
+        return 0.0
+
+    def _position(self, ticket):
+        return 1 + sum(
+            1 for waiting in self._waiting if waiting.model == ticket.model and waiting.order < ticket.order
+        )
+
+    def acquire(self, session_id, priority, tokens, model, timeout=None, on_wait=None):
+        """model に送る順番が来るまで待つ（スクリプトやワーカーのスレッドから呼ぶ）
+
+        on_wait には待っている間、順番待ちの位置（1始まり）が変わるたびに呼ぶ関数を渡す
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            ticket = self._enqueue(session_id, priority, tokens, model)
+            position = None
+            try:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if wait <= 0:
+                        return
+                    if deadline is not None and time.monotonic() + min(wait, MAX_WAIT_STEP_SECONDS) > deadline:
+                        raise SchedulerRejected("順番待ちの時間が長すぎます")
+                    if on_wait is not None and self._position(ticket) != position:
+                        position = self._position(ticket)
+                        self._lock.release()
+                        try:
+                            on_wait(position)
+                        finally:
+                            self._lock.acquire()
+                    self._changed.wait(min(wait, MAX_WAIT_STEP_SECONDS))
+            finally:
+                self._remove(ticket)
+
+    async def acquire_async(self, session_id, priority, tokens, model, timeout=None):
+        """acquire のイベントループ版（待っている間もループを止めない）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            ticket = self._enqueue(session_id, priority, tokens, model)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_grant(ticket)
+                if wait <= 0:
+                    return
+                if deadline is not None and time.monotonic() + min(wait, MAX_WAIT_STEP_SECONDS) > deadline:
+                    raise SchedulerRejected("順番待ちの時間が長すぎます")
+                await asyncio.sleep(min(wait, MAX_WAIT_STEP_SECONDS))
+        finally:
+            with self._lock:
+                self._remove(ticket)
+
+    def position(self, session_id):
+        """セッションのリクエストの順番待ちの位置（1始まり。待っていなければNone）"""
+        with self._lock:
+            tickets = [ticket for ticket in self._waiting if ticket.session_id == session_id]
+            if not tickets:
+                return None
+            return min(self._position(ticket) for ticket in tickets)
+
+    def observe(self, status_code, headers, model):
+        """レスポンスのステータスとヘッダーで、送ったモデルのプロバイダー側の残りに合わせる
+
+        モデルが分からないレスポンス（model が None）は、どのバケットにも反映しない
+        """
+        if model is None:
+            return
+        now = time.monotonic()
+
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        with self._lock:
+            for bucket, kind in zip(self._buckets_for(model), ("requests", "tokens")):
+                limit = number(f"x-ratelimit-limit-{kind}")
+                remaining = number(f"x-ratelimit-remaining-{kind}")
+                if limit is None and remaining is None:
+                    continue
+                bucket.sync(limit, remaining, parse_duration(headers.get(f"x-ratelimit-reset-{kind}")), now)
+            if status_code == 429:
+                self.rate_limited += 1
+                retry_after = parse_duration(headers.get("retry-after")) or max(
+                    parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                    parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0,
+                    1.0,
+                )
+                self._paused_until[model] = max(self._paused_until.get(model, 0.0), now + retry_after)
+            self._changed.notify_all()
+
+    def stats(self):
+        """画面に出す状況（順番待ちの数・モデルごとの残りの枠・429の回数）"""
+        now = time.monotonic()
+        with self._lock:
+            models = {}
+            for model, (requests, tokens) in self._buckets.items():
+                requests._refill(now)
+                tokens._refill(now)
+                models[model] = {"requests_left": int(requests.level), "tokens_left": int(tokens.level)}
+            return {
+                "waiting": len(self._waiting),
+                "models": models,
+                "granted": self.granted,
+                "rate_limited": self.rate_limited,
+            }
@@ -0,0 +1,116 @@
+"""音声などのバイト列をURLで配信する
+
+base64のdata URIをst.markdownに埋め込むと、サイズが1.33倍になったうえ描画のたびに
+音声全体がWebSocketで送られ、セッションの要素ツリーにも巨大な文字列が残る。
+ここではStreamlitのメディアファイルマネージャーにバイト列を登録し、/media/... のURLで参照する。
+配信はTornadoの静的ファイルハンドラー経由なのでRangeリクエストにも対応している。
+
+登録したファイルはセッション単位で管理され、次の（フラグメントではない）再実行で
+再登録されなければ、その実行の終了時に自動で解放される。
+"""
+import base64
+import hashlib
+
+import streamlit as st
+from streamlit import runtime
+
+from resources import get_image_assets, get_sound_effects
+
+# 列の幅いっぱいに表示する画像の、想定する最大の幅（px）。wideレイアウトの中央の列くらい
+IMAGE_MAX_WIDTH = 960
+
+
+def _with_base_url(url):
+    """server.baseUrlPath が設定されている場合はURLの先頭に付ける"""
+    base_url_path = (st.get_option("server.baseUrlPath") or "").strip("/")
+    if base_url_path and url.startswith("/"):
+        return f"/{base_url_path}{url}"
+    return url
+
+
+def register_media(data, mimetype="audio/mpeg", key=None):
+    """バイト列を登録して、ブラウザから参照できるURLを返す
+
+    keyは同じセッション内で登録を区別するための名前（省略時は内容のハッシュ）。
+    URLは内容で決まり、アプリ全体の再実行で登録し直されなかったものは次の再実行の終わりに消える。
+    Streamlitのランタイム外で実行されている場合はdata URIを返す。
+    """
+    if not runtime.exists():
+        return f"data:{mimetype};base64,{base64.b64encode(data).decode()}"
+    if key is None:
+        key = hashlib.md5(data).hexdigest()
+    url = runtime.get_instance().media_file_mgr.add(data, mimetype, f"kurouzu-media:{key}")
+    return _with_base_url(url)
+
+
+def audio_html(url):
+    """URLを参照する非表示の自動再生audioタグ"""
+    return f"""
+    <audio autoplay preload="auto" style="display: none;">
+        <source src="{url}" type="audio/mpeg">
+    </audio>
+    """
+
+
+def sound_effect_url(effect):
+    """効果音のURL（同じ効果音はいつも同じURLになるので、先読みした分がそのまま使われる）"""
+    return register_media(effect.data, effect.mimetype, key=f"sound-effect-{effect.name}")
+
+
+def play_sound_effect(name, container=None):
+    """効果音を鳴らし、その長さ（秒）を返す。効果音が無ければ警告を出してNoneを返す
+
+    読み込み済みのバイト列をURLで参照するだけなので、ファイルの読み込みや変換はしない
+    """
+    effect = get_sound_effects().get(name)
+    if effect is None:
+        (container or st).warning(f"効果音が見つかりません: {name}")
+        return None
+    (container or st).markdown(audio_html(sound_effect_url(effect)), unsafe_allow_html=True)
+    return effect.duration
+
+
+def preload_sound_effects(*names, container=None):
+    """このあと鳴らす効果音を、ブラウザに先に読み込ませておく"""
+    tags = "".join(
+        f'<audio preload="auto" src="{sound_effect_url(effect)}" style="display: none;"></audio>'
+        for effect in (get_sound_effects().get(name) for name in names)
+        if effect is not None
+    )
+    if tags:
+        (container or st).markdown(tags, unsafe_allow_html=True)
+
+
+def picture_html(candidates, fallback_url, width=None, sizes="100vw"):
+    """形式ごとのsrcsetを並べた <picture> タグ
+
+    candidates は [(mimetype, [(幅, URL), ...]), ...]。ブラウザが対応している最初の形式から、
+    表示する幅と画面の解像度に合うものを選ぶ
+    """
+    style = f"width: {width}px; max-width: 100%;" if width else "width: 100%;"
+    sources = "".join(
+        f'<source type="{mimetype}" sizes="{sizes}" srcset="{", ".join(f"{url} {w}w" for w, url in urls)}">'
+        for mimetype, urls in candidates
+    )
+    return f'<picture>{sources}<img src="{fallback_url}" alt="" decoding="async" style="{style} height: auto;"></picture>'
+
+
+def display_image(path, width=None, container=None):
+    """st.image(path) の代わりに、縮小・変換した画像をURLで表示する
+
+    widthを渡すとその幅（px）で、省略すると列の幅いっぱいに表示する
+    """
+    max_width = width or IMAGE_MAX_WIDTH
+    candidates, (mimetype, name, data) = get_image_assets().sources(path, max_width)
+    urls = [
+        (candidate_mimetype, [(w, register_media(variant, candidate_mimetype, key=variant_name))
+                              for w, variant_name, variant in variants])
+        for candidate_mimetype, variants in candidates
+    ]
+    html = picture_html(
+        urls,
+        register_media(data, mimetype, key=name),
+        width=width,
+        sizes=f"(max-width: 768px) 100vw, {max_width}px",
+    )
+    (container or st).markdown(html, unsafe_allow_html=True)
@@ -0,0 +1,129 @@
+"""ターンの種類と各モデルの調子に合わせて、送るモデルを選ぶ
+
+ほとんどのターンは「不正解、もう一回」の煽りや次の問題を出すだけで、大きなモデルは要らない。
+アプリ側で判定済みの反応や出題だけのターンは速い小さなモデル（small）に、
+モデル自身に判定させるターンや自由な会話は大きなモデル（large）に送る。
+プロバイダーは選択中のものを優先し、最初の文字が届くまでの時間とエラー率の
+指数移動平均（EWMA）が明らかに悪いときだけもう一方に切り替える。
+"""
+import threading
+import time
+
+# ターンの種類
+TURN_ASK = "ask"            # 最初の問題を出すだけ
+TURN_REACTION = "reaction"  # アプリ側で判定済みの回答への反応（と次の問題）
+TURN_OPEN = "open"          # モデルに判定させる回答や、問題と関係のない会話
+
+TIER_SMALL = "small"
+TIER_LARGE = "large"
+_SMALL_TURNS = (TURN_ASK, TURN_REACTION)
+
+# EWMAの重み（新しい値の割合）
+EWMA_ALPHA = 0.2
+# 記録が無いモデルの見込みの応答時間（秒）
+DEFAULT_LATENCY = 2.0
+# エラー率がこれを超えたモデルは使わない
+MAX_ERROR_RATE = 0.5
+# もう一方のプロバイダーがこの割合より速ければ切り替える
+SWITCH_LATENCY_RATIO = 0.5
+# 呼ばれなくなったモデルのエラー率が半分に戻るまでの時間（秒）。外したモデルもいずれ試し直す
+ERROR_HALF_LIFE_SECONDS = 60
+
+
+def classify_turn(tracker, verdict):
+    """進行状況とアプリ側の判定から、ターンの種類を決める"""
+    if not tracker.asked:
+        return TURN_ASK
+    if verdict is not None:
+        return TURN_REACTION
+    return TURN_OPEN
+
+
+class ModelStats:
+    """モデルごとの応答時間とエラー率の指数移動平均（スレッドセーフ）"""
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self._latency = {}
+        self._error_rate = {}
+        self._count = {}
+        self._error_updated = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, latency=None, ok=True):
+        """1回の呼び出しの結果を記録する（失敗のときは latency を渡さない）"""
+        with self._lock:
+            self._count[model] = self._count.get(model, 0) + 1
+            now = time.monotonic()
+            error = 0.0 if ok else 1.0
+            previous = self._decayed_error_rate(model, now) if model in self._error_rate else None
+            self._error_rate[model] = error if previous is None else previous + self.alpha * (error - previous)
+            self._error_updated[model] = now
+            if latency is not None:
+                previous = self._latency.get(model)
+                self._latency[model] = latency if previous is None else previous + self.alpha * (latency - previous)
+
+    def _decayed_error_rate(self, model, now):
+        """最後の記録からの時間の分だけ0に近づけたエラー率（ロックは呼び出し側で持つ）"""
+        rate = self._error_rate.get(model, 0.0)
+        elapsed = now - self._error_updated.get(model, now)
+        return rate * 0.5 ** (elapsed / ERROR_HALF_LIFE_SECONDS)
+
+    def latency(self, model):
+        with self._lock:
+            return self._latency.get(model, DEFAULT_LATENCY)
+
+    def error_rate(self, model):
+        with self._lock:
+            return self._decayed_error_rate(model, time.monotonic())
+
+    def snapshot(self):
+        """画面に出す {モデル: (応答時間, エラー率, 回数)}"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: (self._latency.get(model), self._decayed_error_rate(model, now), count)
+                for model, count in self._count.items()
+            }
+
+
+class ModelRouter:
+    """ターンごとに (プロバイダー, モデル) を選ぶ
+
+    tiers は {プロバイダー: {"small": モデル名, "large": モデル名}}
+    """
+
+    def __init__(self, tiers, stats=None):
+        self.tiers = tiers
+        self.stats = stats or ModelStats()
+
+    def _model(self, provider, tier):
+        models = self.tiers[provider]
+        model = models[tier]
+        # 小さなモデルの調子が悪ければ大きなモデルで代わりにする
+        if tier == TIER_SMALL and self.stats.error_rate(model) > MAX_ERROR_RATE:
+            return models[TIER_LARGE]
+        return model
+
+    def _score(self, model):
+        """小さいほど良い（応答時間をエラー率の分だけ割り増す）"""
+        return self.stats.latency(model) / (1.0 - min(self.stats.error_rate(model), 0.9))
+
+    def choose(self, turn_type, preferred, available):
+        """ターンの種類と選択中のプロバイダーから (プロバイダー, モデル) を選ぶ
+
+        available は今使えるプロバイダーの一覧（APIキーが無いものやブレーカーが開いているものは除く）
+        """
+        tier = TIER_SMALL if turn_type in _SMALL_TURNS else TIER_LARGE
+        provider = preferred
+        candidates = [candidate for candidate in available if candidate != preferred and candidate in self.tiers]
+        if candidates:
+            best = min(candidates, key=lambda candidate: self._score(self._model(candidate, tier)))
+            current = self._score(self._model(preferred, tier))
+            if preferred not in available or self._score(self._model(best, tier)) < current * SWITCH_LATENCY_RATIO:
+                provider = best
+        return provider, self._model(provider, tier)
+
+    def model_for(self, provider, turn_type):
+        """プロバイダーを決めた後で、ターンの種類に合うモデルを選ぶ（切り替え先・ヘッジ送信用）"""
+        return self._model(provider, TIER_SMALL if turn_type in _SMALL_TURNS else TIER_LARGE)
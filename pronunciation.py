@@ -0,0 +1,183 @@
+"""TTS用の読み方変換エンジン
+
+読み方辞書（pronunciation.json）の語を、テキストを1回だけ走査して最長一致で置き換える。
+辞書の項目ごとに str.replace を繰り返すと O(項目数 × テキスト長) かかる。
+
+辞書が小さいうち（READING_TRIE_MIN_ENTRIES 語未満。標準の辞書は約40語）は、長い語から
+並べた正規表現の選択（app.js と同じ方式）で置き換える。Cのregexで走査するので旧方式と
+同じくらい速い。辞書が数千語（卒業生・先生の名前など）に増えたらトライ木に切り替え、
+テキスト長にほぼ比例する時間で終わらせる。どちらも結果は同じ。
+
+辞書ファイルはブラウザ版（app.js の applyPronunciationGuides）と共有している。
+環境変数 PRONUNCIATION_DICTS にパスを os.pathsep 区切りで指定すると、
+追加の辞書を後ろから重ねて読み込む（同じ語は後の辞書が優先）。
+
+    python pronunciation.py   # 旧方式との速度比較（マイクロベンチマーク）
+"""
+import functools
+import json
+import os
+import re
+from pathlib import Path
+
+DEFAULT_DICTIONARY_PATH = Path(__file__).with_name("pronunciation.json")
+# この語数からトライ木で置き換える（少ないうちは正規表現の選択の方が速い）
+READING_TRIE_MIN_ENTRIES = int(os.getenv("READING_TRIE_MIN_ENTRIES", "500"))
+
+# トライ木で「ここで単語が終わる」ことを示すキー（1文字のキーとは衝突しない）
+_END = ""
+
+
+class ReadingEngine:
+    """最長一致・1パスで読み方を置き換える"""
+
+    def __init__(self, entries, trie_min_entries=READING_TRIE_MIN_ENTRIES):
+        # 読みが元の語と同じ項目は置き換えても変わらないので除く
+        self.entries = {word: reading for word, reading in entries.items() if word and word != reading}
+        self._pattern = None
+        self._trie = {}
+        self._find_start = None
+        if self.entries and len(self.entries) < trie_min_entries:
+            # 同じ位置から始まる語は長い方が先に当たるので、最長一致になる
+            words = sorted(self.entries, key=len, reverse=True)
+            self._pattern = re.compile("|".join(re.escape(word) for word in words))
+            return
+        for word, reading in self.entries.items():
+            node = self._trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[_END] = reading
+        # 辞書のどれかの語の先頭になりうる文字だけをCのregexで高速に探す
+        if self._trie:
+            first_chars = "".join(re.escape(char) for char in self._trie)
+            self._find_start = re.compile(f"[{first_chars}]").search
+
+    def __len__(self):
+        return len(self.entries)
+
+    def apply(self, text):
+        """テキスト中の語を読み方に置き換える"""
+        if not text:
+            return text
+        if self._pattern is not None:
+            entries = self.entries
+            return self._pattern.sub(lambda match: entries[match.group()], text)
+        if self._find_start is None:
+            return text
+        find_start = self._find_start
+        trie = self._trie
+        length = len(text)
+        pieces = []
+        position = 0
+        match = find_start(text, position)
+        while match:
+            start = match.start()
+            node = trie
+            index = start
+            reading = None
+            end = start
+            # この位置から始まる最長の語を探す
+            while index < length:
+                node = node.get(text[index])
+                if node is None:
+                    break
+                index += 1
+                if _END in node:
+                    reading = node[_END]
+                    end = index
+            if reading is None:
+                match = find_start(text, start + 1)
+                continue
+            pieces.append(text[position:start])
+            pieces.append(reading)
+            position = end
+            match = find_start(text, position)
+        if not pieces:
+            return text
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+
+def dictionary_paths():
+    """読み込む辞書ファイルのパス（標準の辞書 + 環境変数で指定した追加辞書）"""
+    paths = [DEFAULT_DICTIONARY_PATH]
+    extra = os.getenv("PRONUNCIATION_DICTS", "")
+    paths.extend(Path(path) for path in extra.split(os.pathsep) if path)
+    return paths
+
+
+def load_entries(paths):
+    """辞書ファイルを順に読み込んで1つの辞書にまとめる"""
+    entries = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            entries.update(json.load(f))
+    return entries
+
+
+@functools.lru_cache(maxsize=4)
+def _load_engine(paths, modified_times):
+    return ReadingEngine(load_entries(paths))
+
+
+def get_reading_engine(paths=None):
+    """辞書を読み込んだエンジンを返す
+
+    プロセス内でキャッシュし、辞書ファイルが更新されたときだけ作り直す
+    """
+    paths = tuple(str(path) for path in (paths or dictionary_paths()))
+    modified_times = tuple(os.stat(path).st_mtime_ns for path in paths)
+    return _load_engine(paths, modified_times)
+
+
+def apply_readings(text):
+    """標準の辞書で読み方を置き換える"""
+    return get_reading_engine().apply(text)
+
+
+def _replace_sequentially(text, entries):
+    """旧方式（項目ごとにstr.replace）。ベンチマークの比較用"""
+    for word, reading in entries.items():
+        if word in text and word != reading:
+            text = text.replace(word, reading)
+    return text
+
+
+def _benchmark():
+    import random
+    import timeit
+
+    base_entries = load_entries([DEFAULT_DICTIONARY_PATH])
+    sample = (
+        "なんね、チーム1の秋本と田中！1192年に源頼朝が征夷大将軍になったとは常識やろ。"
+        "次はチーム3の松雪と松浦や。附設の裏店と男く祭、芙蓉の花も知らんとか？"
+        "黒水様を舐めるなよ、2005年の共学化も1968年の移転も知っとるやろうな。"
+    )
+    random.seed(0)
+    kanji = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+    kana = [chr(code) for code in range(0x3041, 0x3097)]
+    for size in (len(base_entries), 300, 1000, 5000):
+        entries = dict(base_entries)
+        while len(entries) < size:
+            name = "".join(random.choice(kanji) for _ in range(random.randint(2, 4)))
+            entries[name] = "".join(random.choice(kana) for _ in range(random.randint(4, 8)))
+        engine = ReadingEngine(entries)
+        regex = ReadingEngine(entries, trie_min_entries=len(entries) + 1)
+        trie = ReadingEngine(entries, trie_min_entries=0)
+        for text_length in (len(sample), len(sample) * 20):
+            text = (sample * 20)[:text_length]
+            assert regex.apply(text) == trie.apply(text)
+            runs = 200
+            old = timeit.timeit(lambda: _replace_sequentially(text, entries), number=runs) / runs
+            timings = [
+                timeit.timeit(lambda: variant.apply(text), number=runs) / runs for variant in (regex, trie, engine)
+            ]
+            print(
+                f"entries={size:5d} chars={text_length:5d}  str.replace: {old * 1e6:8.1f} us  "
+                f"regex: {timings[0] * 1e6:7.1f} us  trie: {timings[1] * 1e6:7.1f} us  "
+                f"engine: {timings[2] * 1e6:7.1f} us  ({old / timings[2]:5.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,342 @@
+"""プロンプトの問題リストを構造化し、進行状況をアプリ側で管理する
+
+prompt.txt / prompt2.txt や各ステージのシステムプロンプトには、キャラクター設定と
+10問分の問題・答え・ヒントがまとめて書かれている。これを毎ターン全部送って
+「今何問目か・次はどのチームか」をモデルに覚えさせると、プロンプトが長くなるうえ、
+問題を飛ばしたり同じ問題を2回出したりする。
+
+ここではプロンプトを「キャラクター設定」と「問題リスト」に分けて読み込み、
+問題番号とチームの順番は QuizTracker で管理する。モデルには毎ターン
+キャラクター設定（システムプロンプト、毎ターン同じ）と、今の問題だけの指示を送る。
+"""
+import re
+
+from judge import VERDICT_CORRECT, VERDICT_WRONG, AnswerKey
+
+# 「### 見出し」で節を区切る（「####」以上は節の中の小見出しとして扱う）
+_SECTION_PATTERN = re.compile(r"^###(?!#)\s*(.*)$")
+_QUESTION_PATTERN = re.compile(r"^質問[0-9０-９]*[：:]\s*(.*)$")
+_FIELD_PATTERN = re.compile(r"^(答え|ヒント|判定)[：:]\s*(.*)$")
+_TEAM_PATTERN = re.compile(r"チーム\s*([0-9０-９]+)\s*[:：]\s*((?:'[^']*'\s*,?\s*)+)")
+_NAMED_TEAMS_PATTERN = re.compile(r"（([^（）]*チーム(?:、[^（）]*チーム)+)）")
+
+# 返答の先頭に付けてもらう判定タグ（判定の値は judge と共通）
+_VERDICT_PATTERN = re.compile(r"^\s*[\[［【]\s*(正解|不正解)\s*[\]］】]\s*")
+# タグかどうかを判断するまでに待つ最大の文字数
+_VERDICT_MAX_LENGTH = 8
+
+# 問題・チーム・終了の合図として別に扱う節
+_QUESTION_SECTION = "質問"
+_TEAM_SECTION = "参加者チーム"
+_ENDING_SECTION = "最後の会話"
+
+
+class Question:
+    """1問分の問題文・答え・判定方法・ヒント
+
+    答えが決まっている問題は answer_key でアプリ側で判定する。
+    「判定：内容が8割あっていればOK」のような問題は判定方法ごとモデルに任せる
+    """
+
+    def __init__(self, text, number):
+        self.number = number
+        self.text = text
+        self.answer = None
+        self.judging = None
+        self.hints = []
+        # 「これはヒントなしで」などの補足
+        self.notes = []
+        # この問題の前に言う前置き（「ここからは附設に関する質問やけんな」など）
+        self.preface = None
+
+    @property
+    def answer_key(self):
+        if not self.answer or self.judging:
+            return None
+        if getattr(self, "_answer_key", None) is None:
+            self._answer_key = AnswerKey(self.answer)
+        return self._answer_key
+
+    @property
+    def hints_allowed(self):
+        """ヒントを出してよい問題か（「これはヒントなしで」と書かれていればFalse）"""
+        return not any("ヒントなし" in note for note in self.notes)
+
+    def describe(self):
+        """モデルに渡す、この問題の説明"""
+        lines = [f"質問：{self.text}"]
+        if self.answer:
+            lines.append(f"答え：{self.answer}（参加者には絶対に教えない）")
+        if self.judging:
+            lines.append(f"判定：{self.judging}")
+        lines.extend(f"ヒント：{hint}" for hint in self.hints if hint)
+        lines.extend(self.notes)
+        return "\n".join(lines)
+
+
+class QuizBank:
+    """プロンプトを読み込んだ結果（キャラクター設定・問題・チーム・最後の会話）"""
+
+    def __init__(self, persona, rules, questions, teams, ending, descending=False, rotate_on_correct=False):
+        self.persona = persona
+        self.rules = rules
+        self.questions = questions
+        self.teams = teams
+        self.ending = ending
+        # 数字の大きなチームから当てる
+        self.descending = descending
+        # 回答ごとではなく、次の問題に進んだときだけ次のチームに当てる
+        self.rotate_on_correct = rotate_on_correct
+        # 「ヒントはださないでください」と書かれていれば、どの問題でもヒントを出さない
+        self.hints_allowed = "ヒントはださない" not in persona
+
+    def system_prompt(self):
+        """毎ターン共通のシステムプロンプト（問題リストは含めない）"""
+        parts = [self.persona]
+        if self.rules:
+            parts.append("### 出題のルール\n" + self.rules)
+        parts.append(
+            "### 進め方\n"
+            "問題はアプリが1問ずつ指示する。指示された問題以外は絶対に出さない。"
+        )
+        return "\n\n".join(parts)
+
+    def team_order(self):
+        """当てる順番に並べたチーム名"""
+        return list(reversed(self.teams)) if self.descending else list(self.teams)
+
+
+def _parse_teams(text):
+    """「チーム1: '秋本', '田中'」の形式か「（えいちゃんチーム、まことチーム）」の形式のチーム一覧"""
+    teams = []
+    for match in _TEAM_PATTERN.finditer(text):
+        members = "、".join(re.findall(r"'([^']*)'", match.group(2)))
+        teams.append(f"チーム{match.group(1)}（{members}）")
+    if teams:
+        return teams
+    match = _NAMED_TEAMS_PATTERN.search(text)
+    if match:
+        return match.group(1).split("、")
+    return []
+
+
+def parse_prompt(text):
+    """プロンプトの文字列を QuizBank にする"""
+    sections = [("", [])]
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        match = _SECTION_PATTERN.match(line)
+        if match:
+            sections.append((match.group(1).strip(), []))
+        else:
+            sections[-1][1].append(line)
+
+    persona_parts = []
+    rules = []
+    questions = []
+    teams = []
+    ending = ""
+    preface = None
+    for title, lines in sections:
+        body = "\n".join(lines).strip()
+        if title == _QUESTION_SECTION:
+            current = None
+            for line in lines:
+                question_match = _QUESTION_PATTERN.match(line)
+                field_match = _FIELD_PATTERN.match(line)
+                if question_match:
+                    # 同じ問題が続けて書かれている場合は1問として扱う
+                    if current is not None and current.text == question_match.group(1):
+                        continue
+                    current = Question(question_match.group(1), len(questions) + 1)
+                    current.preface, preface = preface, None
+                    questions.append(current)
+                elif line.startswith("####"):
+                    preface = line.lstrip("#").strip()
+                elif current is None:
+                    if line:
+                        rules.append(line)
+                elif field_match:
+                    name, value = field_match.groups()
+                    if name == "答え":
+                        current.answer = value
+                    elif name == "判定":
+                        current.judging = value
+                    else:
+                        current.hints.append(value)
+                elif line:
+                    current.notes.append(line)
+            teams = teams or _parse_teams(body)
+        elif title == _TEAM_SECTION:
+            teams = _parse_teams(body)
+        elif title == _ENDING_SECTION:
+            ending = body
+        elif body:
+            persona_parts.append(f"### {title}\n{body}" if title else body)
+
+    rules_text = "\n".join(rules)
+    return QuizBank(
+        persona="\n\n".join(persona_parts),
+        rules=rules_text,
+        questions=questions,
+        teams=teams,
+        ending=ending,
+        descending="大きなチームから" in rules_text,
+        rotate_on_correct="次の問題にいったら次の順番のチーム" in rules_text,
+    )
+
+
+def load_quiz_bank(file_path):
+    """プロンプトファイルを読み込んで QuizBank にする"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return parse_prompt(f.read())
+
+
+def parse_verdict(text):
+    """返答の先頭の判定タグを取り出す
+
+    (判定, タグを除いた返答) を返す。タグが無ければ判定はNone
+    """
+    match = _VERDICT_PATTERN.match(text or "")
+    if not match:
+        return None, text
+    return match.group(1), text[match.end():]
+
+
+class VerdictReader:
+    """ストリームの先頭の判定タグを取り除き、判定を記録する"""
+
+    def __init__(self):
+        self.verdict = None
+
+    def read(self, chunks):
+        """タグを除いたチャンクを返すジェネレーター"""
+        buffer = ""
+        chunks = iter(chunks)
+        for chunk in chunks:
+            buffer += chunk
+            stripped = buffer.lstrip()
+            # タグが閉じるか、タグではないと分かるまで表示を待つ
+            if stripped and stripped[0] in "[［【" and len(stripped) < _VERDICT_MAX_LENGTH \
+                    and not any(close in stripped for close in "]］】"):
+                continue
+            break
+        self.verdict, rest = parse_verdict(buffer)
+        if rest:
+            yield rest
+        yield from chunks
+
+
+class QuizTracker:
+    """問題番号とチームの順番をアプリ側で管理する
+
+    セッションごとに1つ作り、st.session_state に保持する
+    """
+
+    def __init__(self, bank):
+        self.bank = bank
+        self.question_index = 0
+        self.team_index = 0
+        self.wrong_attempts = 0
+        # 最初の問題をまだ出していない
+        self.asked = False
+
+    @property
+    def finished(self):
+        return self.question_index >= len(self.bank.questions)
+
+    @property
+    def current_question(self):
+        return None if self.finished else self.bank.questions[self.question_index]
+
+    def _team(self, offset=0):
+        order = self.bank.team_order()
+        if not order:
+            return None
+        return order[(self.team_index + offset) % len(order)]
+
+    def progress(self):
+        """1行の進行状況"""
+        parts = [f"第{self.question_index + 1}問/全{len(self.bank.questions)}問"]
+        if self._team():
+            parts.append(f"回答中: {self._team()}")
+        parts.append(f"この問題の不正解: {self.wrong_attempts}回")
+        return "、".join(parts)
+
+    def _ask(self, question, team):
+        lines = []
+        if question.preface:
+            lines.append(f"出題の前に「{question.preface}」と前置きする。")
+        target = f"{team}に" if team else ""
+        lines.append(f"次の問題を{target}出題する：「{question.text}」")
+        return "\n".join(lines)
+
+    def judge(self, response):
+        """参加者の発言を今の問題への回答としてアプリ側で判定する
+
+        判定できない場合（まだ出題していない、答えが決まっていない問題、
+        正解とも不正解とも言い切れない回答）はNoneを返し、モデルに判定させる
+        """
+        question = self.current_question
+        if not self.asked or question is None or question.answer_key is None:
+            return None
+        return question.answer_key.judge(response)
+
+    def instruction(self, verdict=None):
+        """今回のターンでモデルに送る指示（今の問題と進行状況だけ）
+
+        verdictにアプリ側の判定を渡すと、その判定に合わせた反応だけをモデルに書かせる
+        """
+        question = self.current_question
+        if question is None:
+            return None
+        if not self.asked:
+            return "### 今回のターン\nまだ問題を出していない。判定タグは付けない。\n" + self._ask(question, self._team())
+
+        next_team = self._team(1) if len(self.bank.team_order()) > 1 else self._team()
+        retry_team = self._team() if self.bank.rotate_on_correct else next_team
+        next_question = self.bank.questions[self.question_index + 1] \
+            if self.question_index + 1 < len(self.bank.questions) else None
+        if next_question is not None:
+            on_correct = self._ask(next_question, next_team)
+        else:
+            on_correct = f"これが最後の問題。{self.bank.ending}"
+        on_wrong = f"{retry_team}に同じ問題を答えさせる。" if retry_team else "同じ問題にもう一度答えさせる。"
+        if not (self.bank.hints_allowed and question.hints_allowed):
+            on_wrong = "ヒントは出さない。" + on_wrong
+        lines = [
+            "### 今回のターン",
+            f"進行状況: {self.progress()}",
+            "#### 現在の問題",
+            question.describe(),
+            "#### 返答のしかた",
+        ]
+        if verdict == VERDICT_CORRECT:
+            lines += ["参加者の回答は正解（判定済み。判定タグは付けない）。", on_correct]
+        elif verdict == VERDICT_WRONG:
+            lines += ["参加者の回答は不正解（判定済み。判定タグは付けない）。", on_wrong]
+        else:
+            lines += [
+                f"返答の先頭に、参加者の発言が現在の問題への正しい回答なら[{VERDICT_CORRECT}]、"
+                f"間違った回答なら[{VERDICT_WRONG}]と書く。回答ではない発言ならタグは付けない。",
+                f"正解の場合：{on_correct}",
+                f"不正解の場合：{on_wrong}",
+            ]
+        return "\n".join(lines)
+
+    def record(self, verdict):
+        """モデルの返答を受け取ったあとに進行状況を進める"""
+        if not self.asked:
+            self.asked = True
+            return
+        if verdict is None:
+            return
+        if verdict == VERDICT_CORRECT:
+            self.question_index += 1
+            self.wrong_attempts = 0
+        else:
+            self.wrong_attempts += 1
+            if self.bank.rotate_on_correct:
+                return
+        # 同じチームには続けて当てない
+        self.team_index += 1
@@ -0,0 +1,242 @@
+"""プロバイダー呼び出しの締め切り・再試行・サーキットブレーカー
+
+本番のステージでは、1回の遅い応答でターン全体が止まるのがいちばん困る。
+呼び出しはターンごとの持ち時間（Deadline）の中で行い、失敗したら間隔をランダムに
+ずらして（ジッター）持ち時間の範囲で再試行する。プロバイダーごとのサーキットブレーカーは
+連続した失敗や遅い応答で開き、しばらくの間そのプロバイダーを呼ばずに、
+呼び出し側で決めた代わりの手段（別のプロバイダー、音声なしの表示）に切り替えさせる。
+"""
+import asyncio
+import random
+import threading
+import time
+
+# 続けてこの回数だけ失敗（または遅い応答）したらブレーカーを開く
+BREAKER_FAILURE_THRESHOLD = 3
+# これより遅い応答は失敗として数える（秒）
+BREAKER_SLOW_CALL_SECONDS = 10.0
+# 開いてから試しに1回呼んでみるまでの時間（秒）
+BREAKER_OPEN_SECONDS = 30.0
+
+# 再試行の回数と、間隔の基準・上限（秒）
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 2.0
+
+# 再試行して意味のあるHTTPステータス
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+# 再試行して意味のあるgRPCのステータス（Google Cloud TTS・Geminiの StatusCode の名前）
+RETRYABLE_GRPC_CODES = ("DEADLINE_EXCEEDED", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "ABORTED", "INTERNAL")
+# タイムアウトと接続エラーの例外のクラス名（プロバイダーのSDKを読み込まずに見分ける）
+TRANSIENT_ERROR_NAMES = (
+    "APITimeoutError", "APIConnectionError",    # openai
+    "TimeoutException", "NetworkError", "RemoteProtocolError",    # httpx
+    "RetryError", "ServiceUnavailable",    # google.api_core
+)
+
+
+class DeadlineExceeded(Exception):
+    """持ち時間の中で呼び出しが成功しなかった"""
+
+
+class CircuitOpen(Exception):
+    """サーキットブレーカーが開いているので呼び出さなかった"""
+
+
+class Deadline:
+    """1ターンの持ち時間"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """プロバイダー1つ分のサーキットブレーカー（スレッドセーフ）
+
+    closed（通常）→ 連続で失敗すると open（呼ばない）→ 時間が経つと half_open
+    （1回だけ試す）→ 成功すれば closed、失敗すればまた open
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 slow_call_seconds=BREAKER_SLOW_CALL_SECONDS, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        # half_open で試している呼び出しの開始時刻（取り消された試しで止まらないように期限を付ける）
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """今呼び出してよいか"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.open_seconds:
+                self.state = "half_open"
+                self._trial_started = None
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and (
+                self._trial_started is None or now - self._trial_started >= self.open_seconds
+            ):
+                self._trial_started = now
+                return True
+            return False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.open_seconds
+
+    def record_success(self, latency):
+        """成功した呼び出しを記録する（遅すぎれば失敗として数える）"""
+        if latency >= self.slow_call_seconds:
+            self.record_failure()
+            return
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_started = None
+
+    def release_trial(self):
+        """half_open の試しの呼び出しを、成功とも失敗とも数えずに終える（次の呼び出しが試せる）"""
+        with self._lock:
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_started = None
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class CircuitBreakerRegistry:
+    """プロバイダー名ごとのサーキットブレーカー（プロセスで1つ）"""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name)
+            return breaker
+
+
+def _status_code(error):
+    """例外のHTTPステータス（int）か gRPC の StatusCode の名前（str）。分からなければNone
+
+    openai は status_code、google.api_core は code（HTTPステータスの int か、gRPC の StatusCode）に持つ
+    """
+    for name in ("status_code", "code"):
+        code = getattr(error, name, None)
+        if isinstance(code, int) and not isinstance(code, bool):
+            return code
+        if code is not None and isinstance(getattr(code, "name", None), str):
+            return code.name
+    return None
+
+
+def is_retryable(error):
+    """再試行して意味のある失敗か（タイムアウト・接続エラー・408/409/429/5xx だけ）
+
+    認証エラーや不正なリクエスト、プログラムの誤りは何度呼んでも同じなので再試行しない
+    """
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    status = _status_code(error)
+    if isinstance(status, str):
+        return status in RETRYABLE_GRPC_CODES
+    return status is not None and (status in RETRYABLE_STATUS_CODES or status >= 500)
+
+
+def _retry_delay(attempt):
+    """指数的に伸ばした上限までのランダムな待ち時間（full jitter）"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def call_with_retries(call, deadline, breaker=None, attempts=RETRY_ATTEMPTS):
+    """call(timeout) を持ち時間の中で再試行しながら呼ぶ
+
+    timeout には残りの持ち時間（秒）が渡るので、プロバイダーのクライアントにそのまま渡す。
+    ブレーカーが開いていれば CircuitOpen、持ち時間を使い切ったら DeadlineExceeded を投げる
+    """
+    last_error = None
+    for attempt in range(attempts):
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            break
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpen(breaker.name) from last_error
+        started = time.monotonic()
+        try:
+            result = call(remaining)
+        except Exception as e:
+            if not is_retryable(e):
+                # 認証エラーや不正なリクエストはプロバイダーの不調ではないので、ブレーカーには数えない。
+                # half_open の試しだった場合も、次の呼び出しが試せるように終えておく
+                if breaker is not None:
+                    breaker.release_trial()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            last_error = e
+        else:
+            if breaker is not None:
+                breaker.record_success(time.monotonic() - started)
+            return result
+        delay = _retry_delay(attempt)
+        if delay >= deadline.remaining():
+            break
+        time.sleep(delay)
+    raise DeadlineExceeded(str(last_error) if last_error else "持ち時間を使い切りました") from last_error
+
+
+async def call_with_retries_async(call, deadline, breaker=None, attempts=RETRY_ATTEMPTS):
+    """call_with_retries のイベントループ版（call(timeout) はコルーチンを返す）"""
+    last_error = None
+    for attempt in range(attempts):
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            break
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpen(breaker.name) from last_error
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(call(remaining), remaining)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                if breaker is not None:
+                    breaker.release_trial()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            last_error = e
+        else:
+            if breaker is not None:
+                breaker.record_success(time.monotonic() - started)
+            return result
+        delay = _retry_delay(attempt)
+        if delay >= deadline.remaining():
+            break
+        await asyncio.sleep(delay)
+    raise DeadlineExceeded(str(last_error) if last_error else "持ち時間を使い切りました") from last_error
@@ -0,0 +1,314 @@
+"""プロセス全体で共有するAPIクライアント
+
+Streamlitはユーザー操作のたびにスクリプトを先頭から再実行するため、
+モジュールレベルでクライアントを作るとそのたびに接続プールとTLSハンドシェイクが
+作り直される。ここでは st.cache_resource でプロセスに1つだけクライアントを持ち、
+全セッションでkeep-alive接続を使い回す。
+"""
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+import streamlit as st
+from openai import AsyncOpenAI, OpenAI
+
+from async_worker import AsyncWorker
+from hedging import LatencyStats
+from image_assets import ImageAssets
+from llm_scheduler import LLMScheduler
+from model_router import TIER_LARGE, TIER_SMALL, ModelRouter
+from resilience import CircuitBreakerRegistry
+from sound_effects import SoundEffects
+from rooms import session_is_active
+from tts_cache import TTSCache
+
+# 接続プールとタイムアウトの設定（環境変数で上書き可能）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") != "0"
+
+# 音声合成を並行で行うワーカー数
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+
+# チャットのレート制限の初期値（実際の値はレスポンスのx-ratelimit-*ヘッダーで合わせる）
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+
+# ヘッジ送信で2つのモデルに同時に送るときのワーカー数
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "8"))
+
+# 会話の要約など、返答を待たずに行う処理のワーカー数
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+
+# 合成済み音声キャッシュの設定
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".cache/tts")
+TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", "256"))
+TTS_CACHE_MEMORY_MB = int(os.getenv("TTS_CACHE_MEMORY_MB", "32"))
+TTS_CACHE_DISK_MB = int(os.getenv("TTS_CACHE_DISK_MB", "256"))
+
+# 縮小・変換した画像の保存先と、起動時に変換しておく画像・表示する幅（px）
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".cache/images")
+IMAGE_DIR = "src/images"
+IMAGE_WARM_WIDTH = 960
+# 効果音（ファイル名から拡張子を除いたものが効果音の名前になる）
+SOUND_EFFECTS_DIR = "src/audio"
+# チャットのアバターの縮小画像の幅（px）。表示は80pxなので高解像度の画面用に2倍で作る
+AVATAR_THUMBNAIL_WIDTH = 160
+
+GEMINI_API_KEY_PATH = "src/credentials/gemini-api-key.txt"
+GOOGLE_CREDENTIALS_PATH = "/Users/Yukis_MacBook/Python/Hell-high-school/src/credentials/hell-highschool-40eb2d572293.json"
+
+# Geminiのモデル名と、プロンプト部分のコンテキストキャッシュの保持時間（秒）
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash")
+GEMINI_SMALL_MODEL_NAME = os.getenv("GEMINI_SMALL_MODEL_NAME", "gemini-2.5-flash-lite")
+
+# OpenAIのモデル名（判定済みの反応や出題だけのターンは小さなモデルに送る）
+OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o")
+OPENAI_SMALL_MODEL_NAME = os.getenv("OPENAI_SMALL_MODEL_NAME", "gpt-4o-mini")
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+
+# gRPCチャネルのkeep-alive設定（Google TTS用）
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+def _http2_available():
+    """h2パッケージがあればHTTP/2を使う"""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_http_client(max_connections=HTTP_MAX_CONNECTIONS, read_timeout=HTTP_READ_TIMEOUT, event_hooks=None):
+    """keep-alive/HTTP2対応のhttpxクライアントを作成"""
+    return httpx.Client(
+        event_hooks=event_hooks,
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(HTTP_MAX_KEEPALIVE_CONNECTIONS, max_connections),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+def create_async_http_client(max_connections=HTTP_MAX_CONNECTIONS, read_timeout=HTTP_READ_TIMEOUT, event_hooks=None):
+    """create_http_client と同じ設定の非同期版"""
+    return httpx.AsyncClient(
+        event_hooks=event_hooks,
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(HTTP_MAX_KEEPALIVE_CONNECTIONS, max_connections),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm_scheduler():
+    """チャットのリクエストの順番待ち（全セッションで共有）"""
+    return LLMScheduler(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
+
+def request_model(request):
+    """OpenAIへのリクエストの本文から送ったモデル名を取り出す（分からなければNone）"""
+    try:
+        return json.loads(request.content).get("model")
+    except (ValueError, AttributeError, httpx.RequestNotRead):
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
+    """チャット用のOpenAIクライアント（プロセスで1つだけ作成）
+
+    レスポンスのレート制限のヘッダーは、送ったモデルの順番待ちのバケットに反映する
+    """
+    scheduler = get_llm_scheduler()
+
+    def observe(response):
+        scheduler.observe(response.status_code, response.headers, request_model(response.request))
+
+    return OpenAI(api_key=api_key, http_client=create_http_client(event_hooks={"response": [observe]}))
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_openai_client(api_key):
+    """AsyncWorkerのイベントループで使うOpenAIクライアント（プロセスで1つだけ作成）
+
+    接続プールはイベントループに結び付くので、get_async_worker() のループからだけ使うこと
+    """
+    scheduler = get_llm_scheduler()
+
+    async def observe(response):
+        scheduler.observe(response.status_code, response.headers, request_model(response.request))
+
+    return AsyncOpenAI(api_key=api_key, http_client=create_async_http_client(event_hooks={"response": [observe]}))
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_tts_client(api_key):
+    """TTS用のOpenAIクライアント
+
+    音声のダウンロードがチャットの接続を塞がないようにプールを分けておく
+    """
+    return OpenAI(api_key=api_key, http_client=create_http_client())
+
+
+@st.cache_resource(show_spinner=False)
+def configure_gemini(api_key_path=GEMINI_API_KEY_PATH):
+    """Gemini APIキーを読み込んでgenaiを初期化する（プロセスで1回だけ）
+
+    キーが空ならNoneを返す。ファイルが読めない場合の例外はキャッシュされないので、
+    呼び出し側でエラー表示すれば次の再実行で再試行される。
+    """
+    import google.generativeai as genai
+
+    with open(api_key_path, "r") as f:
+        api_key = f.read().strip()
+    if not api_key:
+        return None
+    genai.configure(api_key=api_key, transport="grpc")
+    return api_key
+
+
+# コンテキストキャッシュが期限切れになる前にモデルを作り直す
+@st.cache_resource(show_spinner=False, ttl=max(GEMINI_CONTEXT_CACHE_TTL - 300, 60))
+def get_gemini_model(system_instruction, model_name=GEMINI_MODEL_NAME):
+    """プロンプトごとにGeminiモデルを1つだけ作る
+
+    プロンプトはsystem_instructionとして渡し、長いプロンプト部分はコンテキストキャッシュに
+    載せて毎ターン送らないようにする。プロンプトがキャッシュの最小トークン数に満たない場合などは
+    キャッシュなしのモデルを使う。configure_gemini() を先に呼んでおくこと。
+    """
+    import google.generativeai as genai
+    from google.generativeai import caching
+
+    try:
+        cached_content = caching.CachedContent.create(
+            model=f"models/{model_name}",
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL),
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    except Exception:
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+
+@st.cache_resource(show_spinner=False)
+def get_google_tts_client(credentials_path=GOOGLE_CREDENTIALS_PATH):
+    """Google Cloud TTSクライアント（gRPCチャネルをプロセスで共有）"""
+    from google.cloud import texttospeech
+    from google.cloud.texttospeech_v1.services.text_to_speech.transports import (
+        TextToSpeechGrpcTransport,
+    )
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
+    channel = TextToSpeechGrpcTransport.create_channel(options=GRPC_CHANNEL_OPTIONS)
+    return texttospeech.TextToSpeechClient(transport=TextToSpeechGrpcTransport(channel=channel))
+
+
+@st.cache_resource(show_spinner=False)
+def get_tts_executor(max_workers=TTS_WORKERS):
+    """文ごとの音声合成に使うワーカープール（全セッションで共有）"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+
+
+@st.cache_resource(show_spinner=False)
+def get_background_executor(max_workers=BACKGROUND_WORKERS):
+    """返答の待ち時間に影響させたくない処理（会話の要約など）のワーカープール"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="background")
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_worker():
+    """返答の生成を行うイベントループ（全セッションで1つを共有）
+
+    閉じられたセッションの実行中の呼び出しは自動で取り消す
+    """
+    return AsyncWorker(is_alive=session_is_active)
+
+
+@st.cache_resource(show_spinner=False)
+def get_hedge_executor(max_workers=HEDGE_WORKERS):
+    """ヘッジ送信で各モデルの最初の文字を待つワーカープール（全セッションで共有）"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+
+@st.cache_resource(show_spinner=False)
+def get_latency_stats():
+    """モデルごとの応答時間の記録（全セッションで共有）"""
+    return LatencyStats()
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_router():
+    """ターンごとのモデルの選択と、モデルごとの応答時間・エラー率の記録（全セッションで共有）"""
+    return ModelRouter({
+        "gpt-4o": {TIER_SMALL: OPENAI_SMALL_MODEL_NAME, TIER_LARGE: OPENAI_MODEL_NAME},
+        "gemini": {TIER_SMALL: GEMINI_SMALL_MODEL_NAME, TIER_LARGE: GEMINI_MODEL_NAME},
+    })
+
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breakers():
+    """プロバイダーごとのサーキットブレーカー（全セッションで共有）"""
+    return CircuitBreakerRegistry()
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_assets():
+    """縮小・変換した画像のキャッシュ（全セッションで共有）
+
+    src/images の画像はバックグラウンドで先に変換しておく
+    """
+    assets = ImageAssets(disk_dir=IMAGE_CACHE_DIR or None)
+    paths = sorted(str(path) for path in Path(IMAGE_DIR).glob("*") if path.suffix.lower() in (".png", ".jpg", ".jpeg"))
+    get_background_executor().submit(assets.warm, paths, IMAGE_WARM_WIDTH)
+    return assets
+
+
+@st.cache_resource(show_spinner=False)
+def get_avatar_thumbnail(path, width=AVATAR_THUMBNAIL_WIDTH):
+    """チャットのアバターの縮小画像（全セッション・全メッセージで同じバイト列を共有）
+
+    Streamlitは同じ内容の画像を1つのURLで配信するので、メッセージごとに送るのはURLだけになる。
+    画像が無ければNone
+    """
+    if not Path(path).exists():
+        return None
+    return get_image_assets().thumbnail(path, width)
+
+
+@st.cache_resource(show_spinner=False)
+def get_sound_effects(directory=SOUND_EFFECTS_DIR):
+    """効果音（起動時に1回だけ読み込み、全セッションで共有）"""
+    return SoundEffects(directory)
+
+
+@st.cache_resource(show_spinner=False)
+def get_tts_cache():
+    """合成済み音声のキャッシュ（全セッションで共有）"""
+    return TTSCache(
+        max_entries=TTS_CACHE_MAX_ENTRIES,
+        max_memory_bytes=TTS_CACHE_MEMORY_MB * 1024 * 1024,
+        disk_dir=TTS_CACHE_DIR or None,
+        max_disk_bytes=TTS_CACHE_DISK_MB * 1024 * 1024,
+    )
@@ -0,0 +1,262 @@
+"""ステージのゲームを複数の画面で同時に見るための「ルーム」
+
+プロジェクター、司会のPC、各チームのタブレットがそれぞれStreamlitのセッションを開くと、
+画面ごとに get_chat_response と音声合成が走ってしまう。ルームでは1つの「ドライバー」
+セッションだけが返答と音声を作り、残りの「ビューアー」セッションは同じ会話と
+音声の参照（TTSキャッシュのキー）を受け取って表示・再生するだけにする。
+
+ビューアーへの反映は、ビューアー側のフラグメントの定期更新（run_every）で行う。
+これがStreamlitの公開APIだけで動く、サポートされた方法である。
+ドライバーが会話を更新したときにサーバー側から再実行を要求する request_rerun と、
+session_is_active は、定期更新を待たずに反映するための補助にすぎない。
+これらはStreamlitの内部（runtime._session_mgr、AppSession._event_loop）を使うので、
+requirements.txt で固定したバージョンでしか確かめていない。
+使えなければ何もしないので、バージョンが変わっても定期更新で追いつく。
+
+各チームの端末からの回答は、ルームの入力キューに順番に積む。キューから取り出して
+返答を作るのはドライバーだけで、同時に処理するのは常に1件（single writer）。
+同じ端末・チームからの同じ回答の二重送信は1件にまとめ、処理中は他の端末に
+「判定中」「順番待ち」を表示する。ルームごとに処理するので全体のロックは持たない。
+"""
+import threading
+import time
+import unicodedata
+import uuid
+from collections import deque
+
+import streamlit as st
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# ストリーミング中の途中経過をビューアーに送る最短の間隔（秒）
+ROOM_PARTIAL_INTERVAL = 0.5
+# 同じ回答の二重送信とみなす間隔（秒）
+ROOM_COALESCE_SECONDS = 5
+# ドライバーが処理中のまま応答しなくなった回答を取り直すまでの時間（秒）
+ROOM_TURN_TIMEOUT = 120
+
+
+def current_session_id():
+    """実行中のStreamlitセッションのID（ランタイム外ならNone）"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
+def session_is_active(session_id):
+    """セッションがまだ開いているか（ランタイムの外では開いているものとして扱う）
+
+    Streamlitの内部APIを使う。使えなければ開いているものとして扱う
+    """
+    try:
+        return runtime.get_instance()._session_mgr.get_active_session_info(session_id) is not None
+    except Exception:
+        return True
+
+
+def request_rerun(session_id):
+    """別のセッションに再実行を要求する。できなければFalse
+
+    Streamlitの内部APIを使う補助の経路。Falseのときは相手のフラグメントの定期更新で反映される
+    """
+    try:
+        session_info = runtime.get_instance()._session_mgr.get_active_session_info(session_id)
+    except Exception:
+        return False
+    if session_info is None:
+        return False
+    session = session_info.session
+    # AppSessionはイベントループのスレッドで操作する
+    event_loop = getattr(session, "_event_loop", None)
+    try:
+        if event_loop is not None:
+            event_loop.call_soon_threadsafe(session.request_rerun, None)
+        else:
+            session.request_rerun(None)
+    except Exception:
+        return False
+    return True
+
+
+class Room:
+    """1つのステージゲームの会話と進行状況（スレッドセーフ）
+
+    会話の各メッセージは {"id", "role", "content", "audio_keys"} の辞書。
+    audio_keys は合成済み音声のTTSキャッシュのキーで、ビューアーはこれで音声を取り出す
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.driver_session_id = None
+        self.transcript = []
+        self.game_state = None
+        # ドライバーがストリーミング中の返答（表示用の途中経過）
+        self.partial = None
+        self.version = 0
+        self._subscribers = set()
+        self._last_partial_at = 0.0
+        # 順番待ちの回答と、ドライバーが処理中の回答
+        self._queue = deque()
+        self.in_flight = None
+        self._in_flight_since = 0.0
+        # 送信元とテキストごとの最後に受け付けた時刻（二重送信の判定用）
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def claim_driver(self, session_id):
+        """このセッションをドライバーにする（後から開いたドライバーが引き継ぐ）"""
+        with self._lock:
+            self.driver_session_id = session_id
+            self._subscribers.discard(session_id)
+
+    def subscribe(self, session_id):
+        """ビューアーとして更新の通知を受け取る"""
+        if session_id is None:
+            return
+        with self._lock:
+            if session_id != self.driver_session_id:
+                self._subscribers.add(session_id)
+
+    def _notify(self, include_driver=False):
+        """購読中のビューアーに再実行を要求する（ロックの外で呼ぶ）"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            driver_session_id = self.driver_session_id
+        if include_driver and driver_session_id:
+            request_rerun(driver_session_id)
+        gone = [session_id for session_id in subscribers if not request_rerun(session_id)]
+        if gone:
+            # 閉じたセッションや、通知できないセッションは定期更新に任せる
+            with self._lock:
+                self._subscribers.difference_update(gone)
+
+    def publish(self, messages, game_state):
+        """ドライバーの会話と画面の状態をビューアーに配る"""
+        transcript = [
+            {
+                "id": msg["id"],
+                "role": msg["role"],
+                "content": msg["content"],
+                "audio_keys": list(msg.get("audio", {}).get("keys", [])),
+            }
+            for msg in messages
+        ]
+        with self._lock:
+            if transcript == self.transcript and game_state == self.game_state and self.partial is None:
+                return
+            self.transcript = transcript
+            self.game_state = game_state
+            self.partial = None
+            self.version += 1
+        self._notify()
+
+    def publish_partial(self, text):
+        """ストリーミング中の返答を、一定の間隔でビューアーに配る"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_partial_at < ROOM_PARTIAL_INTERVAL:
+                return
+            self._last_partial_at = now
+            self.partial = text
+            self.version += 1
+        self._notify()
+
+    def snapshot(self):
+        """ビューアーが表示するための (version, 会話, 画面の状態, 途中経過)"""
+        with self._lock:
+            return self.version, list(self.transcript), self.game_state, self.partial
+
+    def enqueue(self, text, team=None, session_id=None):
+        """回答を入力キューに積む
+
+        (回答, 受け付けたか) を返す。同じ送信元（チーム、チームが無ければセッション）から
+        同じ回答が順番待ち・処理中、または直前に受け付けたばかりなら、新しく積まずに
+        既存の回答を返す
+        """
+        text = text.strip()
+        if not text:
+            return None, False
+        source = team or session_id
+        key = (source, unicodedata.normalize("NFKC", text).lower())
+        now = time.monotonic()
+        with self._lock:
+            for submission in ([self.in_flight] if self.in_flight else []) + list(self._queue):
+                if submission["key"] == key:
+                    return submission, False
+            if now - self._recent.get(key, float("-inf")) < ROOM_COALESCE_SECONDS:
+                return None, False
+            submission = {
+                "id": uuid.uuid4().hex,
+                "key": key,
+                "team": team,
+                "text": text,
+                "session_id": session_id,
+                "submitted_at": now,
+            }
+            self._recent[key] = now
+            self._queue.append(submission)
+            self.version += 1
+        self._notify(include_driver=True)
+        return submission, True
+
+    def begin_turn(self):
+        """ドライバーが次に処理する回答を取り出す
+
+        処理中の回答があればNone（1件ずつしか処理しない）。ドライバーが処理の途中で
+        いなくなった場合は、一定時間が過ぎたら次の回答に進む
+        """
+        with self._lock:
+            if self.in_flight is not None and time.monotonic() - self._in_flight_since < ROOM_TURN_TIMEOUT:
+                return None
+            if not self._queue:
+                self.in_flight = None
+                return None
+            self.in_flight = self._queue.popleft()
+            self._in_flight_since = time.monotonic()
+            self.version += 1
+            submission = self.in_flight
+        self._notify()
+        return submission
+
+    def end_turn(self, submission):
+        """回答の処理が終わった"""
+        with self._lock:
+            if self.in_flight is submission:
+                self.in_flight = None
+            self.version += 1
+        self._notify()
+
+    def has_queued(self):
+        """順番待ちの回答があるか"""
+        with self._lock:
+            return bool(self._queue)
+
+    def queue_status(self):
+        """(処理中の回答, 順番待ちの回答のリスト)"""
+        with self._lock:
+            return self.in_flight, list(self._queue)
+
+
+class RoomRegistry:
+    """ルーム名からルームを引く（プロセスで1つ）"""
+
+    def __init__(self):
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            room = self._rooms.get(name)
+            if room is None:
+                room = self._rooms[name] = Room(name)
+            return room
+
+
+@st.cache_resource(show_spinner=False)
+def get_room_registry():
+    """全セッションで共有するルームの一覧"""
+    return RoomRegistry()
+
+
+def get_room(name):
+    """名前のルームを返す（無ければ作る）"""
+    return get_room_registry().get(name)
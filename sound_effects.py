@@ -0,0 +1,104 @@
+"""効果音をプロセスで1回だけ読み込んで、名前で使えるようにする
+
+ドアが開く音などの効果音は、画面を表示するたびにファイルを開いて読み込んでいた。
+ここでは起動時に src/audio の効果音をすべて読み込み、ファイル名（拡張子なし）で取り出せるようにする。
+再生の長さはMP3のフレームヘッダーから求めておき、効果音が鳴り終わってから画面を進めるのに使う。
+"""
+from pathlib import Path
+
+# MPEGのバージョンのビット → (表の種類, サンプリング周波数)
+_SAMPLE_RATES = {
+    3: ("1", (44100, 48000, 32000)),    # MPEG-1
+    2: ("2", (22050, 24000, 16000)),    # MPEG-2
+    0: ("2", (11025, 12000, 8000)),     # MPEG-2.5
+}
+# (表の種類, レイヤー) → ビットレート（kbps）。インデックス0（free）と15（不正）は使わない
+_BITRATES = {
+    ("1", 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    ("1", 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    ("1", 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    ("2", 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    ("2", 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    ("2", 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+
+def _skip_id3v2(data):
+    """先頭のID3v2タグの長さ（無ければ0）"""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    # サイズは各バイトの下位7ビットを並べた値（syncsafe integer）
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _parse_frame_header(header):
+    """4バイトのフレームヘッダーから (フレームの長さ, サンプル数, サンプリング周波数) を返す
+
+    フレームヘッダーでなければNone
+    """
+    if header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version_bits not in _SAMPLE_RATES or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    table, sample_rates = _SAMPLE_RATES[version_bits]
+    bitrate = _BITRATES[(table, layer)][bitrate_index] * 1000
+    sample_rate = sample_rates[sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and table == "2":
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def mp3_duration(data):
+    """MP3の再生時間（秒）。フレームを先頭から数えるのでVBRでも正しい"""
+    position = _skip_id3v2(data)
+    duration = 0.0
+    while position + 4 <= len(data):
+        frame = _parse_frame_header(data[position:position + 4])
+        if frame is None:
+            # フレームの間のゴミやID3v1タグは1バイトずつ読み飛ばす
+            position += 1
+            continue
+        length, samples, sample_rate = frame
+        duration += samples / sample_rate
+        position += length
+    return duration
+
+
+class SoundEffect:
+    """読み込み済みの効果音1つ"""
+
+    __slots__ = ("name", "data", "mimetype", "duration")
+
+    def __init__(self, name, data, mimetype="audio/mpeg"):
+        self.name = name
+        self.data = data
+        self.mimetype = mimetype
+        self.duration = mp3_duration(data)
+
+
+class SoundEffects:
+    """効果音の一覧（読み込みは作成時の1回だけで、その後は変わらないので複数のスレッドから使ってよい）"""
+
+    def __init__(self, directory):
+        self._effects = {}
+        for path in sorted(Path(directory).glob("*.mp3")):
+            try:
+                self._effects[path.stem] = SoundEffect(path.stem, path.read_bytes())
+            except OSError:
+                continue
+
+    def get(self, name):
+        """名前の効果音（無ければNone）"""
+        return self._effects.get(name)
+
+    def names(self):
+        return sorted(self._effects)
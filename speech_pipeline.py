@@ -0,0 +1,204 @@
+"""返答のストリームを文ごとに区切って並行に音声合成するパイプライン
+
+LLMの返答を最後まで待たずに、文が1つ完成するたびにTTSを発行する。
+合成は共有のワーカープールで並行に行い、結果は文の順番どおりに取り出す。
+ブラウザ側ではWeb Audio APIで取り出した順につなげて再生するので、
+最初の音声が出るまでの時間は「最初の1文の生成時間 + 短いTTS 1回分」になる。
+"""
+import json
+import re
+
+# 文末とみなす記号と、その直後に続く閉じ括弧
+SENTENCE_ENDINGS = "。！？!?\n"
+CLOSING_BRACKETS = "」』）)】"
+
+# 文末記号（連続可）と閉じ括弧のあとに、別の文字が来たところで文を確定する
+# 末尾の記号の後ろに閉じ括弧がまだ届いていない可能性があるので、次の文字を見るまで確定しない
+_SENTENCE_PATTERN = re.compile(
+    rf"(.+?[{SENTENCE_ENDINGS}]+[{CLOSING_BRACKETS}]*)(?=[^{SENTENCE_ENDINGS}{CLOSING_BRACKETS}])",
+    re.DOTALL,
+)
+
+
+class SentenceSplitter:
+    """ストリームで届くテキストから完成した文を取り出す"""
+
+    def __init__(self, min_chars=4):
+        # 「ふん！」のような短すぎる文は次の文とまとめて1回のTTSにする
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """チャンクを追加し、完成した文のリストを返す"""
+        self._buffer += chunk
+        sentences = []
+        pending = ""
+        position = 0
+        for match in _SENTENCE_PATTERN.finditer(self._buffer):
+            pending += match.group(1)
+            position = match.end()
+            if len(pending.strip()) >= self.min_chars:
+                sentences.append(pending)
+                pending = ""
+        self._buffer = pending + self._buffer[position:]
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+    def flush(self):
+        """残りのテキストを最後の文として返す"""
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return [rest] if rest else []
+
+
+class SpeechPipeline:
+    """文ごとの音声合成をワーカープールで並行に行い、順番どおりに取り出す
+
+    synthesize は文字列を受け取って音声バイト列を返す関数。
+    ワーカースレッドで実行されるので、st.session_stateやst.*の表示関数は使わないこと。
+    """
+
+    def __init__(self, synthesize, executor, prepare=None, min_chars=4):
+        self.synthesize = synthesize
+        self.executor = executor
+        self.prepare = prepare
+        self.splitter = SentenceSplitter(min_chars=min_chars)
+        self._futures = []
+        self._next_index = 0
+        # 各文について実際に合成に渡した文字列（番号で引ける）
+        self.texts = []
+
+    def _submit(self, sentences):
+        for sentence in sentences:
+            text = self.prepare(sentence) if self.prepare else sentence
+            self.texts.append(text)
+            self._futures.append(self.executor.submit(self.synthesize, text))
+
+    def feed(self, chunk):
+        """ストリームのチャンクを渡す。文が完成していれば合成を開始する"""
+        self._submit(self.splitter.feed(chunk))
+
+    def ready(self):
+        """合成が終わった音声を、待たずに取り出せる分だけ順番に返す
+
+        (文の番号, 音声バイト列, 例外) のタプルを返す。失敗した文は音声がNoneになる
+        """
+        while self._next_index < len(self._futures) and self._futures[self._next_index].done():
+            yield self._take()
+
+    def finish(self):
+        """残りのテキストも合成して、すべての音声を順番に返す（完了を待つ）"""
+        self._submit(self.splitter.flush())
+        while self._next_index < len(self._futures):
+            yield self._take()
+
+    def cancel(self):
+        """まだ始まっていない合成を取り消す"""
+        for future in self._futures[self._next_index:]:
+            future.cancel()
+        self._next_index = len(self._futures)
+
+    def _take(self):
+        index = self._next_index
+        future = self._futures[index]
+        self._next_index += 1
+        try:
+            return index, future.result(), None
+        except Exception as e:
+            return index, None, e
+
+
+# 親ウィンドウに置く再生キュー
+# コンポーネントのiframeは再実行のたびに消えるので、親ウィンドウの中でスクリプトを実行して
+# AudioContextごと保持する。届いた音声はデコードして番号順に隙間なく再生予約する。
+_PLAYER_SCRIPT = """
+if (!window.__kurouzuSpeech) {
+    window.__kurouzuSpeech = (function() {
+        const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+        const context = new AudioContextClass();
+        let turn = null;
+        let expected = 0;
+        let pending = {};
+        let playhead = 0;
+        let sources = [];
+
+        function reset(newTurn) {
+            sources.forEach(function(source) {
+                try { source.stop(); } catch (e) {}
+            });
+            sources = [];
+            pending = {};
+            expected = 0;
+            playhead = 0;
+            turn = newTurn;
+        }
+
+        function schedule() {
+            while (pending[expected] && pending[expected].buffer) {
+                const buffer = pending[expected].buffer;
+                delete pending[expected];
+                expected += 1;
+                const source = context.createBufferSource();
+                source.buffer = buffer;
+                source.connect(context.destination);
+                const startAt = Math.max(context.currentTime + 0.05, playhead);
+                source.start(startAt);
+                playhead = startAt + buffer.duration;
+                sources.push(source);
+            }
+        }
+
+        return {
+            enqueue: function(turnId, index, src) {
+                if (turnId !== turn) {
+                    reset(turnId);
+                }
+                if (context.state === 'suspended') {
+                    context.resume();
+                }
+                const slot = { buffer: null };
+                pending[index] = slot;
+                if (!src) {
+                    // 合成に失敗した文は無音として扱い、後ろの文の再生を止めない
+                    slot.buffer = context.createBuffer(1, 1, 22050);
+                    schedule();
+                    return;
+                }
+                fetch(src)
+                    .then(function(response) { return response.arrayBuffer(); })
+                    .then(function(data) { return context.decodeAudioData(data); })
+                    .catch(function(error) {
+                        console.log('音声の読み込みに失敗しました:', error);
+                        return context.createBuffer(1, 1, 22050);
+                    })
+                    .then(function(buffer) {
+                        if (pending[index] === slot) {
+                            slot.buffer = buffer;
+                            schedule();
+                        }
+                    });
+            }
+        };
+    })();
+}
+"""
+
+
+def speech_enqueue_html(turn_id, index, src):
+    """音声1つを親ウィンドウの再生キューに追加するHTMLを返す
+
+    components.html(..., height=0) で埋め込む想定。
+    合成に失敗した文もsrcを空にして必ず追加すること（後ろの文が再生待ちのまま止まるため）
+    """
+    return f"""
+    <script>
+        (function() {{
+            const parentWindow = window.parent;
+            if (!parentWindow.__kurouzuSpeech) {{
+                const script = parentWindow.document.createElement('script');
+                script.textContent = {json.dumps(_PLAYER_SCRIPT)};
+                parentWindow.document.head.appendChild(script);
+            }}
+            parentWindow.__kurouzuSpeech.enqueue({json.dumps(turn_id)}, {index}, {json.dumps(src)});
+        }})();
+    </script>
+    """
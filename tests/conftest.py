@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# スクリプトと同じ階層のモジュール（judge, quiz_bank など）をテストから読み込めるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
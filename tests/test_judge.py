@@ -0,0 +1,75 @@
+"""judge の回答判定のテスト"""
+import ast
+from pathlib import Path
+
+import pytest
+
+from judge import VERDICT_CORRECT, AnswerKey, batch_judge
+from quiz_bank import load_quiz_bank, parse_prompt
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _system_prompt(script):
+    """ステージのスクリプトの SYSTEM_PROMPT を、streamlit を読み込まずに取り出す"""
+    tree = ast.parse((ROOT / script).read_text(encoding="utf-8"))
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "SYSTEM_PROMPT" for target in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    raise LookupError(script)
+
+
+def _banks():
+    return {
+        "prompt.txt": load_quiz_bank(ROOT / "prompt.txt"),
+        "prompt2.txt": load_quiz_bank(ROOT / "prompt2.txt"),
+        "1st-stage.py": parse_prompt(_system_prompt("1st-stage.py")),
+        "2nd-stage.py": parse_prompt(_system_prompt("2nd-stage.py")),
+    }
+
+
+def _answer_keys():
+    for name, bank in _banks().items():
+        for question in bank.questions:
+            if question.answer_key is not None:
+                yield pytest.param(question.answer_key, id=f"{name}-{question.number}")
+
+
+def _responses(answer_key, others):
+    """答えの表記から作る、正解・途中まで・誤字・語尾付き・他の問題の答えなどの回答"""
+    responses = ["わからない", "パス", "もう一回問題を言って", "ヒント教えて", "今日はいい天気だけど先生は元気ですか"]
+    for alternative in answer_key.alternatives:
+        responses += [alternative, alternative + "です", alternative + "か", alternative + "だよ", f"たぶん{alternative}"]
+        responses += [alternative[:length] for length in range(1, len(alternative))]
+        responses += [alternative[:index] + "あ" + alternative[index + 1:] for index in range(len(alternative))]
+    return responses + others
+
+
+def test_reading_with_trailing_ka_is_not_stripped():
+    answer_key = AnswerKey("補習科（ほしゅうか）")
+    assert answer_key.judge("ほしゅうか") == VERDICT_CORRECT
+    assert answer_key.judge("ほしゅうかです") == VERDICT_CORRECT
+
+
+@pytest.mark.parametrize("response", ["ほしゅう", "補習"])
+def test_partial_answer_is_not_correct(response):
+    assert AnswerKey("補習科（ほしゅうか）").judge(response) != VERDICT_CORRECT
+
+
+def test_prompt2_reading_answer():
+    bank = load_quiz_bank(ROOT / "prompt2.txt")
+    answer_key = next(question.answer_key for question in bank.questions
+                      if question.answer_key is not None and "ほしゅうか" in question.answer_key.aliases)
+    assert answer_key.judge("ほしゅうか") == VERDICT_CORRECT
+    assert answer_key.judge("ほしゅう") != VERDICT_CORRECT
+    assert answer_key.judge("補習") != VERDICT_CORRECT
+
+
+@pytest.mark.parametrize("answer_key", list(_answer_keys()))
+def test_batch_judge_agrees_with_judge(answer_key):
+    # 他の問題の答えも混ぜて、不正解の側の判定もそろっているか確かめる
+    others = [alternative for param in _answer_keys() for alternative in param.values[0].alternatives]
+    responses = _responses(answer_key, others)
+    assert batch_judge(answer_key, responses) == [answer_key.judge(response) for response in responses]
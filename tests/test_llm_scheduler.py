@@ -0,0 +1,32 @@
+"""llm_scheduler のセッションごとの記録が残り続けないことのテスト"""
+import time
+
+from llm_scheduler import PRIORITY_STAGE, LLMScheduler, SchedulerRejected
+
+
+def test_session_tags_are_dropped_when_queue_empties():
+    scheduler = LLMScheduler(requests_per_minute=1000, tokens_per_minute=100000)
+    for number in range(50):
+        scheduler.acquire(f"session-{number}", PRIORITY_STAGE, 10, "gpt-4o")
+    assert scheduler._session_tags == {}
+
+
+def test_session_tag_is_dropped_after_timeout():
+    scheduler = LLMScheduler(requests_per_minute=1, tokens_per_minute=100000)
+    scheduler.acquire("first", PRIORITY_STAGE, 10, "gpt-4o")
+    try:
+        scheduler.acquire("second", PRIORITY_STAGE, 10, "gpt-4o", timeout=0.01)
+    except SchedulerRejected:
+        pass
+    else:
+        raise AssertionError("バケットが空なのに順番が来た")
+    assert scheduler._session_tags == {}
+
+
+def test_expired_submit_windows_are_dropped():
+    scheduler = LLMScheduler(requests_per_minute=1000, tokens_per_minute=100000, session_window_seconds=0.05)
+    for number in range(20):
+        assert scheduler.admit(f"session-{number}")
+    time.sleep(0.06)
+    assert scheduler.admit("latest")
+    assert list(scheduler._submits) == ["latest"]
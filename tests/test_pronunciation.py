@@ -0,0 +1,30 @@
+"""pronunciation の小さい辞書用の置き換えがトライ木と同じ結果になることのテスト"""
+import random
+
+from pronunciation import DEFAULT_DICTIONARY_PATH, ReadingEngine, load_entries
+
+SAMPLE = (
+    "なんね、チーム1の秋本と田中！1192年に源頼朝が征夷大将軍になったとは常識やろ。"
+    "附設の裏店と男く祭、芙蓉の花も知らんとか？鎌倉幕府も知っとるやろうな。"
+)
+
+
+def test_default_dictionary_uses_regex_and_matches_trie():
+    entries = load_entries([DEFAULT_DICTIONARY_PATH])
+    regex = ReadingEngine(entries)
+    trie = ReadingEngine(entries, trie_min_entries=0)
+    assert regex._pattern is not None
+    assert regex.apply(SAMPLE) == trie.apply(SAMPLE)
+
+
+def test_overlapping_words_take_the_longest_match():
+    random.seed(0)
+    alphabet = "源頼朝鎌倉幕府附設"
+    entries = {
+        "".join(random.choice(alphabet) for _ in range(random.randint(1, 4))): f"<{number}>"
+        for number in range(60)
+    }
+    text = "".join(random.choice(alphabet + "のと") for _ in range(500))
+    regex = ReadingEngine(entries, trie_min_entries=len(entries) + 1)
+    trie = ReadingEngine(entries, trie_min_entries=0)
+    assert regex.apply(text) == trie.apply(text)
@@ -0,0 +1,40 @@
+"""チャット履歴の表示を直近のメッセージに絞る
+
+ステージのゲームは5チーム・10問・やり直しで100件を超えるメッセージになり、
+再実行のたびに全件をアバター付きで描き直すと、再実行の時間も
+WebSocketで送る差分もゲームが進むほど大きくなる。ここでは直近の CHAT_WINDOW_MESSAGES 件だけを
+通常どおり表示し、それより古いメッセージはトグルを開いたときだけ軽いテキストでまとめて表示する。
+"""
+import os
+
+import streamlit as st
+
+# 通常どおり表示する直近のメッセージの数
+CHAT_WINDOW_MESSAGES = int(os.getenv("CHAT_WINDOW_MESSAGES", "20"))
+
+# 古いメッセージの表示で使う話者の名前
+DEFAULT_SPEAKERS = {"user": "あなた", "assistant": "校長"}
+
+
+def split_transcript(messages, window=CHAT_WINDOW_MESSAGES):
+    """(古いメッセージ, 直近のメッセージ) に分ける"""
+    if len(messages) <= window:
+        return [], messages
+    return messages[:-window], messages[-window:]
+
+
+def display_older_messages(older, container, key="show_older_messages", speakers=None):
+    """古いメッセージを、トグルを開いたときだけまとめて表示する
+
+    閉じている間はトグルだけを送るので、古いメッセージが増えても差分は大きくならない
+    """
+    if not older:
+        return
+    speakers = speakers or DEFAULT_SPEAKERS
+    with container:
+        if not st.toggle(f"これまでのやり取りを表示（{len(older)}件）", key=key):
+            return
+        st.markdown("\n\n".join(
+            f"**{speakers.get(msg['role'], msg['role'])}**：{msg['content']}" for msg in older
+        ))
+        st.divider()
@@ -0,0 +1,50 @@
+"""時間をおいて画面を進める（スクリプトのスレッドを待たせない）
+
+ドアの音を鳴らしてから次の画面に進むところで time.sleep をすると、その間スクリプトのスレッドが
+塞がり、会場の全員が同時に進むとスレッドが溜まる。ここでは進む先と時刻をセッションに記録し、
+一定の間隔で再実行されるフラグメントが時刻を過ぎたところで game_state を進める。
+待っている間の間隔はブラウザ側のタイマーで数えるので、サーバーで待っているスレッドは無い。
+"""
+import time
+
+import streamlit as st
+
+# 予約した時刻を過ぎたかを確かめる間隔（秒）
+TRANSITION_POLL_SECONDS = 0.5
+
+
+def schedule_transition(game_state, delay):
+    """delay 秒後に game_state へ進むように予約する"""
+    st.session_state.scheduled_transition = {
+        "from": st.session_state.game_state,
+        "to": game_state,
+        "due": time.monotonic() + delay,
+    }
+
+
+def transition_scheduled():
+    """今の画面から進む予約があるか（別の理由で画面が変わっていれば予約は取り消す）"""
+    transition = st.session_state.get('scheduled_transition')
+    if transition is None:
+        return False
+    if transition["from"] != st.session_state.game_state:
+        del st.session_state.scheduled_transition
+        return False
+    return True
+
+
+@st.fragment(run_every=TRANSITION_POLL_SECONDS)
+def _wait_for_transition():
+    transition = st.session_state.get('scheduled_transition')
+    if transition is None or time.monotonic() < transition["due"]:
+        return
+    del st.session_state.scheduled_transition
+    if st.session_state.game_state == transition["from"]:
+        st.session_state.game_state = transition["to"]
+    st.rerun()
+
+
+def run_scheduled_transition():
+    """予約があれば、時刻になったら画面を進める（予約が無いときは何もしない）"""
+    if transition_scheduled():
+        _wait_for_transition()
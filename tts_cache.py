@@ -0,0 +1,187 @@
+"""合成済み音声のキャッシュ
+
+同じ台詞（オープニングの挑発、問題文、不正解時のツッコミなど）はチームやリハーサルを
+またいで何度も読み上げられるので、合成結果を内容のハッシュで保存して使い回す。
+メモリ上のLRUと、容量上限つきのディスク保存の2段構成。
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def make_cache_key(provider, voice, model, speed, text):
+    """音声の内容を決める要素からキャッシュキーを作る
+
+    textは読み方ガイドを適用した後の、実際にTTSに送る文字列を渡すこと
+    """
+    payload = json.dumps([provider, voice, model, speed, text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """メモリLRU + ディスクの2段キャッシュ（スレッドセーフ）"""
+
+    def __init__(self, max_entries=256, max_memory_bytes=32 * 1024 * 1024,
+                 disk_dir=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(path.stat().st_size for path in self.disk_dir.glob("*.mp3"))
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{key}.mp3"
+
+    def _remember(self, key, data):
+        """メモリに追加し、上限を超えた分を古い順に捨てる（ロック内で呼ぶ）"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_memory_bytes):
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get(self, key):
+        """キャッシュから音声を取り出す。無ければNone"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                data = path.read_bytes()
+                # ディスク側もLRUにするため、使ったファイルの更新時刻を新しくする
+                os.utime(path)
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        """音声を保存する"""
+        with self._lock:
+            self._remember(key, data)
+        if self.disk_dir:
+            self._write_disk(key, data)
+
+    def _write_disk(self, key, data):
+        path = self._disk_path(key)
+        if path.exists():
+            return
+        # 書き込み途中のファイルを読まれないように一時ファイル経由で置き換える
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes += len(data)
+            over_limit = self._disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """ディスクの合計サイズが上限を下回るまで古いファイルから消す"""
+        files = []
+        for path in self.disk_dir.glob("*.mp3"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def get_or_create(self, key, synthesize):
+        """キャッシュに無ければsynthesize()で合成して保存する
+
+        同じキーを複数のセッションが同時に要求した場合、合成は1回だけ行う
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait()
+            data = self.get(key)
+            if data is not None:
+                return data
+            # 先に始めた合成が失敗した場合は自分で合成し直す
+            return self.get_or_create(key, synthesize)
+        try:
+            with self._lock:
+                self.misses += 1
+            data = synthesize()
+            if data:
+                self.put(key, data)
+            return data
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def stats(self):
+        """ヒット数・ミス数などの統計"""
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def purge(self):
+        """メモリとディスクのキャッシュをすべて削除する"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self.memory_hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+        if self.disk_dir:
+            for path in self.disk_dir.glob("*.mp3"):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            with self._lock:
+                self._disk_bytes = 0